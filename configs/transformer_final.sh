@@ -19,6 +19,8 @@ relu_dropout=0.3
 d_ff=1024
 label_smoothing=0.1
 n_warmup_steps=16000
+# the updates use the gradients of the summed loss of the update_freq accumulated batches
+update_freq=1
 tgt_emb_prj_weight_sharing=True
 emb_src_tgt_weight_sharing=True
 exp_name=$1
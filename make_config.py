@@ -65,14 +65,37 @@ if __name__ == '__main__':
                    default=False, help='Whether to weight tie encoder and decoder weights')
     p.add_argument('-labsmooth', '--label_smoothing', type=float,
                    default=0.1, help='Label smoothing rate')
+    p.add_argument('-densels', '--dense_label_smoothing', action='store_true',
+                   help='Compute the label smoothing loss with the dense smoothed distribution instead of the fused loss')
     p.add_argument('-dff', '--d_ff', type=int, default=2048,
                    help='Size of intermiediate hidden layer in Positionwise Feed Forward Net')
+    p.add_argument('-binarized', '--binarized', action='store_true',
+                   help='Read the numericalized (memory-mapped) copy of the dataset instead of the text files')
+    p.add_argument('-streambuf', '--stream_buffer', type=int, default=0,
+                   help='Stream the training data from disk through a buffer of this many pairs (0 loads it in memory)')
+    p.add_argument('-prefetch', '--prefetch', type=int, default=0,
+                   help='Number of batches prepared ahead in the background (0 disables prefetching)')
+    p.add_argument('-workers', '--num_workers', type=int, default=0,
+                   help='Number of worker processes preparing the batches of a binarized dataset (0 uses a thread)')
+    p.add_argument('-packlen', '--pack_len', type=int, default=0,
+                   help='Pack several training pairs into rows of at least this many tokens (Transformer only, 0 disables packing)')
     p.add_argument('-boost', "--boost", action="store_true",
                    help="Apply boosting to training procedure")
     p.add_argument('-bw', "--boost_warmup", type=int, default=3,
                    help="Number of training epochs to do before boosting")
     p.add_argument('-bp', "--boost_percent", type=float, default=0.20,
                    help="Percentage of data points to add to the original data")
+    p.add_argument('-losschunk', '--loss_chunk_size', type=int, default=0,
+                   help='Number of target tokens for which the generator and the loss are computed at once (0 for the whole batch)')
+    p.add_argument('-updatefreq', '--update_freq', type=int, default=1,
+                   help='Number of batches over which the gradients are accumulated before each update')
+    p.add_argument('-logevery', '--log_every', type=int, default=100,
+                   help='Number of updates over which the training statistics are averaged before being logged')
+    p.add_argument('-ckptevery', '--checkpoint_every', type=int, default=0,
+                   help='Recompute the activations of every k-th Transformer layer during backward (0 disables it)')
+    p.add_argument('-bf16', '--bf16', action='store_true',
+                   help='Experimental: train with bfloat16 mixed precision (autocast on the CPU, torch>=1.10). '
+                        'Its speed and BLEU have not been compared against float32 yet')
     p.add_argument('-warmup', '--n_warmup_steps', type=int,
                    default=4000, help='Number of warmup steps for learning rate')
     p.add_argument('-exp_name', '--experiment_name', type=str,
@@ -87,13 +110,15 @@ if __name__ == '__main__':
     common_params = ['epochs', 'min_freq', 'train_batch_size', 'dev_batch_size', 'embed_size', 'n_layers_enc',
                      'n_layers_dec', 'max_length', 'lr', 'grad_clip', 'teacher_forcing_ratio', 'input_dropout',
                      'layer_dropout', 'tgt_emb_prj_weight_sharing', 'emb_src_tgt_weight_sharing', 'exp_name', 'model_type',
-                     'boost', 'boost_warmup', 'boost_percent']
+                     'boost', 'boost_warmup', 'boost_percent', 'loss_chunk_size',
+                     'update_freq', 'log_every', 'bf16', 'binarized',
+                     'stream_buffer', 'prefetch', 'num_workers', 'pack_len']
 
     model2args = {
         'GRU': common_params + ['hidden_size', 'attention'],
         'Transformer': common_params + ['hidden_size', 'num_heads',
-                                        'attention_dropout', 'relu_dropout', 'label_smoothing',
-                                        'd_ff', 'n_warmup_steps']
+                                        'attention_dropout', 'relu_dropout', 'label_smoothing', 'dense_label_smoothing',
+                                        'd_ff', 'n_warmup_steps', 'checkpoint_every']
     }
 
     try:
@@ -37,8 +37,10 @@ class ScaledDotProductAttention(nn.Module):
         scores = torch.matmul(query, key) / math.sqrt(d_k)
 
         # apply mask to scores if given
+        # (-1e9 does not fit in float16, so use the lowest value of the dtype of the scores if it's bigger)
         if mask is not None:
-            scores = scores.masked_fill(mask == 0, -1e9)
+            scores = scores.masked_fill(
+                mask == 0, max(-1e9, torch.finfo(scores.dtype).min))
 
         # compute normalized attention scores
         # [batch_size, num_heads, seq_len, seq_len]
@@ -3,17 +3,56 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from models.attention import DotProductAttention, BahdanauAttention
 from .transformer.embeddings import Embedder, PositionalEncoder
 from .transformer.layers import EncoderLayer, DecoderLayer
 from .transformer.sublayers import LayerNorm
-from utils.utils import get_clones
+from .transformer.state import DecoderState, SlotDecoderState
+from utils.utils import get_clones, use_checkpoint
 from .dropout.embed_dropout import embedded_dropout
 from .dropout.weight_drop import WeightDrop
 from .dropout.variational_dropout import VariationalDropout
 
 
+class GRUDecoderState(object):
+    """
+    Decoding state of the GRUDecoder used for incremental decoding (greedy decoding/beam search).
+    Besides the hidden state of the Decoder, the state holds the projected keys of the attention
+    and the final hidden state of the Encoder, which only need to be computed once per sentence
+
+    Arguments:
+        hidden: hidden state of the Decoder [num_layers, batch_size, hidden_size]
+        projected_keys: The projected Encoder hidden states [batch_size, seq_len, hidden_size] (None without attention)
+        encoder_final: final hidden state of the Encoder [num_layers, batch_size, 2*hidden_size]
+    """
+
+    def __init__(self, hidden, projected_keys, encoder_final):
+        self.hidden = hidden
+        self.projected_keys = projected_keys
+        self.encoder_final = encoder_final
+
+    def reorder(self, index, memory_index=None):
+        """
+        Select/reorder the hypotheses along the batch dimension.
+        This is used to follow the backpointers of the beams during beam search
+        and to drop the sentences that have finished decoding
+
+        Arguments:
+            index: LongTensor with the positions (in the batch) of the hypotheses to keep
+            memory_index: LongTensor with the positions of the projected keys and the final Encoder
+                          state to keep (None leaves them untouched)
+        """
+        self.hidden = self.hidden.index_select(1, index)
+        if memory_index is not None:
+            if self.projected_keys is not None:
+                self.projected_keys = self.projected_keys.index_select(
+                    0, memory_index)
+            self.encoder_final = self.encoder_final.index_select(
+                1, memory_index)
+
+
 class GRUDecoder(nn.Module):
     """
     Conditional GRU Decoder that decodes the source sequence into the target sequence
@@ -53,7 +92,8 @@ class GRUDecoder(nn.Module):
             embed_size + 2 * hidden_size + hidden_size, hidden_size)
         self.variational_dropout = VariationalDropout()
 
-    def forward_step(self, prev_embed, encoder_final, hidden, encoder_hidden=None, src_mask=None, projected_keys=None):
+    def forward_step(self, prev_embed, encoder_final, hidden, encoder_hidden=None, src_mask=None, projected_keys=None,
+                     dropout_rows=None, dropout_batch_size=None):
         """
         Perform a single step of decoding
 
@@ -64,6 +104,10 @@ class GRUDecoder(nn.Module):
             encoder_hidden: hidden states of the Encoder [batch_size, seq_len, 2 * hidden_size]
             src_mask: Mask for src sequence [batch_size, 1, seq_len]
             projected_keys: The projected Encoder hidden states [batch_size, seq_len, 2 * hidden_size]
+            dropout_rows: LongTensor with the rows (of a batch of `dropout_batch_size` sequences) that the inputs
+                          hold. The dropout masks are drawn for the whole batch and only these rows are kept
+                          (see `shrinking_teacher_forcing`). None draws the masks for the inputs only
+            dropout_batch_size: size of the whole batch (only used with `dropout_rows`)
 
         Returns:
             pre_output tensor of shape [batch_size, seq_len, hidden_size]
@@ -101,7 +145,7 @@ class GRUDecoder(nn.Module):
             if l != self.num_layers - 1:
                 # apply variational dropout to the input for the RNN
                 outputs = self.variational_dropout(
-                    outputs, dropout=self.dropout_p)
+                    outputs, dropout=self.dropout_p, rows=dropout_rows, batch_size=dropout_batch_size)
 
         hidden = torch.cat(hidden_states, dim=0)
 
@@ -115,16 +159,70 @@ class GRUDecoder(nn.Module):
 
         # pass the `outputs` through a linear layer to get a tensor of size [batch, seq_len, hidden_size]
         # [batch, hidden_size + hidden_size * 2 + embed_size] => [batch, hidden_size]
-        outputs = self.dropout_layer(outputs)
+        outputs = self.output_dropout(
+            outputs, dropout_rows, dropout_batch_size)
         outputs = self.pre_output_layer(outputs)
         return outputs, hidden
 
-    def forward(self, trg, encoder_hidden, src_mask, trg_mask, encoder_final, hidden=None):
+    def output_dropout(self, outputs, rows=None, batch_size=None):
+        """
+        Apply `dropout_layer` to the outputs of a timestep [len(rows), features]. With `rows`, the
+        mask is drawn for the whole batch of `batch_size` sequences (the same way as `nn.Dropout`
+        draws it) and only the `rows` are kept
+        """
+        p = self.dropout_layer.p
+        if rows is None or not self.training or p in (0, 1):
+            return self.dropout_layer(outputs)
+
+        noise = outputs.new_empty(
+            batch_size, outputs.size(1)).bernoulli_(1 - p)
+        noise.div_(1 - p)
+        return outputs * noise.index_select(0, rows)
+
+    def init_state(self, encoder_hidden, encoder_final):
+        """
+        Create a GRUDecoderState for incremental decoding.
+        The projected keys of the attention are computed once here instead of
+        at every call of `forward`
+
+        Arguments:
+            encoder_hidden: hidden states of the Encoder [batch_size, seq_len, 2 * hidden_size]
+            encoder_final: final hidden state of the Encoder [num_layers, batch_size, 2*hidden_size]
+
+        Returns:
+            A `GRUDecoderState` object
+        """
+        projected_keys = self.attention.key_layer(
+            encoder_hidden) if self.attention is not None else None
+        return GRUDecoderState(self.init_hidden(encoder_final), projected_keys, encoder_final)
+
+    def forward(self, trg, encoder_hidden, src_mask, trg_mask, encoder_final, hidden=None, trg_lengths=None):
+        """
+        Arguments:
+            trg: Target sequence tensor [batch_size, seq_len]
+            encoder_hidden: hidden states of the Encoder [batch_size, src_seq_len, 2 * hidden_size]
+            src_mask: Mask for src sequence [batch_size, 1, src_seq_len]
+            trg_mask: unused by the GRUDecoder
+            encoder_final: final hidden state of the Encoder [num_layers, batch_size, 2*hidden_size]
+            hidden: hidden state of the Decoder, GRUDecoderState used for incremental decoding or None
+            trg_lengths: length of each target sequence [batch_size]. If given (and `hidden` is not a
+                         GRUDecoderState), every timestep only runs on the sequences that are still active
+                         (see `shrinking_teacher_forcing`). Without attention, the whole sequence is decoded
+                         at once instead (see `sequence_teacher_forcing`)
+
+        Returns:
+            A Tensor of shape [batch_size, seq_len, hidden_size] and the hidden state (or the updated GRUDecoderState)
+        """
         # Apply Embedding Dropout to dropout full words
         # Embed ==> [batch, seq_len, V]
         embed = embedded_dropout(self.embed, trg,
                                  dropout=self.input_droput_p if self.training else 0)
 
+        # the decoding state holds the hidden state and the precomputed projected keys
+        state = hidden if isinstance(hidden, GRUDecoderState) else None
+        if state is not None:
+            hidden, encoder_final = state.hidden, state.encoder_final
+
         # initialize the decoder hidden state using the final encoder hidden state
         # [num_layers, batch_size, 2*hidden_size] => [num_layers, batch_size, hidden_size]
         if hidden is None:
@@ -132,32 +230,41 @@ class GRUDecoder(nn.Module):
 
         # project the keys (encoder hidden states)
         # projected_keys => [batch_size, seq_len, 2*hidden_size]
-        if self.attention is not None:
+        if state is not None:
+            projected_keys = state.projected_keys
+        elif self.attention is not None:
             projected_keys = self.attention.key_layer(encoder_hidden)
         else:
             projected_keys = None
 
-        # hold the ouputs from the Decoding process
-        # [batch_size, seq_len, hidden_size]
-        outputs = torch.zeros(trg.size(1), trg.size(
-            0), self.hidden_size, device=self.device)
+        if self.attention is None:
+            outputs, hidden = self.sequence_teacher_forcing(
+                embed, encoder_final, hidden)
+        elif trg_lengths is not None and state is None:
+            outputs, hidden = self.shrinking_teacher_forcing(
+                embed, trg_lengths, encoder_final, hidden, encoder_hidden, src_mask, projected_keys)
+        else:
+            # hold the ouputs from the Decoding process
+            # [batch_size, seq_len, hidden_size]
+            outputs = torch.zeros(trg.size(1), trg.size(
+                0), self.hidden_size, device=self.device)
 
-        # this decodes the SRC sequence one word (timestep) a time
-        # uses teacher forcing (use ground truth TRG sequence as input to the decoder)
-        for t in range(trg.size(1)):
+            # this decodes the SRC sequence one word (timestep) a time
+            # uses teacher forcing (use ground truth TRG sequence as input to the decoder)
+            for t in range(trg.size(1)):
 
-            # get the embedding for the current word at the `t`_th timestep
-            prev_embed = embed[:, t, :].unsqueeze(1)  # [batch, 1, V]
+                # get the embedding for the current word at the `t`_th timestep
+                prev_embed = embed[:, t, :].unsqueeze(1)  # [batch, 1, V]
 
-            # perform one foward step in the Decoder
-            # to get the ouput prediction (word) at the
-            # current timestep.
-            # also get the new hidden state for the Decoder
-            output, hidden = self.forward_step(
-                prev_embed, encoder_final, hidden, encoder_hidden, src_mask, projected_keys)
+                # perform one foward step in the Decoder
+                # to get the ouput prediction (word) at the
+                # current timestep.
+                # also get the new hidden state for the Decoder
+                output, hidden = self.forward_step(
+                    prev_embed, encoder_final, hidden, encoder_hidden, src_mask, projected_keys)
 
-            # save the output word to the `outputs` tensor
-            outputs[t] = output
+                # save the output word to the `outputs` tensor
+                outputs[t] = output
 
         # apply Variational Dropout on the output tensor
         # outputs => [batch_size, seq_len, hidden_size]
@@ -165,8 +272,122 @@ class GRUDecoder(nn.Module):
         outputs = outputs.transpose(0, 1)
         outputs = self.variational_dropout(x=outputs, dropout=self.dropout_p)
 
+        if state is not None:
+            state.hidden = hidden
+            return outputs, state
         return outputs, hidden
 
+    def sequence_teacher_forcing(self, embed, encoder_final, hidden):
+        """
+        Teacher forcing without attention: the context is the final hidden state of the Encoder at every
+        timestep, so the inputs of the GRU are known up front and every layer runs over the whole sequence
+        in a single call (instead of one call per timestep), then the pre-output layer is applied to all
+        the timesteps at once
+
+        Without dropout (eg. in eval mode), the outputs are the same as with the step-by-step loop.
+        In training, the WeightDrop mask of the recurrent weights and the VariationalDropout mask between
+        the layers are drawn once per forward and shared by all the timesteps of a sequence (the
+        step-by-step loop draws them again at every timestep)
+
+        Arguments:
+            embed: embeddings of the target sequences [batch_size, seq_len, embed_size]
+            encoder_final: final hidden state of the Encoder [num_layers, batch_size, 2*hidden_size]
+            hidden: initial hidden state of the Decoder [num_layers, batch_size, hidden_size]
+
+        Returns:
+            The outputs [seq_len, batch_size, hidden_size] and the hidden state after the last timestep
+            [num_layers, batch_size, hidden_size]
+        """
+        # [num_layers, batch_size, 2*hidden_size] ==> [batch_size, seq_len, 2*hidden_size]
+        context = encoder_final[-1].unsqueeze(1).expand(-1, embed.size(1), -1)
+
+        # run the whole sequence through every layer of the GRU
+        outputs = torch.cat((embed, context), dim=2)
+        hidden_states = []
+        for l, gru in enumerate(self.gru):
+            outputs, new_hidden = gru(outputs, hidden[l].unsqueeze(0))
+            hidden_states.append(new_hidden)
+
+            if l != self.num_layers - 1:
+                # apply variational dropout to the input for the RNN
+                outputs = self.variational_dropout(
+                    outputs, dropout=self.dropout_p)
+
+        hidden = torch.cat(hidden_states, dim=0)
+
+        # [batch_size, seq_len, embed_size + hidden_size + 2*hidden_size] => [batch_size, seq_len, hidden_size]
+        outputs = torch.cat((embed, outputs, context), dim=2)
+        outputs = self.dropout_layer(outputs)
+        outputs = self.pre_output_layer(outputs)
+
+        # [seq_len, batch_size, hidden_size] like the outputs of the step-by-step loop
+        return outputs.transpose(0, 1), hidden
+
+    def shrinking_teacher_forcing(self, embed, trg_lengths, encoder_final, hidden, encoder_hidden, src_mask, projected_keys):
+        """
+        Teacher forcing where every timestep only runs on the target sequences that have not ended yet
+        (the Decoder equivalent of `pack_padded_sequence` in the GRUEncoder)
+
+        The batch is sorted by decreasing target length, so that the active sequences at every timestep
+        are a prefix of the batch, and the outputs/hidden states are put back in the original order.
+        The outputs of the real target tokens are the same as with the full-batch loop (the outputs after
+        the end of a sequence are zeros, and they are only used to predict padding). The dropout masks
+        of every timestep are drawn for the whole batch (in its original order) and sliced to the
+        active sequences, so they are the same masks that the full-batch loop draws
+
+        Arguments:
+            embed: embeddings of the target sequences [batch_size, seq_len, embed_size]
+            trg_lengths: length of each target sequence [batch_size]
+            encoder_final: final hidden state of the Encoder [num_layers, batch_size, 2*hidden_size]
+            hidden: initial hidden state of the Decoder [num_layers, batch_size, hidden_size]
+            encoder_hidden: hidden states of the Encoder [batch_size, src_seq_len, 2 * hidden_size]
+            src_mask: Mask for src sequence [batch_size, 1, src_seq_len]
+            projected_keys: The projected Encoder hidden states (None without attention)
+
+        Returns:
+            The outputs [seq_len, batch_size, hidden_size] and the hidden state of every sequence
+            after its last token [num_layers, batch_size, hidden_size]
+        """
+        def select(tensor, dim=0):
+            return tensor.index_select(dim, order) if tensor is not None else None
+
+        # sort the batch by decreasing target length
+        sorted_lengths, order = trg_lengths.to(embed.device).sort(descending=True)
+        _, restore_order = order.sort()
+        embed, encoder_hidden, src_mask, projected_keys = [select(tensor) for tensor in
+                                                           [embed, encoder_hidden, src_mask, projected_keys]]
+        encoder_final, hidden = select(encoder_final, 1), select(hidden, 1)
+
+        # number of active sequences at every timestep
+        seq_len = embed.size(1)
+        batch_sizes = (sorted_lengths.unsqueeze(0) > torch.arange(
+            seq_len, device=embed.device).unsqueeze(1)).sum(1).tolist()
+
+        outputs = torch.zeros(seq_len, embed.size(
+            0), self.hidden_size, device=self.device)
+
+        # hidden states of the sequences that have ended (the last sequences of the batch end first)
+        finished = []
+        for t, batch_size in enumerate(batch_sizes):
+            if batch_size == 0:
+                break
+            if batch_size < hidden.size(1):
+                finished.append(hidden[:, batch_size:])
+                hidden = hidden[:, :batch_size]
+
+            output, hidden = self.forward_step(
+                embed[:batch_size, t, :].unsqueeze(1),
+                encoder_final[:, :batch_size] if encoder_final is not None else None,
+                hidden,
+                encoder_hidden[:batch_size] if encoder_hidden is not None else None,
+                src_mask[:batch_size] if src_mask is not None else None,
+                projected_keys[:batch_size] if projected_keys is not None else None,
+                dropout_rows=order[:batch_size], dropout_batch_size=order.size(0))
+            outputs[t, :batch_size] = output
+
+        hidden = torch.cat([hidden] + finished[::-1], dim=1)
+        return outputs.index_select(1, restore_order), hidden.index_select(1, restore_order)
+
     def init_hidden(self, encoder_final):
         """
         Returns the initial decoder state,
@@ -200,16 +421,19 @@ class TransformerDecoder(nn.Module):
         layer_dropout: Dropout for each layer
         attention_dropout: Dropout probability after attention
         relu_dropout: Dropout probability after ReLU operation in FFN
+        checkpoint_every: recompute the activations of every `checkpoint_every`-th layer during the
+                          backward pass instead of keeping them in memory (0 disables checkpointing)
 
     Returns:
         A Tensor of shape [batch_size, seq_len, d_model]
     """
 
     def __init__(self, embedding_size, tgt_vocab_size, d_model, num_layers, num_heads, max_length, d_ff=2048, input_dropout=0.0,
-                 layer_dropout=0.1, attention_dropout=0.1, relu_dropout=0.1):
+                 layer_dropout=0.1, attention_dropout=0.1, relu_dropout=0.1, checkpoint_every=0):
         super().__init__()
 
         self.num_layers = num_layers
+        self.checkpoint_every = checkpoint_every
 
         # Embeddings and Positional Encodings
         self.embeddings = Embedder(embedding_size, tgt_vocab_size)
@@ -223,16 +447,116 @@ class TransformerDecoder(nn.Module):
         # Layer Norm on the output of the Decoder
         self.output_layer_norm = LayerNorm(d_model)
 
-    def forward(self, trg, encoder_outputs, src_mask, trg_mask, encoder_final=None, hidden=None):
+    def init_state(self, encoder_outputs=None, encoder_final=None):
+        """
+        Create a DecoderState for incremental decoding.
+        Passing the state as the `hidden` argument of `forward` caches the
+        self-attention keys/values of every layer, so each decoding step
+        only needs to feed the newest target token
 
-        # sum the Embeddings and Positional Encodings
-        x = self.positional_encodings(self.embeddings(trg))
+        Arguments:
+            encoder_outputs: Output Tensor from the Encoder [batch_size, src_seq_len, d_model].
+                             If given, the keys/values of the encoder-decoder attention are
+                             precomputed once for all decoding steps
+            encoder_final: unused by the Transformer
+
+        Returns:
+            A `DecoderState` object
+        """
+        state = DecoderState(self.num_layers)
+        if encoder_outputs is not None:
+            for layer, layer_cache in zip(self.decoder_stack, state.layer_caches):
+                layer_cache["memory_keys"], layer_cache["memory_values"] = \
+                    layer.multi_head_attention_enc_dec.project_keys_values(
+                        encoder_outputs, encoder_outputs)
+        return state
+
+    def init_slot_state(self, num_slots, max_trg_len, max_src_len):
+        """
+        Create a SlotDecoderState for continuous batching, where new sentences are
+        admitted into the free slots of the state (see `fill_slots`) between decoding steps
+
+        Arguments:
+            num_slots: number of sentences decoded at once
+            max_trg_len: maximum number of target tokens fed to the Decoder (including <s>)
+            max_src_len: expected maximum length of the src sequences
+
+        Returns:
+            A `SlotDecoderState` object
+        """
+        attention = self.decoder_stack[0].multi_head_attention_dec
+        weight = attention.key_linear.weight
+        d_model = weight.size(0)
+        return SlotDecoderState(self.num_layers, num_slots, attention.num_heads, d_model // attention.num_heads,
+                                max_trg_len, max_src_len, weight.device, weight.dtype)
+
+    def fill_slots(self, state, slots, encoder_outputs, src_mask):
+        """
+        Admit new sentences into the free `slots` of a SlotDecoderState
+        (the keys/values of the encoder-decoder attention are precomputed once for every sentence)
+
+        Arguments:
+            state: SlotDecoderState
+            slots: LongTensor with the slots of the new sentences
+            encoder_outputs: Output Tensor from the Encoder for the new sentences [len(slots), src_seq_len, d_model]
+            src_mask: Mask of the src sequences of the new sentences [len(slots), 1, src_seq_len]
+        """
+        memory = [layer.multi_head_attention_enc_dec.project_keys_values(encoder_outputs, encoder_outputs)
+                  for layer in self.decoder_stack]
+        state.fill(slots, memory, src_mask)
+
+    def forward(self, trg, encoder_outputs, src_mask, trg_mask, encoder_final=None, hidden=None, positions=None):
+        """
+        Arguments:
+            trg: Target sequence tensor [batch_size, seq_len]
+                 (only the newest target tokens if `hidden` is a DecoderState,
+                 the newest token of every slot [num_slots, 1] if `hidden` is a SlotDecoderState)
+            encoder_outputs: Output Tensor from the Encoder [batch_size, src_seq_len, d_model]
+            src_mask: Mask for src sequence [batch_size, 1 or seq_len, src_seq_len]
+            trg_mask: Mask for the `trg` sequence [batch_size, seq_len, seq_len]
+            encoder_final: unused by the Transformer
+            hidden: DecoderState used for incremental decoding, SlotDecoderState used for
+                    continuous batching (the `trg_mask` is then built from the positions of the slots) or None
+            positions: position of each target token [batch_size, seq_len] when `hidden` is None
+                       (packed sequences restart at 0 in every segment), defaults to 0, 1, 2, ...
+
+        Returns:
+            A Tensor of shape [batch_size, seq_len, d_model] and the updated DecoderState (or None)
+        """
+        if isinstance(hidden, SlotDecoderState):
+            state = hidden
+
+            # every slot feeds the token at its own position
+            x = self.positional_encodings(
+                self.embeddings(trg), positions=state.positions.unsqueeze(1))
+            trg_mask = state.self_attention_mask()
+        else:
+            state = hidden if isinstance(hidden, DecoderState) else None
+            start = state.step if state is not None else 0
+
+            # sum the Embeddings and Positional Encodings
+            x = self.positional_encodings(
+                self.embeddings(trg), start=start, positions=positions)
+
+            if state is not None:
+                # let the new tokens attend to the cached tokens as well
+                trg_mask = state.update_mask(trg_mask)
 
         # pass the input through the Decoder Stack
         for i in range(self.num_layers):
-            x = self.decoder_stack[i](x, encoder_outputs, src_mask, trg_mask)
+            layer_cache = state.layer_caches[i] if state is not None else None
+            if layer_cache is None and use_checkpoint(self, i, x):
+                # the dropout masks are the same when the layer is recomputed (the RNG state is restored)
+                x = checkpoint(self.decoder_stack[i], x,
+                               encoder_outputs, src_mask, trg_mask)
+            else:
+                x = self.decoder_stack[i](
+                    x, encoder_outputs, src_mask, trg_mask, layer_cache=layer_cache)
 
         # layer norm on the output
         x = self.output_layer_norm(x)
 
-        return x, None
+        if isinstance(state, DecoderState):
+            state.step += trg.size(1)
+
+        return x, state
@@ -15,7 +15,16 @@ class VariationalDropout(nn.Module):
     def __init__(self):
         super(VariationalDropout, self).__init__()
 
-    def forward(self, x, dropout=.5):
+    def forward(self, x, dropout=.5, rows=None, batch_size=None):
+        """
+        Arguments:
+            x: input of shape [bsz, seq_len, input_dim]
+            dropout: dropout probability
+            rows: LongTensor with the rows (of a batch of `batch_size` examples) that `x` holds. If given,
+                  the mask is sampled for the whole batch and only these rows are kept, so `x` gets
+                  the same mask as if the whole batch went through the layer (None uses all the rows of `x`)
+            batch_size: size of the whole batch (only used with `rows`)
+        """
 
         # if you aren't in training mode, then we don't want to use dropout
         assert 0 <= dropout <= 1, "Dropout must be in between 0 and 1"
@@ -32,9 +41,11 @@ class VariationalDropout(nn.Module):
         keep_prob = 1 - dropout
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         mask = torch.FloatTensor(
-            bsz, 1, input_dim).to(device).bernoulli_(keep_prob)
+            bsz if rows is None else batch_size, 1, input_dim).to(device).bernoulli_(keep_prob)
 
         mask = mask / keep_prob  # use inverted dropout
+        if rows is not None:
+            mask = mask.index_select(0, rows)
 
         # expand the mask such that the binary mask
         # is the same through all **timesteps** in the sequence
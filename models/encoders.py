@@ -4,11 +4,12 @@ from torch import nn
 import numpy as np
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from .transformer.embeddings import Embedder, PositionalEncoder
 from .transformer.layers import EncoderLayer, DecoderLayer
 from .transformer.sublayers import LayerNorm
-from utils.utils import get_clones
+from utils.utils import get_clones, use_checkpoint
 from .dropout.embed_dropout import embedded_dropout
 from .dropout.weight_drop import WeightDrop
 from .dropout.variational_dropout import VariationalDropout
@@ -103,16 +104,19 @@ class TransformerEncoder(nn.Module):
         layer_dropout: Dropout for each layer
         attention_dropout: Dropout probability after attention
         relu_dropout: Dropout probability after ReLU operation in FFN
+        checkpoint_every: recompute the activations of every `checkpoint_every`-th layer during the
+                          backward pass instead of keeping them in memory (0 disables checkpointing)
 
     Returns:
         A Tensor of shape [batch_size, seq_len, d_model]
     """
 
     def __init__(self, embedding_size, src_vocab_size, d_model, num_layers, num_heads, max_length, d_ff=2048, input_dropout=0.0,
-                 layer_dropout=0.0, attention_dropout=0.0, relu_dropout=0.0):
+                 layer_dropout=0.0, attention_dropout=0.0, relu_dropout=0.0, checkpoint_every=0):
         super().__init__()
 
         self.num_layers = num_layers
+        self.checkpoint_every = checkpoint_every
 
         # Embeddings and Postional Encodings
         self.embeddings = Embedder(
@@ -127,14 +131,26 @@ class TransformerEncoder(nn.Module):
         # Layer Norm on the output of the Encoder
         self.output_layer_norm = LayerNorm(d_model)
 
-    def forward(self, src, src_mask, src_lengths=None):
+    def forward(self, src, src_mask, src_lengths=None, positions=None):
+        """
+        Arguments:
+            src: Source sequence tensor [batch_size, seq_len]
+            src_mask: Mask for src sequence [batch_size, 1 or seq_len, seq_len]
+            src_lengths: unused by the Transformer
+            positions: position of each src token [batch_size, seq_len] (packed sequences restart at 0
+                       in every segment), defaults to 0, 1, 2, ...
+        """
 
         # sum the Token Embeddings and Positional Encodings
-        x = self.positional_encodings(self.embeddings(src))
+        x = self.positional_encodings(self.embeddings(src), positions=positions)
 
         # pass the embeddings through the Encoder stack
         for i in range(self.num_layers):
-            x = self.encoder_stack[i](x, src_mask)
+            if use_checkpoint(self, i, x):
+                # the dropout masks are the same when the layer is recomputed (the RNG state is restored)
+                x = checkpoint(self.encoder_stack[i], x, src_mask)
+            else:
+                x = self.encoder_stack[i](x, src_mask)
 
         # layer norm on the output
         x = self.output_layer_norm(x)
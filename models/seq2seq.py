@@ -19,11 +19,21 @@ class EncoderDecoder(nn.Module):
         self.decoder = decoder
         self.generator = generator
 
-    def forward(self, src, tgt, src_mask, tgt_mask, src_lengths=None, trg_lengths=None):
+    def forward(self, src, tgt, src_mask, tgt_mask, src_lengths=None, trg_lengths=None, return_hidden=False,
+                memory_mask=None, src_positions=None, trg_positions=None):
+        """
+        Arguments:
+            return_hidden: return the outputs of the Decoder [batch_size, seq_len, hidden_size]
+                           instead of the log probabilities, so that the generator and the loss
+                           can be computed in chunks (see `Trainer.chunked_loss`)
+            memory_mask, src_positions, trg_positions: mask of the encoder-decoder attention
+                           [batch_size, trg_seq_len, src_seq_len] (defaults to `src_mask`) and positions
+                           of the src/trg tokens, for packed batches (see `utils.packing`, Transformer only)
+        """
 
         # pass the src sequence through the Encoder
         encoder_outputs, encoder_final = self.encode(
-            src, src_mask, src_lengths)
+            src, src_mask, src_lengths, positions=src_positions)
 
         if isinstance(self.decoder, GRUDecoder):
             # last hidden state of the Encoder is used as the initial hidden state of the Decoder
@@ -33,13 +43,20 @@ class EncoderDecoder(nn.Module):
             encoder_final = None
 
         # pass the tgt sequence through the Decoder
+        # the GRUDecoder only runs each timestep on the target sequences that have not ended yet
         decoder_output, _ = self.decode(trg=tgt, encoder_outputs=encoder_outputs,
-                                        src_mask=src_mask, trg_mask=tgt_mask,
-                                        encoder_final=encoder_final, decoder_hidden=None)
+                                        src_mask=src_mask if memory_mask is None else memory_mask,
+                                        trg_mask=tgt_mask, encoder_final=encoder_final,
+                                        decoder_hidden=None, positions=trg_positions,
+                                        trg_lengths=trg_lengths if isinstance(self.decoder, GRUDecoder) else None)
+        if return_hidden:
+            return decoder_output
         logits = self.generator(decoder_output)
-        return F.log_softmax(logits, dim=-1)
 
-    def encode(self, src, src_mask, src_lengths):
+        # the log softmax is computed in float32 (the logits are in bfloat16 under mixed precision)
+        return F.log_softmax(logits.float(), dim=-1)
+
+    def encode(self, src, src_mask, src_lengths, positions=None):
         """ 
         Encode the src sequence using the Encoder 
 
@@ -47,13 +64,17 @@ class EncoderDecoder(nn.Module):
             src: Source sequence tensor [batch_size, seq_len] 
             src_mask: Mask for src sequence [batch_size, 1, seq_len]
             src_lengths: lenght of each example in batch
+            positions: positions of the src tokens [batch_size, seq_len] (only for TransformerEncoder)
 
         Returns:
             A Tensor of shape [batch_size, seq_len, hidden_size]
         """
+        if positions is not None:
+            return self.encoder(src, src_mask, src_lengths, positions=positions)
         return self.encoder(src, src_mask, src_lengths)
 
-    def decode(self, trg, encoder_outputs, src_mask, trg_mask, encoder_final=None, decoder_hidden=None):
+    def decode(self, trg, encoder_outputs, src_mask, trg_mask, encoder_final=None, decoder_hidden=None, positions=None,
+               trg_lengths=None):
         """ 
         Decode the target sequence given the outputs from the Encoder         
 
@@ -63,12 +84,19 @@ class EncoderDecoder(nn.Module):
             encoder_final: Final hidden state from the Encoder (only for GRUEncoder)
             src_mask: Mask for src sequence [batch_size, 1, seq_len]
             tgt_mask: Mask for the tgt sequence [batch_size, seq_len, seq_len] (only for TransformerDecoder)
-            decoder_hidden: decoder hidden state
+            decoder_hidden: decoder hidden state (or the decoding state created by `decoder.init_state`)
+            positions: positions of the target tokens [batch_size, seq_len] (only for TransformerDecoder)
+            trg_lengths: length of each target sequence [batch_size] (only for GRUDecoder)
 
         Returns:
             A Tensor of shape [batch_size, seq_len, hidden_size]
         """
-        return self.decoder(trg, encoder_outputs, src_mask, trg_mask, encoder_final, hidden=decoder_hidden)
+        kwargs = {}
+        if positions is not None:
+            kwargs["positions"] = positions
+        if trg_lengths is not None:
+            kwargs["trg_lengths"] = trg_lengths
+        return self.decoder(trg, encoder_outputs, src_mask, trg_mask, encoder_final, hidden=decoder_hidden, **kwargs)
 
 
 def make_seq2seq_model(params):
@@ -88,13 +116,15 @@ def make_seq2seq_model(params):
         encoder = TransformerEncoder(params.embed_size, params.src_vocab_size, params.hidden_size, params.n_layers_enc,
                                      params.num_heads, params.max_length, d_ff=params.d_ff, input_dropout=params.input_dropout,
                                      layer_dropout=params.layer_dropout, attention_dropout=params.attention_dropout,
-                                     relu_dropout=params.relu_dropout)
+                                     relu_dropout=params.relu_dropout,
+                                     checkpoint_every=getattr(params, "checkpoint_every", 0))
 
         # create the Transformer Decoder
         decoder = TransformerDecoder(params.embed_size, params.tgt_vocab_size, params.hidden_size, params.n_layers_dec,
                                      params.num_heads, params.max_length, d_ff=params.d_ff, input_dropout=params.input_dropout,
                                      layer_dropout=params.layer_dropout, attention_dropout=params.attention_dropout,
-                                     relu_dropout=params.relu_dropout)
+                                     relu_dropout=params.relu_dropout,
+                                     checkpoint_every=getattr(params, "checkpoint_every", 0))
 
     # standard linear + softmax generation step
     generator = nn.Linear(params.hidden_size,
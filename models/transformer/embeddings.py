@@ -59,10 +59,15 @@ class PositionalEncoder(nn.Module):
         pe = pe.unsqueeze(0)
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
+    def forward(self, x, start=0, positions=None):
 
         # obtain the positional encodings (these encodings are fixed and not learnt during training)
-        pe = Variable(self.pe[:, :x.size(1)], requires_grad=False)
+        # `start` is the position of the first token in `x` (non-zero during incremental decoding)
+        # `positions` gives the position of each token in `x` instead [batch_size, seq_len]
+        if positions is not None:
+            pe = Variable(self.pe[0, positions], requires_grad=False)
+        else:
+            pe = Variable(self.pe[:, start:start + x.size(1)], requires_grad=False)
 
         # add the word embeddings with positional encodings
         assert x.size(-1) == pe.size(-1), "Word Embedding size and Positional Encoding size must be the same"
@@ -86,7 +86,7 @@ class DecoderLayer(nn.Module):
         self.layer_norm_mha_enc_dec = LayerNorm(d_model)
         self.layer_norm_ffn = LayerNorm(d_model)
 
-    def forward(self, x, encoder_outputs, src_mask, trg_mask):
+    def forward(self, x, encoder_outputs, src_mask, trg_mask, layer_cache=None):
 
         # layer normalization before decoder self attention
         x_norm = self.layer_norm_mha_dec(x)
@@ -94,8 +94,10 @@ class DecoderLayer(nn.Module):
         # Masked Multi-head attention
         # query, key, value => [batch_size, tgt_seq_len, d_model]
         # [batch_size, tgt_seq_len, d_model]
+        # (if a `layer_cache` is given, x only holds the newest target tokens and the
+        # keys/values of the previous tokens are read from the cache)
         y = self.multi_head_attention_dec(
-            query=x_norm, key=x_norm, value=x_norm, mask=trg_mask)
+            query=x_norm, key=x_norm, value=x_norm, mask=trg_mask, layer_cache=layer_cache)
 
         # Dropout and residual after masked multi-head self-attention
         x = x + self.dropout_mmha(y)
@@ -107,8 +109,10 @@ class DecoderLayer(nn.Module):
         # query => [batch_size, tgt_seq_len]
         # key, value => [batch_size, src_seq_len, d_model]
         # [batch_size, tgt_seq_len, d_model]
+        # (if a `layer_cache` is given, the projected keys/values of the encoder outputs are reused)
         y = self.multi_head_attention_enc_dec(
-            query=x_norm, key=encoder_outputs, value=encoder_outputs, mask=src_mask)
+            query=x_norm, key=encoder_outputs, value=encoder_outputs, mask=src_mask,
+            layer_cache=layer_cache, attn_type="context")
 
         # Dropout and residual after encoder-decoder attention
         x = x + self.dropout_mha(y)
@@ -0,0 +1,192 @@
+""" Decoding state used for incremental (step by step) decoding with the Transformer Decoder """
+import torch
+
+
+class DecoderState(object):
+    """
+    Holds the self-attention keys/values of every DecoderLayer for the
+    target tokens that have been decoded so far. When a DecoderState is passed
+    to the TransformerDecoder, only the newest target token(s) need to be
+    fed to the Decoder at each step, since the keys/values of the previous
+    tokens are read from the cache instead of being recomputed.
+
+    The state also holds the `memory`: the encoder outputs projected by the
+    key/value layers of the encoder-decoder attention of every DecoderLayer.
+    These are computed once per sentence and reused at every step.
+
+    Arguments:
+        num_layers: number of layers in the Decoder stack
+    """
+
+    def __init__(self, num_layers):
+        # number of target tokens that have been fed to the Decoder so far
+        # (this is also the position of the next target token)
+        self.step = 0
+
+        # [batch_size, 1, step] mask over the cached target tokens (hides padding)
+        self.key_mask = None
+
+        # self_keys, self_values => [batch_size, num_heads, step, d_model/num_heads]
+        # memory_keys, memory_values => [batch_size, num_heads, src_seq_len, d_model/num_heads]
+        self.layer_caches = [{"self_keys": None, "self_values": None,
+                              "memory_keys": None, "memory_values": None}
+                             for _ in range(num_layers)]
+
+    def update_mask(self, trg_mask):
+        """
+        Extend the mask of the newly fed target tokens to the cached target tokens
+
+        Arguments:
+            trg_mask: mask of the new target tokens [batch_size, new_len, new_len] (see `make_tgt_mask`)
+
+        Returns:
+            A mask of shape [batch_size, new_len, step + new_len]
+        """
+        # the last row of the target mask only hides the padding of the new tokens
+        new_key_mask = trg_mask[:, -1:, :]
+
+        if self.key_mask is not None:
+            # the new tokens are allowed to attend to every (non padded) cached token
+            past_mask = self.key_mask.expand(-1, trg_mask.size(1), -1)
+            trg_mask = torch.cat([past_mask, trg_mask], dim=-1)
+            self.key_mask = torch.cat([self.key_mask, new_key_mask], dim=-1)
+        else:
+            self.key_mask = new_key_mask
+        return trg_mask
+
+    def reorder(self, index, memory_index=None):
+        """
+        Select/reorder the cached hypotheses along the batch dimension.
+        This is used to follow the backpointers of the beams during beam search
+        and to drop the sentences that have finished decoding
+
+        Arguments:
+            index: LongTensor with the positions (in the batch) of the hypotheses to keep
+            memory_index: LongTensor with the positions of the memory to keep. The memory is the same
+                          for all beams of a sentence, so it only needs to be selected when the beams are
+                          expanded or when sentences are dropped (None leaves the memory untouched)
+        """
+        if self.key_mask is not None:
+            self.key_mask = self.key_mask.index_select(0, index)
+        names = ["self_keys", "self_values"]
+        if memory_index is not None:
+            names += ["memory_keys", "memory_values"]
+        for layer_cache in self.layer_caches:
+            for name in names:
+                if layer_cache[name] is not None:
+                    selection = memory_index if name.startswith(
+                        "memory") else index
+                    layer_cache[name] = layer_cache[name].index_select(
+                        0, selection)
+
+
+class SlotDecoderState(object):
+    """
+    Decoding state used for continuous batching. The decoder works on a fixed number of
+    slots and every slot holds one sentence: new sentences are admitted into free slots
+    between two decoding steps and finished sentences free their slot right away.
+
+    Since the sentences of the slots are at different steps, every slot has its own
+    position and the self-attention keys/values (and the projected encoder outputs) live in
+    buffers that are allocated once for all the sentences, instead of being concatenated
+    (or selected) at every step like in the DecoderState
+
+    Arguments:
+        num_layers: number of layers in the Decoder stack
+        num_slots: number of sentences decoded at once
+        num_heads: number of attention heads
+        head_size: size of each attention head (d_model/num_heads)
+        max_trg_len: maximum number of target tokens fed to the Decoder (including <s>)
+        max_src_len: maximum length of the src sequences (the memory buffers grow if a longer one is admitted)
+        device: device of the buffers
+        dtype: dtype of the keys/values buffers
+    """
+
+    def __init__(self, num_layers, num_slots, num_heads, head_size, max_trg_len, max_src_len, device, dtype=torch.float):
+        self.num_slots = num_slots
+
+        # position of the target token fed to the Decoder by each slot [num_slots]
+        self.positions = torch.zeros(num_slots, dtype=torch.long, device=device)
+
+        # mask/length of the src sequence held by each slot
+        self.src_mask = torch.zeros(
+            num_slots, 1, max_src_len, dtype=torch.bool, device=device)
+        self.src_lengths = torch.zeros(
+            num_slots, dtype=torch.long, device=device)
+
+        # self_keys, self_values => [num_slots, num_heads, max_trg_len, d_model/num_heads]
+        # memory_keys, memory_values => [num_slots, num_heads, max_src_len, d_model/num_heads]
+        # (the attention layers write the keys/values of the new token of each slot at `slot_positions`)
+        self.layer_caches = [{"self_keys": torch.zeros(num_slots, num_heads, max_trg_len, head_size, dtype=dtype, device=device),
+                              "self_values": torch.zeros(num_slots, num_heads, max_trg_len, head_size, dtype=dtype, device=device),
+                              "memory_keys": torch.zeros(num_slots, num_heads, max_src_len, head_size, dtype=dtype, device=device),
+                              "memory_values": torch.zeros(num_slots, num_heads, max_src_len, head_size, dtype=dtype, device=device),
+                              "slot_positions": self.positions}
+                             for _ in range(num_layers)]
+
+    def self_attention_mask(self):
+        """
+        Mask of the self attention of the new tokens: the token of each slot can attend to the
+        tokens of its sentence up to (and including) its own position
+
+        Returns:
+            A mask of shape [num_slots, 1, max(positions) + 1]
+        """
+        length = int(self.positions.max()) + 1
+        steps = torch.arange(length, dtype=torch.long,
+                             device=self.positions.device)
+        return (steps.unsqueeze(0) <= self.positions.unsqueeze(1)).unsqueeze(1)
+
+    def memory_mask(self):
+        """
+        Mask of the encoder-decoder attention (hides the padding of the src sequences)
+
+        Returns:
+            A mask of shape [num_slots, 1, max(src_lengths)]
+        """
+        return self.src_mask[:, :, :max(1, int(self.src_lengths.max()))]
+
+    def fill(self, slots, memory, src_mask):
+        """
+        Admit new sentences into the (free) `slots`
+
+        Arguments:
+            slots: LongTensor with the slots of the new sentences
+            memory: list with the projected (keys, values) of the encoder outputs for every layer,
+                    each one of shape [len(slots), num_heads, src_seq_len, d_model/num_heads]
+            src_mask: mask of the src sequences of the new sentences [len(slots), 1, src_seq_len]
+        """
+        src_len = src_mask.size(-1)
+        if src_len > self.src_mask.size(-1):
+            self.grow_memory(src_len)
+
+        self.positions[slots] = 0
+        self.src_mask[slots] = False
+        self.src_mask[slots, :, :src_len] = src_mask.bool()
+        self.src_lengths[slots] = src_len
+        for layer_cache, (keys, values) in zip(self.layer_caches, memory):
+            layer_cache["memory_keys"][slots, :, :src_len] = keys.type_as(
+                layer_cache["memory_keys"])
+            layer_cache["memory_values"][slots, :, :src_len] = values.type_as(
+                layer_cache["memory_values"])
+
+    def release(self, slots):
+        """
+        Free the `slots` of the sentences that have finished decoding
+
+        Arguments:
+            slots: LongTensor with the slots to free
+        """
+        self.positions[slots] = 0
+        self.src_lengths[slots] = 0
+
+    def grow_memory(self, max_src_len):
+        """ Re-allocate the memory buffers to hold src sequences of `max_src_len` tokens """
+        padding = max_src_len - self.src_mask.size(-1)
+        self.src_mask = torch.cat(
+            [self.src_mask, self.src_mask.new_zeros(self.num_slots, 1, padding)], dim=-1)
+        for layer_cache in self.layer_caches:
+            for name in ["memory_keys", "memory_values"]:
+                buffer = layer_cache[name]
+                layer_cache[name] = torch.cat(
+                    [buffer, buffer.new_zeros(buffer.size(0), buffer.size(1), padding, buffer.size(3))], dim=2)
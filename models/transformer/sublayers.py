@@ -38,24 +38,60 @@ class MultiHeadAttention(nn.Module):
         self.value_linear = nn.Linear(d_model, d_model)
         self.output_linear = nn.Linear(d_model, d_model)
 
-    def forward(self, query, key, value, mask=None):
+    def forward(self, query, key, value, mask=None, layer_cache=None, attn_type="self"):
+        """
+        Arguments:
+            query, key, value: Tensors of shape [batch_size, seq_len, d_model]
+            mask: attention mask of shape [batch_size, 1 or query_len, key_len]
+            layer_cache: dictionary holding the keys/values of the previously decoded
+                         tokens (self attention during incremental decoding, see `DecoderState`
+                         and `SlotDecoderState`) and the projected encoder outputs (encoder-decoder attention)
+            attn_type: "self" for self attention, "context" for encoder-decoder attention
+        """
         if mask is not None:
             # the same mask is applied to `num_heads` heads
             # so we add an extra dimension to the mask
             # [batch_size, 1, seq_len] ==> [batch_size, 1, 1, seq_len]
             mask = mask.unsqueeze(1)
 
-        # Pass key, queries, values through linear layer
-        # [batch_size, seq_len, d_model]
-        queries = self.query_linear(query)
-        keys = self.key_linear(key)
-        values = self.value_linear(value)
-
-        # split the heads
+        # Pass the queries through linear layer and split the heads
         # [batch_size, num_heads, seq_len, d_model/num_heads]
-        queries = self._split_heads(queries)
-        keys = self._split_heads(keys)
-        values = self._split_heads(values)
+        queries = self._split_heads(self.query_linear(query))
+
+        if attn_type == "context" and layer_cache is not None:
+            # the encoder outputs don't change while decoding, so their
+            # keys/values are only projected once per sentence
+            if layer_cache["memory_keys"] is None:
+                layer_cache["memory_keys"], layer_cache["memory_values"] = self.project_keys_values(
+                    key, value)
+            keys = layer_cache["memory_keys"]
+            values = layer_cache["memory_values"]
+            if "slot_positions" in layer_cache:
+                # the memory buffers of the slots are allocated for the longest src sequence
+                keys = keys[:, :, :mask.size(-1)]
+                values = values[:, :, :mask.size(-1)]
+        else:
+            keys, values = self.project_keys_values(key, value)
+
+        if attn_type == "self" and layer_cache is not None and "slot_positions" in layer_cache:
+            # continuous batching (see `SlotDecoderState`): write the keys/values of the new
+            # token of every slot at the position of the slot in the pre-allocated buffers
+            slots = torch.arange(keys.size(0), dtype=torch.long, device=keys.device)
+            positions = layer_cache["slot_positions"]
+            layer_cache["self_keys"][slots, :, positions] = keys[:, :, -1].type_as(
+                layer_cache["self_keys"])
+            layer_cache["self_values"][slots, :, positions] = values[:, :, -1].type_as(
+                layer_cache["self_values"])
+            keys = layer_cache["self_keys"][:, :, :mask.size(-1)]
+            values = layer_cache["self_values"][:, :, :mask.size(-1)]
+        elif attn_type == "self" and layer_cache is not None:
+            # prepend the keys/values of the previously decoded tokens
+            # [batch_size, num_heads, step + seq_len, d_model/num_heads]
+            if layer_cache["self_keys"] is not None:
+                keys = torch.cat([layer_cache["self_keys"], keys], dim=2)
+                values = torch.cat([layer_cache["self_values"], values], dim=2)
+            layer_cache["self_keys"] = keys
+            layer_cache["self_values"] = values
 
         # apply attention to each head in parallel
         # [batch_size, num_heads, seq_len, d_model/num_heads]
@@ -71,6 +107,20 @@ class MultiHeadAttention(nn.Module):
 
         return outputs
 
+    def project_keys_values(self, key, value):
+        """
+        Pass the keys and values through their linear layers and split the heads
+
+        Arguments:
+            key, value: input Tensors with shape [batch_size, seq_len, d_model]
+
+        Returns:
+            The keys and values as Tensors of shape [batch_size, num_heads, seq_len, d_model/num_heads]
+        """
+        keys = self._split_heads(self.key_linear(key))
+        values = self._split_heads(self.value_linear(value))
+        return keys, values
+
     def _merge_heads(self, x):
         """
         Merge the heads input `x` into the last dimension
@@ -117,10 +167,14 @@ class LayerNorm(nn.Module):
         self.eps = eps
 
     def forward(self, x):
+        # the statistics are computed in float32, since bfloat16 is not
+        # precise enough for the mean/std (eg. under mixed precision)
+        dtype = x.dtype
+        x = x.float()
         mean = x.mean(-1, keepdim=True)
         std = x.std(-1, keepdim=True)
         normalize = (x-mean) / (std + self.eps)
-        return self.gamma * normalize + self.beta
+        return (self.gamma * normalize + self.beta).to(dtype)
 
 
 class PositionwiseFeedForwardNet(nn.Module):
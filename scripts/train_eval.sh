@@ -40,7 +40,7 @@ else
                             -maxlen $max_len -lr $lr -gc $grad_clip -tf $tf -inpdrop $input_dropout -laydrop $layer_dropout  \
                             -attndrop $attention_dropout -reldrop $relu_dropout -labsmooth $label_smoothing -dff $d_ff \
                             -decweightshare $tgt_emb_prj_weight_sharing -encdecweightshare $emb_src_tgt_weight_sharing \
-                            -warmup $n_warmup_steps -exp_name $exp_name -model_type $model_type
+                            -warmup $n_warmup_steps -updatefreq ${update_freq:-1} -exp_name $exp_name -model_type $model_type
 fi
 echo "Done making experiment folder..."
 
@@ -0,0 +1,95 @@
+""" The vectorized batch planner against the token-budget batching of `batch_size_fn` it replaced """
+import random
+
+import pytest
+from utils.batching import plan_batches
+
+
+def batch_size_fn(src_len, trg_len, count, state):
+    """ The former `batch_size_fn` of the DataIterator (its running maxima are kept in `state`) """
+    if count == 1:
+        state["src"], state["trg"] = 0, 0
+    state["src"] = max(state["src"], src_len + 2)
+    state["trg"] = max(state["trg"], trg_len + 2)
+    return max(count * state["src"], count * state["trg"])
+
+
+def reference_batches(src_lengths, trg_lengths, batch_size):
+    """ torchtext's `data.batch` with `batch_size_fn` over the examples sorted by width """
+    order = sorted(range(len(src_lengths)), key=lambda i: max(src_lengths[i], trg_lengths[i]))
+    state, batches, batch, size = {}, [], [], 0
+    for i in order:
+        batch.append(i)
+        size = batch_size_fn(src_lengths[i], trg_lengths[i], len(batch), state)
+        if size == batch_size:
+            batches.append(batch)
+            batch, size = [], 0
+        elif size > batch_size:
+            batches.append(batch[:-1])
+            batch = batch[-1:]
+            size = batch_size_fn(src_lengths[i], trg_lengths[i], 1, state)
+    if batch:
+        batches.append(batch)
+    # `data.batch` yields an empty batch before an example that is longer than the budget on its own
+    return [batch for batch in batches if batch]
+
+
+def random_lengths(num_examples, seed, max_len=60):
+    rng = random.Random(seed)
+    src_lengths = [rng.randint(1, max_len) for _ in range(num_examples)]
+    trg_lengths = [max(1, length + rng.randint(-5, 5)) for length in src_lengths]
+    return src_lengths, trg_lengths
+
+
+@pytest.mark.parametrize("batch_size", [62, 200, 1000, 4096])
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_budget_and_coverage(batch_size, shuffle):
+    src_lengths, trg_lengths = random_lengths(2000, seed=batch_size)
+    plan = plan_batches(src_lengths, trg_lengths, batch_size, shuffle=shuffle)
+
+    # every example is in exactly one batch
+    indices = sorted(int(i) for batch in plan for i in batch)
+    assert indices == list(range(len(src_lengths)))
+
+    num_padded = 0
+    for batch in plan:
+        batch = [int(i) for i in batch]
+        assert len(batch) > 0
+        width = max(max(src_lengths[i], trg_lengths[i]) + 2 for i in batch)
+        # the token budget is respected (a single example longer than the budget is its own batch)
+        assert len(batch) == 1 or len(batch) * width <= batch_size
+
+        # the examples of a batch are sorted by decreasing (src, trg) length
+        keys = [(src_lengths[i], trg_lengths[i]) for i in batch]
+        assert keys == sorted(keys, reverse=True)
+
+        num_padded += len(batch) * (max(src_lengths[i] for i in batch) + 2)
+        num_padded += len(batch) * (max(trg_lengths[i] for i in batch) + 2)
+
+    assert plan.num_tokens == sum(src_lengths) + sum(trg_lengths) + 4 * len(src_lengths)
+    assert plan.num_padded == num_padded
+
+
+@pytest.mark.parametrize("batch_size", [62, 200, 1000, 4096])
+def test_same_batches_as_batch_size_fn(batch_size):
+    src_lengths, trg_lengths = random_lengths(2000, seed=batch_size)
+    plan = plan_batches(src_lengths, trg_lengths, batch_size, shuffle=False)
+    expected = reference_batches(src_lengths, trg_lengths, batch_size)
+    assert sorted(sorted(int(i) for i in batch) for batch in plan) == \
+        sorted(sorted(batch) for batch in expected)
+
+
+def test_plan_is_seeded_from_random():
+    src_lengths, trg_lengths = random_lengths(500, seed=0)
+    random.seed(1)
+    first = plan_batches(src_lengths, trg_lengths, 1000)
+    random.seed(1)
+    second = plan_batches(src_lengths, trg_lengths, 1000)
+    # seeded from `random`: every rank of data-parallel training plans the same batches
+    assert [list(batch) for batch in first] == [list(batch) for batch in second]
+
+
+def test_no_examples():
+    plan = plan_batches([], [], 1000)
+    assert len(plan) == 0
+    assert plan.padding_ratio == 0.0
@@ -0,0 +1,83 @@
+""" Parity of the batched beam search with a per-sentence beam search that never prunes """
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.nn.functional as F
+from utils.beam_search import length_penalty, translate_batch
+
+SOS, EOS, PAD = 1, 2, 0
+VOCAB_SIZE = 7
+
+
+class ToyState(object):
+    """ Decoding state of the ToyModel: the number of steps decoded so far """
+
+    def __init__(self):
+        self.step = 0
+
+    def reorder(self, index, memory_index=None):
+        pass
+
+
+class ToyModel(object):
+    """
+    A 'model' whose log probabilities only depend on the sentence, the step and the last word,
+    read from a random table. The sentence id is stored in the encoder output
+    """
+
+    def __init__(self, num_sentences, max_len, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        self.table = torch.randn(
+            num_sentences, max_len, VOCAB_SIZE, VOCAB_SIZE, generator=generator) * 2
+        self.decoder = SimpleNamespace(init_state=lambda src_enc, encoder_final: ToyState())
+        self.generator = lambda x: x
+
+    def decode(self, trg, src_enc, src_mask, trg_mask, encoder_final, state):
+        sentences = src_enc[:, 0, 0].long()
+        logits = self.table[sentences, state.step, trg[:, -1]]
+        state.step += 1
+        return logits.unsqueeze(1), state
+
+    def log_probs(self, sentence, step, word):
+        return F.log_softmax(self.table[sentence, step, word], dim=-1)
+
+
+def reference_search(model, sentence, beam_size, alpha, max_len, n_best):
+    """ Beam search over one sentence that keeps decoding until `max_len` (no early stopping) """
+    beams = [(0.0, [SOS])]
+    finished = []
+    for step in range(1, max_len + 1):
+        candidates = []
+        for score, hyp in beams:
+            log_probs = model.log_probs(sentence, step - 1, hyp[-1])
+            candidates += [(score + float(log_probs[word]), hyp + [word])
+                           for word in range(VOCAB_SIZE)]
+        candidates = sorted(candidates, key=lambda c: c[0], reverse=True)[:2 * beam_size]
+        finished += [(score / length_penalty(step, alpha), hyp[1:-1])
+                     for score, hyp in candidates[:beam_size] if hyp[-1] == EOS]
+        beams = [c for c in candidates if c[1][-1] != EOS][:beam_size]
+        if step == max_len:
+            finished += [(score / length_penalty(step, alpha), hyp[1:]) for score, hyp in beams]
+    finished = sorted(finished, key=lambda c: c[0], reverse=True)[:n_best]
+    return [hyp for _, hyp in finished], [score for score, _ in finished]
+
+
+@pytest.mark.parametrize("alpha", [0.0, 0.6, 2.0])
+@pytest.mark.parametrize("beam_size,n_best", [(1, 1), (3, 1), (3, 2)])
+def test_batched_beam_search_matches_reference(alpha, beam_size, n_best):
+    # per-sentence maximum lengths (1 to 8 words)
+    max_lengths = [1 + (7 * i) % 8 for i in range(40)]
+    model = ToyModel(len(max_lengths), max(max_lengths))
+    params = SimpleNamespace(sos_index=SOS, eos_index=EOS, pad_token=PAD)
+    src_enc = torch.arange(len(max_lengths), dtype=torch.float).view(-1, 1, 1)
+    src_mask = torch.ones(len(max_lengths), 1, 1, dtype=torch.bool)
+
+    translations, scores = translate_batch(model, src_enc, src_mask, beam_size, alpha, params,
+                                           max(max_lengths), n_best=n_best, max_lengths=max_lengths)
+
+    for sentence, max_len in enumerate(max_lengths):
+        expected_translations, expected_scores = reference_search(
+            model, sentence, beam_size, alpha, max_len, n_best)
+        assert translations[sentence] == expected_translations
+        assert scores[sentence] == pytest.approx(expected_scores, abs=1e-5)
@@ -0,0 +1,108 @@
+""" The fast teacher forcing paths of the GRUDecoder match the step-by-step loop over the whole batch """
+import torch
+from models.decoders import GRUDecoder
+
+VOCAB_SIZE, EMBED_SIZE, HIDDEN_SIZE, NUM_LAYERS = 20, 8, 6, 2
+TRG_LENGTHS = [4, 7, 1, 5, 7, 2]
+
+
+def make_decoder(attention, dropout):
+    torch.manual_seed(0)
+    return GRUDecoder(VOCAB_SIZE, EMBED_SIZE, HIDDEN_SIZE, attention, input_dropout_p=dropout, dropout_p=dropout,
+                      device=torch.device("cpu"), num_layers=NUM_LAYERS)
+
+
+def make_inputs():
+    generator = torch.Generator().manual_seed(1)
+    batch_size, src_len = len(TRG_LENGTHS), 5
+    trg = torch.randint(4, VOCAB_SIZE, (batch_size, max(TRG_LENGTHS)), generator=generator)
+    trg_lengths = torch.tensor(TRG_LENGTHS)
+    encoder_hidden = torch.randn(batch_size, src_len, 2 * HIDDEN_SIZE, generator=generator)
+    src_mask = torch.ones(batch_size, 1, src_len, dtype=torch.bool)
+    src_mask[::2, :, 3:] = False
+    encoder_final = torch.randn(NUM_LAYERS, batch_size, 2 * HIDDEN_SIZE, generator=generator)
+    return trg, trg_lengths, encoder_hidden, src_mask, encoder_final
+
+
+def run(decoder, trg_lengths=None, seed=0):
+    """ Outputs of the real target tokens and the gradients of their (weighted) sum """
+    trg, lengths, encoder_hidden, src_mask, encoder_final = make_inputs()
+    decoder.zero_grad()
+    torch.manual_seed(seed)
+    outputs, _ = decoder(trg, encoder_hidden, src_mask, None, encoder_final, trg_lengths=trg_lengths)
+
+    valid = torch.arange(trg.size(1)).unsqueeze(0) < lengths.unsqueeze(1)
+    outputs = outputs[valid]
+    weights = torch.linspace(-1, 1, outputs.numel()).view_as(outputs)
+    (outputs * weights).sum().backward()
+    grads = {name: param.grad.clone() for name, param in decoder.named_parameters() if param.grad is not None}
+    return outputs.detach(), grads
+
+
+def assert_same(expected, actual):
+    expected_outputs, expected_grads = expected
+    outputs, grads = actual
+    assert torch.allclose(outputs, expected_outputs, atol=1e-6)
+    assert expected_grads.keys() == grads.keys()
+    for name in expected_grads:
+        assert torch.allclose(grads[name], expected_grads[name], atol=1e-6), name
+
+
+def test_shrinking_teacher_forcing_without_dropout():
+    decoder = make_decoder("bahdanau", dropout=0.0)
+    for gru in decoder.gru:
+        gru.dropout = 0.0
+    assert_same(run(decoder), run(decoder, trg_lengths=torch.tensor(TRG_LENGTHS)))
+
+
+def test_shrinking_teacher_forcing_draws_the_full_batch_dropout_masks():
+    decoder = make_decoder("bahdanau", dropout=0.3).train()
+    expected = run(decoder, seed=3)
+    assert_same(expected, run(decoder, trg_lengths=torch.tensor(TRG_LENGTHS), seed=3))
+
+    # the dropout is actually applied
+    decoder.eval()
+    assert not torch.allclose(expected[0], run(decoder)[0])
+
+
+def step_loop(decoder):
+    """ Outputs of the step-by-step loop over the whole batch, without attention (in eval mode) """
+    trg, _, _, _, encoder_final = make_inputs()
+    embed = decoder.embed(trg)
+    hidden = decoder.init_hidden(encoder_final)
+    outputs = []
+    for t in range(trg.size(1)):
+        output, hidden = decoder.forward_step(embed[:, t].unsqueeze(1), encoder_final, hidden)
+        outputs.append(output)
+    return torch.stack(outputs, dim=1), hidden
+
+
+def test_sequence_teacher_forcing_matches_the_step_loop_in_eval_mode():
+    decoder = make_decoder(None, dropout=0.3).eval()
+    trg, _, encoder_hidden, src_mask, encoder_final = make_inputs()
+    with torch.no_grad():
+        expected_outputs, expected_hidden = step_loop(decoder)
+        outputs, hidden = decoder(trg, encoder_hidden, src_mask, None, encoder_final)
+
+    assert torch.allclose(outputs, expected_outputs, atol=1e-6)
+    assert torch.allclose(hidden, expected_hidden, atol=1e-6)
+
+
+def test_sequence_teacher_forcing_is_used_in_training(monkeypatch):
+    decoder = make_decoder(None, dropout=0.3).train()
+    calls = []
+    sequence_teacher_forcing = decoder.sequence_teacher_forcing
+
+    def record(*args):
+        calls.append(args)
+        return sequence_teacher_forcing(*args)
+
+    def step(*args, **kwargs):
+        raise AssertionError("the decoder ran step by step")
+    monkeypatch.setattr(decoder, "sequence_teacher_forcing", record)
+    monkeypatch.setattr(decoder, "forward_step", step)
+
+    outputs, grads = run(decoder)
+    run(decoder, trg_lengths=torch.tensor(TRG_LENGTHS))
+    assert len(calls) == 2
+    assert torch.isfinite(outputs).all() and grads
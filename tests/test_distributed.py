@@ -0,0 +1,61 @@
+""" Data-parallel training utilities: every rank builds only its own shard of the planned batches """
+import os
+import random
+
+import pytest
+import torch
+import torch.distributed as dist
+from torchtext import data
+from utils.data_loader import DataIterator, make_fields
+from utils.distributed import ShardedIterator, all_reduce_sum
+
+
+def make_iterator(num_examples=60, batch_size=40):
+    SRC, TRG = make_fields()
+    rng = random.Random(0)
+    fields = [("src", SRC), ("trg", TRG)]
+    examples = [data.Example.fromlist([" ".join("a" * rng.randint(1, 9)), " ".join("b" * rng.randint(1, 9))],
+                                      fields) for _ in range(num_examples)]
+    dataset = data.Dataset(examples, fields)
+    SRC.build_vocab(dataset.src, dataset.trg)
+    TRG.vocab = SRC.vocab
+    return DataIterator(dataset, batch_size=batch_size, device=torch.device("cpu"), repeat=False,
+                        sort_key=lambda x: (len(x.src), len(x.trg)), train=True, sort_within_batch=True,
+                        shuffle=True)
+
+
+def batch_lengths(batches):
+    return [batch.src[1].tolist() + batch.trg[1].tolist() for batch in batches]
+
+
+@pytest.mark.parametrize("world_size", [2, 3])
+def test_ranks_only_build_their_shard_of_the_planned_batches(world_size):
+    # every rank shuffles with the same seed (see train.py)
+    random.seed(5)
+    all_batches = batch_lengths(make_iterator())
+    num_groups = len(all_batches) // world_size
+
+    for rank in range(world_size):
+        random.seed(5)
+        data_iter = make_iterator()
+        shard = batch_lengths(ShardedIterator(data_iter, rank, world_size))
+        assert shard == all_batches[rank:num_groups * world_size:world_size]
+        # the batches of the other ranks were never built
+        assert len(data_iter.batches) == num_groups
+        assert data_iter.shard is None
+
+
+def test_other_iterators_are_sharded_after_the_batches_are_built():
+    assert list(ShardedIterator(range(7), 1, 3)) == [1, 4]
+
+
+def test_all_reduce_sum_keeps_tensors():
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29533")
+    dist.init_process_group("gloo", rank=0, world_size=1)
+    try:
+        loss, words = all_reduce_sum([torch.tensor(2.5), torch.tensor(7)])
+    finally:
+        dist.destroy_process_group()
+    assert torch.is_tensor(loss) and torch.is_tensor(words)
+    assert float(loss) == 2.5 and float(words) == 7.0
@@ -0,0 +1,61 @@
+""" Incremental decoding with a DecoderState gives the outputs of the uncached TransformerDecoder """
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.nn.functional as F
+from models.seq2seq import make_seq2seq_model
+from utils.utils import make_tgt_mask
+
+PAD, SOS = 1, 2
+VOCAB_SIZE = 20
+
+
+def make_model():
+    params = SimpleNamespace(model_type="Transformer", src_vocab_size=VOCAB_SIZE, tgt_vocab_size=VOCAB_SIZE,
+                             embed_size=16, hidden_size=16, n_layers_enc=2, n_layers_dec=3, num_heads=2,
+                             max_length=50, d_ff=32, input_dropout=0.1, layer_dropout=0.1,
+                             attention_dropout=0.1, relu_dropout=0.1, tgt_emb_prj_weight_sharing=False,
+                             emb_src_tgt_weight_sharing=False, device=torch.device("cpu"))
+    torch.manual_seed(0)
+    return make_seq2seq_model(params).eval()
+
+
+def pad(lengths, generator):
+    """ A batch of random sequences starting with <s>, padded after their `lengths` """
+    tensor = torch.randint(3, VOCAB_SIZE, (len(lengths), max(lengths)), generator=generator)
+    tensor[:, 0] = SOS
+    for row, length in enumerate(lengths):
+        tensor[row, length:] = PAD
+    return tensor
+
+
+@pytest.mark.parametrize("src_lengths, trg_lengths", [
+    ([6], [7]),
+    ([6, 3, 8, 1], [7, 2, 5, 7]),  # padded batch
+])
+def test_cached_decoding_matches_full_prefix_decoding(src_lengths, trg_lengths):
+    model = make_model()
+    generator = torch.Generator().manual_seed(1)
+    src, trg = pad(src_lengths, generator), pad(trg_lengths, generator)
+    src_mask = (src != PAD).unsqueeze(-2)
+    real_tokens = trg != PAD
+
+    with torch.no_grad():
+        encoder_outputs, _ = model.encode(src, src_mask, torch.tensor(src_lengths))
+        state = model.decoder.init_state(encoder_outputs)
+        for t in range(trg.size(1)):
+            # only the newest token is fed with the cache
+            step = trg[:, t:t + 1]
+            output, state = model.decode(step, encoder_outputs, src_mask, make_tgt_mask(step, PAD),
+                                         decoder_hidden=state)
+            cached_logits = F.log_softmax(model.generator(output[:, -1]), dim=-1)
+
+            # the whole prefix without a cache
+            prefix = trg[:, :t + 1]
+            output, _ = model.decode(prefix, encoder_outputs, src_mask, make_tgt_mask(prefix, PAD))
+            logits = F.log_softmax(model.generator(output[:, -1]), dim=-1)
+
+            rows = real_tokens[:, t]
+            assert torch.allclose(cached_logits[rows], logits[rows], atol=1e-5)
+            assert state.step == t + 1
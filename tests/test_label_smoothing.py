@@ -0,0 +1,45 @@
+""" The fused label smoothing loss computes the same loss as the dense KL-Divergence """
+import pytest
+import torch
+import torch.nn.functional as F
+from utils.label_smoothing import LabelSmoothingLoss, FusedLabelSmoothingLoss
+
+PAD = 1
+
+
+@pytest.mark.parametrize("label_smoothing", [0.0, 0.1, 0.5, 1.0])
+def test_fused_loss_matches_dense_loss(label_smoothing):
+    torch.manual_seed(0)
+    vocab_size = 11
+    output = F.log_softmax(torch.randn(20, vocab_size, dtype=torch.double), dim=-1)
+    target = torch.randint(0, vocab_size, (20,))
+    # some of the rows are padding
+    target[[0, 7, 8, 19]] = PAD
+
+    dense = LabelSmoothingLoss(label_smoothing, vocab_size, PAD)(output, target)
+    fused = FusedLabelSmoothingLoss(label_smoothing, vocab_size, PAD)(output, target)
+    assert float(fused) == pytest.approx(float(dense), rel=1e-6, abs=1e-6)
+
+
+def test_fused_loss_gradients_match_dense_loss():
+    torch.manual_seed(0)
+    vocab_size = 11
+    logits = torch.randn(20, vocab_size, dtype=torch.double)
+    target = torch.randint(0, vocab_size, (20,))
+    target[[3, 4]] = PAD
+
+    gradients = []
+    for loss_class in [LabelSmoothingLoss, FusedLabelSmoothingLoss]:
+        x = logits.clone().requires_grad_()
+        loss_class(0.1, vocab_size, PAD)(F.log_softmax(x, dim=-1), target).backward()
+        gradients.append(x.grad)
+    assert torch.allclose(gradients[0], gradients[1], atol=1e-7)
+    # the padding rows don't contribute to the loss
+    assert gradients[1][[3, 4]].abs().max() == 0
+
+
+def test_all_padding_gives_zero_loss():
+    output = F.log_softmax(torch.randn(4, 11, dtype=torch.double), dim=-1)
+    target = torch.full((4,), PAD, dtype=torch.long)
+    assert float(FusedLabelSmoothingLoss(0.1, 11, PAD)(output, target)) == 0.0
+    assert float(LabelSmoothingLoss(0.1, 11, PAD)(output, target)) == 0.0
@@ -0,0 +1,131 @@
+""" Sequence packing: the masks, positions and targets keep the segments of a packed row isolated """
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+from models.seq2seq import make_seq2seq_model
+from utils.binarized import TensorBatch
+from utils.packing import PackingIterator, segment_masks
+from utils.trainer import Trainer
+from utils.utils import make_tgt_mask
+
+PAD, SOS, EOS = 1, 2, 3
+VOCAB_SIZE = 20
+
+
+def make_batch(lengths, seed=0):
+    """ A padded batch of (src, trg) pairs with <s> and </s>, sorted by decreasing length """
+    generator = torch.Generator().manual_seed(seed)
+
+    def pad(sides):
+        tensor = torch.full((len(sides), max(len(s) for s in sides)), PAD, dtype=torch.long)
+        for i, side in enumerate(sides):
+            tensor[i, :len(side)] = torch.tensor(side)
+        return tensor, torch.tensor([len(s) for s in sides])
+
+    pairs = []
+    for src_len, trg_len in lengths:
+        src = torch.randint(4, VOCAB_SIZE, (src_len,), generator=generator).tolist()
+        trg = torch.randint(4, VOCAB_SIZE, (trg_len,), generator=generator).tolist()
+        pairs.append(([SOS] + src + [EOS], [SOS] + trg + [EOS]))
+    return TensorBatch(pad([src for src, _ in pairs]), pad([trg for _, trg in pairs]))
+
+
+def test_segment_masks():
+    src_segments = torch.tensor([[1, 1, 2, 2, 2, 0]])
+    trg_segments = torch.tensor([[1, 1, 1, 2, 2, 0]])
+    src_mask, trg_mask, memory_mask = segment_masks(src_segments, trg_segments)
+
+    for q in range(6):
+        for k in range(6):
+            s_q, s_k = int(src_segments[0, q]), int(src_segments[0, k])
+            assert bool(src_mask[0, q, k]) == (s_q == s_k and s_k != 0)
+
+            t_q, t_k = int(trg_segments[0, q]), int(trg_segments[0, k])
+            # block-diagonal and causal
+            assert bool(trg_mask[0, q, k]) == (t_q == t_k and t_k != 0 and k <= q)
+
+            # a trg token only attends to the src tokens of its own segment
+            assert bool(memory_mask[0, q, k]) == (t_q == s_k and s_k != 0)
+
+
+def split_segments(tokens, positions, length):
+    """ Split the first `length` tokens of a packed row where the positions restart at 0 """
+    starts = [col for col in range(length) if int(positions[col]) == 0] + [length]
+    return [list(range(start, end)) for start, end in zip(starts[:-1], starts[1:])]
+
+
+def test_pack_places_every_pair_in_its_own_segment():
+    batch = make_batch([(7, 6), (5, 7), (3, 2), (2, 4), (1, 1)])
+    packed = PackingIterator([batch], PAD, pack_len=12).pack(batch)
+    src, src_row_lengths = packed.src
+    trg, trg_row_lengths = packed.trg
+
+    # fewer (and denser) rows than the padded batch
+    assert src.size(0) < batch.src[0].size(0)
+
+    pairs = []
+    for row in range(src.size(0)):
+        src_segments = split_segments(src[row], packed.src_positions[row], int(src_row_lengths[row]))
+        trg_segments = split_segments(trg[row], packed.trg_positions[row], int(trg_row_lengths[row]))
+        assert len(src_segments) == len(trg_segments)
+        for src_cols, trg_cols in zip(src_segments, trg_segments):
+            pairs.append((src[row, src_cols].tolist(), trg[row, trg_cols].tolist()))
+            # the positions restart at 0 in every segment
+            assert packed.src_positions[row, src_cols].tolist() == list(range(len(src_cols)))
+            assert packed.trg_positions[row, trg_cols].tolist() == list(range(len(trg_cols)))
+            # the trg segment attends to exactly the tokens of its src segment
+            for col in trg_cols:
+                assert packed.memory_mask[row, col].nonzero().view(-1).tolist() == src_cols
+            # and its <s> is not a target of the previous segment
+            assert packed.segment_starts[row].nonzero().view(-1).tolist().count(trg_cols[0]) == 1
+
+        # the padding at the end of the row is not part of any segment
+        assert src[row, int(src_row_lengths[row]):].eq(PAD).all()
+        assert trg[row, int(trg_row_lengths[row]):].eq(PAD).all()
+
+    expected = [(batch.src[0][i, :int(batch.src[1][i])].tolist(), batch.trg[0][i, :int(batch.trg[1][i])].tolist())
+                for i in range(batch.src[0].size(0))]
+    assert sorted(pairs) == sorted(expected)
+
+
+def make_model():
+    params = SimpleNamespace(model_type="Transformer", src_vocab_size=VOCAB_SIZE, tgt_vocab_size=VOCAB_SIZE,
+                             embed_size=16, hidden_size=16, n_layers_enc=2, n_layers_dec=2, num_heads=2,
+                             max_length=50, d_ff=32, input_dropout=0.1, layer_dropout=0.1,
+                             attention_dropout=0.1, relu_dropout=0.1, tgt_emb_prj_weight_sharing=False,
+                             emb_src_tgt_weight_sharing=False, device=torch.device("cpu"))
+    torch.manual_seed(0)
+    return make_seq2seq_model(params).eval()
+
+
+def test_packed_loss_matches_unpacked_loss():
+    batch = make_batch([(9, 8), (7, 9), (5, 4), (3, 5), (2, 2), (1, 3)], seed=1)
+    model = make_model()
+    criterion = nn.NLLLoss(reduction="sum", ignore_index=PAD)
+    trainer = Trainer.__new__(Trainer)
+    trainer.params = SimpleNamespace(pad_token=PAD)
+
+    src, trg = batch.src[0], batch.trg[0]
+    src_mask, trg_mask = (src != PAD).unsqueeze(-2), make_tgt_mask(trg, PAD)
+    with torch.no_grad():
+        output = model(src, trg, src_mask, trg_mask)
+    targets = trainer.loss_targets(batch, trg)
+    expected_loss = criterion(output[:, :-1].reshape(-1, VOCAB_SIZE), targets.reshape(-1))
+
+    iterator = PackingIterator([batch], PAD, pack_len=16)
+    packed = next(iter(iterator))
+    assert packed.src[0].size(0) < src.size(0)
+    with torch.no_grad():
+        output = model(packed.src[0], packed.trg[0], packed.src_mask, packed.trg_mask,
+                       **packed.model_inputs())
+    targets = trainer.loss_targets(packed, packed.trg[0])
+    loss = criterion(output[:, :-1].reshape(-1, VOCAB_SIZE), targets.reshape(-1))
+
+    # the same target tokens are predicted from the same (isolated) contexts
+    assert int(targets.ne(PAD).sum()) == int(trg[:, 1:].ne(PAD).sum())
+    assert torch.allclose(loss, expected_loss, rtol=1e-4)
+
+    # and the packed batch has less padding
+    padding_ratio, packed_padding_ratio = iterator.padding_ratios()
+    assert packed_padding_ratio < padding_ratio
@@ -0,0 +1,144 @@
+""" Losses of the Trainer: the chunked loss computes the same loss and gradients as the whole-batch loss """
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.nn.functional as F
+from torch import nn
+from utils.binarized import TensorBatch
+from utils.label_smoothing import FusedLabelSmoothingLoss
+from utils.trainer import Trainer
+
+PAD = 1
+VOCAB_SIZE = 13
+
+
+class ToyModel(nn.Module):
+    """ A projection of the inputs into the Decoder outputs, followed by the generator """
+
+    def __init__(self):
+        super().__init__()
+        self.proj = nn.Linear(4, 8)
+        self.generator = nn.Linear(8, VOCAB_SIZE)
+
+    def forward(self, x):
+        return torch.tanh(self.proj(x))
+
+
+def make_trainer(model, criterion, loss_chunk_size):
+    trainer = Trainer.__new__(Trainer)
+    trainer.model = model
+    trainer.criterion = criterion
+    trainer.params = SimpleNamespace(pad_token=PAD, tgt_vocab_size=VOCAB_SIZE)
+    trainer.loss_chunk_size = loss_chunk_size
+    trainer.bf16 = False
+    return trainer
+
+
+def make_batch(seed):
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.randn(3, 6, 4, generator=generator)
+    trg = torch.randint(2, VOCAB_SIZE, (3, 6), generator=generator)
+    # padding at the end of the shorter sequences
+    trg[1, 4:] = PAD
+    trg[2, 2:] = PAD
+    return x, trg
+
+
+def gradients(model):
+    return [p.grad.clone() for p in model.parameters()]
+
+
+@pytest.mark.parametrize("loss_chunk_size", [1, 4, 1000])
+@pytest.mark.parametrize("make_criterion", [
+    lambda: nn.NLLLoss(reduction="sum", ignore_index=PAD),
+    lambda: FusedLabelSmoothingLoss(0.1, VOCAB_SIZE, PAD)])
+def test_chunked_loss_matches_whole_batch_loss(loss_chunk_size, make_criterion):
+    x, trg = make_batch(0)
+    torch.manual_seed(0)
+    model = ToyModel()
+
+    # whole batch: log probabilities of every position, as EncoderDecoder.forward returns them
+    trainer = make_trainer(model, make_criterion(), loss_chunk_size)
+    targets = trainer.loss_targets(None, trg)
+    output = F.log_softmax(model.generator(model(x)), dim=-1)[:, :-1]
+    loss = trainer.criterion(output.contiguous().view(-1, VOCAB_SIZE), targets.contiguous().view(-1))
+    loss.backward()
+    expected_gradients = gradients(model)
+
+    model.zero_grad()
+    chunked_loss = trainer.chunked_loss(model(x), targets, backward=True)
+
+    assert float(chunked_loss) == pytest.approx(loss.item(), rel=1e-5)
+    for expected, actual in zip(expected_gradients, gradients(model)):
+        assert torch.allclose(expected, actual, atol=1e-6)
+
+
+def test_chunked_loss_of_a_batch_without_targets():
+    x, trg = make_batch(0)
+    trg[:, 1:] = PAD
+    model = ToyModel()
+    trainer = make_trainer(model, nn.NLLLoss(reduction="sum", ignore_index=PAD), 4)
+
+    loss = trainer.chunked_loss(model(x), trainer.loss_targets(None, trg), backward=True)
+    assert float(loss) == 0.0
+    assert all(p.grad is None for p in model.parameters())
+
+
+class ToySeq2Seq(nn.Module):
+    """ Log probabilities of the next target token from the current one (and the first src token) """
+
+    def __init__(self):
+        super().__init__()
+        self.src_embed = nn.Embedding(VOCAB_SIZE, 8)
+        self.trg_embed = nn.Embedding(VOCAB_SIZE, 8)
+        self.generator = nn.Linear(8, VOCAB_SIZE)
+
+    def forward(self, src, trg, src_mask, trg_mask, src_lengths, trg_lengths):
+        hidden = torch.tanh(self.trg_embed(trg) + self.src_embed(src[:, :1]))
+        return F.log_softmax(self.generator(hidden), dim=-1)
+
+
+class RecordingOptimizer(object):
+    """ Keeps the gradients of every update instead of updating the parameters """
+
+    def __init__(self, model):
+        self.model = model
+        self.updates = []
+
+    def zero_grad(self):
+        self.model.zero_grad()
+
+    def step(self):
+        self.updates.append(gradients(self.model))
+
+
+def accumulated_gradients(batches, update_freq):
+    torch.manual_seed(0)
+    model = ToySeq2Seq()
+    trainer = make_trainer(model, nn.NLLLoss(reduction="sum", ignore_index=PAD), 0)
+    trainer.params = SimpleNamespace(pad_token=PAD, tgt_vocab_size=VOCAB_SIZE, boost=False, cuda=False)
+    trainer.optimizer = RecordingOptimizer(model)
+    trainer.metrics = SimpleNamespace(step=lambda *args: None, flush=lambda *args: None)
+    trainer.update_freq, trainer.iterations = update_freq, 0
+    trainer.world_size, trainer.rank = 1, 0
+    trainer.prefetch, trainer.pack_len = 0, 0
+    trainer.train_epoch(batches)
+    return trainer.optimizer.updates
+
+
+def test_update_freq_keeps_the_gradients_of_the_summed_loss():
+    halves = []
+    for seed in [1, 2]:
+        _, trg = make_batch(seed)
+        src = torch.randint(2, VOCAB_SIZE, (3, 5), generator=torch.Generator().manual_seed(seed))
+        lengths = trg.ne(PAD).sum(1)
+        halves.append(TensorBatch((src, torch.full((3,), 5)), (trg, lengths)))
+    whole = TensorBatch(tuple(torch.cat(tensors) for tensors in zip(halves[0].src, halves[1].src)),
+                        tuple(torch.cat(tensors) for tensors in zip(halves[0].trg, halves[1].trg)))
+
+    # one update of update_freq=2 over the two halves, one update of update_freq=1 over the whole batch
+    [expected] = accumulated_gradients([whole], update_freq=1)
+    [accumulated] = accumulated_gradients(halves, update_freq=2)
+    for expected_grad, grad in zip(expected, accumulated):
+        assert torch.allclose(grad, expected_grad, atol=1e-6)
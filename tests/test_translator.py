@@ -0,0 +1,14 @@
+""" Length limits of the translations """
+import torch
+from utils.translator import Translator
+
+
+def test_max_decode_lengths_count_the_src_words():
+    translator = Translator.__new__(Translator)
+    # 3 and 10 src words, with <s> and </s>
+    src_lengths = torch.tensor([5, 12])
+
+    assert translator.max_decode_lengths(src_lengths, 100).tolist() == [99, 99]
+    assert translator.max_decode_lengths(src_lengths, 100, max_len_a=1.5, max_len_b=2).tolist() == [6, 17]
+    assert translator.max_decode_lengths(src_lengths, 10, max_len_a=1.5, max_len_b=2).tolist() == [6, 9]
+    assert translator.max_decode_lengths(src_lengths, 100, max_len_a=0.0, max_len_b=0).tolist() == [1, 1]
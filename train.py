@@ -1,27 +1,32 @@
 import argparse
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch import optim, nn
 from torch.nn.utils import clip_grad_norm
 from torch.nn import functional as F
-from utils.data_loader import load_dataset
+from utils.data_loader import load_dataset, save_vocab
 from models.seq2seq import make_seq2seq_model
-from utils.label_smoothing import LabelSmoothingLoss
+from utils.label_smoothing import LabelSmoothingLoss, FusedLabelSmoothingLoss
 from models.transformer.optim import ScheduledOptimizer
 from utils.utils import HyperParams, set_logger, RunningAverage
 from utils.trainer import Trainer
+from utils.distributed import broadcast_parameters
 import os
 import sys
 import shutil
 import logging
 import time
 import math
+import random
 from tqdm import tqdm
 
 
 def main(params):
     logging.info("Loading the datasets...")
     train_iter, dev_iter, test_iterator, DE, EN = load_dataset(
-        params.data_path, params.train_batch_size, params.dev_batch_size)
+        params.data_path, params.train_batch_size, params.dev_batch_size,
+        binarized=getattr(params, "binarized", False), stream_buffer=getattr(params, "stream_buffer", 0))
     de_size, en_size = len(DE.vocab), len(EN.vocab)
     logging.info(
         "[DE Vocab Size]: {}, [EN Vocab Size]: {}".format(de_size, en_size))
@@ -36,14 +41,26 @@ def main(params):
     params.SRC = DE
     params.TRG = EN
 
+    # translate.py loads the vocab from the model directory instead of rebuilding it from the training data
+    if getattr(params, "rank", 0) == 0:
+        save_vocab(os.path.join(params.model_dir, "vocab.json"), DE, EN)
+
     # make the Seq2Seq model
     model = make_seq2seq_model(params)
 
+    if params.world_size > 1:
+        # every rank starts from the weights of rank 0 but draws its own dropout masks
+        broadcast_parameters(model)
+        torch.manual_seed(2 + params.rank)
+
     # default optimizer
     optimizer = optim.Adam(model.parameters(), lr=params.lr)
 
     if params.model_type == "Transformer":
-        criterion = LabelSmoothingLoss(
+        # the dense loss builds the smoothed distribution of every target word (the original implementation)
+        loss_class = LabelSmoothingLoss if getattr(
+            params, "dense_label_smoothing", False) else FusedLabelSmoothingLoss
+        criterion = loss_class(
             params.label_smoothing, params.tgt_vocab_size, params.pad_token).to(params.device)
         optimizer = ScheduledOptimizer(optimizer=optimizer, d_model=params.hidden_size,
                                        factor=2, n_warmup_steps=params.n_warmup_steps)
@@ -67,6 +84,35 @@ def main(params):
     trainer.train()
 
 
+def run_worker(rank, params):
+    """
+    Train the model in one of the `world_size` processes of data-parallel training
+
+    Arguments:
+        rank: rank of the process
+        params: hyperparams for training of the model
+    """
+    dist.init_process_group("gloo", init_method="tcp://127.0.0.1:{}".format(params.dist_port),
+                            rank=rank, world_size=params.world_size)
+    params.rank = rank
+
+    # split the cores of the machine between the processes
+    torch.set_num_threads(max(1, os.cpu_count() // params.world_size))
+
+    if rank == 0:
+        set_logger(os.path.join(params.model_dir, "train.log"))
+    else:
+        # only rank 0 reports the progress of the training
+        sys.stdout = open(os.devnull, "w")
+
+    # same seed on every rank: the data iterators of all the ranks shuffle the batches in the same
+    # order (each rank then keeps its own shard) and the models are initialized in the same way
+    random.seed(2)
+    torch.manual_seed(2)
+    main(params)
+    dist.destroy_process_group()
+
+
 if __name__ == "__main__":
     p = argparse.ArgumentParser(
         description="Seq2Seq w/ Attention Hyperparameters")
@@ -75,6 +121,10 @@ if __name__ == "__main__":
                    help="Directory containing seq2seq experiments")
     p.add_argument("-restore_file", default=None, help="Name of the file in the model directory containing weights \
                    to reload before training")
+    p.add_argument("-world_size", type=int, default=1,
+                   help="Number of processes for data-parallel training on the CPU (gloo backend)")
+    p.add_argument("-dist_port", type=int, default=29500,
+                   help="Port used by the processes of data-parallel training to communicate")
     args = p.parse_args()
 
     # Set the logger
@@ -91,9 +141,12 @@ if __name__ == "__main__":
     params.data_path = args.data_path
     params.model_dir = args.model_dir
     params.restore_file = args.restore_file
+    params.world_size = args.world_size
+    params.dist_port = args.dist_port
+    params.rank = 0
 
-    # use GPU if available
-    params.cuda = torch.cuda.is_available()
+    # use GPU if available (data-parallel training runs on the CPU)
+    params.cuda = torch.cuda.is_available() and params.world_size == 1
     logging.info("Using GPU: {}".format(params.cuda))
 
     device = torch.device('cuda' if params.cuda else 'cpu')
@@ -103,4 +156,12 @@ if __name__ == "__main__":
     torch.manual_seed(2)
     if params.cuda:
         torch.cuda.manual_seed(2)
-    main(params)
+    assert not (params.boost and (getattr(params, "binarized", False) or getattr(params, "stream_buffer", 0))), \
+        "Boosting is not supported with a binarized or streamed dataset"
+    assert not (getattr(params, "pack_len", 0) and (params.boost or params.model_type != "Transformer")), \
+        "Sequence packing is only supported for the Transformer (without boosting)"
+    if params.world_size > 1:
+        assert not params.boost, "Boosting is not supported with data-parallel training"
+        mp.spawn(run_worker, args=(params,), nprocs=params.world_size)
+    else:
+        main(params)
@@ -6,6 +6,7 @@ and evaluates the translations using BLEU score
 import argparse
 import subprocess
 import os
+import sys
 import torch
 from torch.autograd import Variable
 from torch import optim
@@ -13,9 +14,13 @@ from tqdm import tqdm
 import logging
 from utils.trainer import Trainer
 from utils.translator import Translator
-from utils.data_loader import load_dataset
+from utils.data_loader import load_dataset, load_vocab, load_eval_dataset
 from utils.utils import HyperParams
 from utils.average_models import average_checkpoints
+from utils.streaming import micro_batches, continuous_translations
+from utils.continuous_batching import ContinuousDecoder
+from utils.translation_cache import TranslationCache
+from utils.server import RequestBatcher, TranslationServer
 from models.seq2seq import make_seq2seq_model
 
 
@@ -27,9 +32,21 @@ def main(params, greedy, beam_size, test):
         greedy: whether or not to do greedy decoding
         beam_size: size of beam if doing beam search
     """
-    print("Loading dataset...")
-    _, dev_iter, test_iterator, DE, EN = load_dataset(
-        params.data_path, params.train_batch_size, params.dev_batch_size)
+    vocab_path = os.path.join(params.model_dir, "vocab.json")
+    if os.path.isfile(vocab_path):
+        print("Loading vocab...")
+        DE, EN = load_vocab(vocab_path)
+        dev_iter, test_iterator = None, None
+        if not (params.stream or params.serve):
+            print("Loading dev/test sets...")
+            dev_iter, test_iterator = load_eval_dataset(
+                params.data_path, DE, EN, params.dev_batch_size)
+    else:
+        # the model was trained before the vocab was saved in its directory
+        print("Loading dataset...")
+        _, dev_iter, test_iterator, DE, EN = load_dataset(
+            params.data_path, params.train_batch_size, params.dev_batch_size,
+            binarized=getattr(params, "binarized", False))
     de_size, en_size = len(DE.vocab), len(EN.vocab)
     print("[DE Vocab Size: ]: {}, [EN Vocab Size]: {}".format(de_size, en_size))
 
@@ -39,6 +56,7 @@ def main(params, greedy, beam_size, test):
     params.pad_token = EN.vocab.stoi["<pad>"]
     params.eos_index = EN.vocab.stoi["</s>"]
     params.itos = EN.vocab.itos
+    params.SRC = DE
 
     device = torch.device('cuda' if params.cuda else 'cpu')
     params.device = device
@@ -59,22 +77,62 @@ def main(params, greedy, beam_size, test):
         print("Restoring parameters from {}".format(model_path))
         model = Trainer.load_checkpoint(model, model_path)
 
+    # cache of the translations of repeated src sentences
+    cache = None
+    if params.cache_size or params.cache_path:
+        cache = TranslationCache(
+            params.cache_size or 100000, params.cache_path)
+
+    # continuous batching is only implemented for greedy decoding with the Transformer
+    continuous_decoder = None
+    if params.slots and (params.stream or params.serve):
+        if greedy and params.model_type == "Transformer":
+            continuous_decoder = ContinuousDecoder(Translator(model, None, params, device), params.slots,
+                                                   max_len_a=params.max_len_a, max_len_b=params.max_len_b)
+        else:
+            print("Continuous batching requires -greedy and a Transformer model, decoding batch by batch instead")
+
+    # translate the lines of the input stream
+    if params.stream:
+        if continuous_decoder is not None:
+            for translation in continuous_translations(params.input_stream, continuous_decoder):
+                params.output_stream.write(" ".join(translation) + "\n")
+                params.output_stream.flush()
+            return
+        translator = Translator(model, None, params, device, cache=cache)
+        stream_translations(translator, params.input_stream, params.output_stream,
+                            None if greedy else beam_size, params.max_tokens or 2048, params.stream_timeout)
+        return
+
+    # serve translation requests over HTTP
+    if params.serve:
+        translator = Translator(model, None, params, device, cache=cache)
+        batcher = RequestBatcher(translator, params.max_batch_size, params.max_tokens or 4096,
+                                 params.max_wait, None if greedy else beam_size, decoder=continuous_decoder)
+        server = TranslationServer((params.host, params.port), batcher)
+        print("Serving translations on http://{}:{}/translate".format(params.host, params.port))
+        server.serve_forever()
+        return
+
     # evaluate on the test set
     if test:
         print("Doing Beam Search on the Test Set")
-        test_decoder = Translator(model, test_iterator, params, device)
+        test_decoder = Translator(
+            model, test_iterator, params, device, max_tokens=params.max_tokens, cache=cache)
         test_beam_search_outputs = test_decoder.beam_decode(
-            beam_width=beam_size)
+            beam_width=beam_size, max_len_a=params.max_len_a, max_len_b=params.max_len_b)
         test_decoder.output_decoded_translations(
             test_beam_search_outputs, "beam_search_outputs_size_test={}.en".format(beam_size))
         return
 
     # instantiate a Translator object to translate SRC langauge to TRG language using Greedy/Beam Decoding
-    decoder = Translator(model, dev_iter, params, device)
+    decoder = Translator(model, dev_iter, params, device,
+                         max_tokens=params.max_tokens, cache=cache)
 
     if greedy:
         print("Doing Greedy Decoding...")
-        greedy_outputs = decoder.greedy_decode(max_len=100)
+        greedy_outputs = decoder.greedy_decode(
+            max_len=100, max_len_a=params.max_len_a, max_len_b=params.max_len_b)
         decoder.output_decoded_translations(
             greedy_outputs, "greedy_outputs.en")
 
@@ -84,7 +142,8 @@ def main(params, greedy, beam_size, test):
 
     if beam_size:
         print("Doing Beam Search...")
-        beam_search_outputs = decoder.beam_decode(beam_width=beam_size)
+        beam_search_outputs = decoder.beam_decode(
+            beam_width=beam_size, max_len_a=params.max_len_a, max_len_b=params.max_len_b)
         decoder.output_decoded_translations(
             beam_search_outputs, "beam_search_outputs_size={}.en".format(beam_size))
 
@@ -92,6 +151,31 @@ def main(params, greedy, beam_size, test):
         subprocess.call(['./utils/eval.sh', params.model_dir +
                          "outputs/beam_search_outputs_size={}.en".format(beam_size)])
 
+    if cache is not None:
+        print("Translation cache: {}".format(cache.stats()))
+
+
+def stream_translations(translator, input_stream, output_stream, beam_size, max_tokens, timeout):
+    """
+    Translate the (BPE'd) German lines of `input_stream` and write the English translations
+    to `output_stream`, in the same order. The lines are grouped into micro-batches and the
+    translations of each micro-batch are written (and flushed) as soon as it is decoded
+
+    Arguments:
+        translator: Translator object wrapping the trained model
+        input_stream: file-like object with one German sentence per line
+        output_stream: file-like object where the translations are written
+        beam_size: size of beam (greedy decoding if None)
+        max_tokens: maximum number of (padded) source tokens in a micro-batch
+        timeout: maximum time (in seconds) a line waits for its micro-batch to be decoded
+    """
+    for batch in micro_batches(input_stream, max_tokens, timeout, beam_width=beam_size or 1):
+        translations = translator.translate_sentences(
+            batch, beam_width=beam_size)
+        for translation in translations:
+            output_stream.write(" ".join(translation) + "\n")
+        output_stream.flush()
+
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser(
@@ -108,7 +192,43 @@ if __name__ == "__main__":
                    help="Average the weight of the last n checkpoints")
     p.add_argument("-test", action="store_true",
                    help="evaluate on the test set")
+    p.add_argument("-batch_size", type=int, default=None,
+                   help="Number of sentences decoded at once (overrides the dev_batch_size of the model)")
+    p.add_argument("-max_tokens", type=int, default=None,
+                   help="Decode in length-sorted batches of at most max_tokens src tokens (times the beam size)")
+    p.add_argument("-stream", action="store_true",
+                   help="translate the lines of -input (stdin by default) and write the translations to stdout")
+    p.add_argument("-input", type=str, default="-",
+                   help="file with the BPE'd sentences to translate in -stream mode (- for stdin)")
+    p.add_argument("-stream_timeout", type=float, default=0.1,
+                   help="maximum time (in seconds) a line waits for its micro-batch in -stream mode")
+    p.add_argument("-serve", action="store_true",
+                   help="serve translation requests over HTTP (POST /translate, GET /stats)")
+    p.add_argument("-host", type=str, default="127.0.0.1",
+                   help="host to listen on in -serve mode")
+    p.add_argument("-port", type=int, default=8080,
+                   help="port to listen on in -serve mode")
+    p.add_argument("-max_batch_size", type=int, default=64,
+                   help="maximum number of sentences decoded at once in -serve mode")
+    p.add_argument("-max_wait", type=float, default=0.01,
+                   help="maximum time (in seconds) a sentence waits for other requests to batch with in -serve mode")
+    p.add_argument("-slots", type=int, default=0,
+                   help="decode with continuous batching over this many slots in -stream/-serve mode (greedy Transformer only)")
+    p.add_argument("-bf16", action="store_true",
+                   help="experimental: decode with bfloat16 mixed precision (autocast on the CPU, torch>=1.10). "
+                        "Its speed and BLEU have not been compared against float32 yet")
+    p.add_argument("-cache_size", type=int, default=0,
+                   help="cache the translations of the last cache_size distinct src sentences (0 disables the cache)")
+    p.add_argument("-cache_path", type=str, default=None,
+                   help="sqlite file where the cached translations are persisted (enables the cache)")
+    p.add_argument("-max_len_a", type=float, default=0.0,
+                   help="Limit the translations to max_len_a * src_len + max_len_b words")
+    p.add_argument("-max_len_b", type=int, default=None,
+                   help="Limit the translations to max_len_a * src_len + max_len_b words")
     args = p.parse_args()
+    # the continuous decoder admits the sentences one by one into its slots, without looking them up in the cache
+    if args.slots and (args.stream or args.serve) and (args.cache_size or args.cache_path):
+        p.error("-slots cannot be combined with the translation cache (-cache_size/-cache_path)")
 
     json_params_path = os.path.join(args.model_dir, "params.json")
     assert os.path.isfile(
@@ -119,5 +239,27 @@ if __name__ == "__main__":
     params.model_dir = args.model_dir
     params.model_file = args.model_file
     params.average = args.average
+    params.max_len_a = args.max_len_a
+    params.max_len_b = args.max_len_b
+    params.max_tokens = args.max_tokens
+    params.stream = args.stream
+    params.stream_timeout = args.stream_timeout
+    params.serve = args.serve
+    params.host = args.host
+    params.port = args.port
+    params.max_batch_size = args.max_batch_size
+    params.max_wait = args.max_wait
+    params.slots = args.slots
+    params.cache_size = args.cache_size
+    params.bf16 = args.bf16
+    params.cache_path = args.cache_path
+    if args.stream:
+        params.input_stream = sys.stdin if args.input == "-" else open(
+            args.input, "r")
+        # stdout only receives the translations, everything else is written to stderr
+        params.output_stream = sys.stdout
+        sys.stdout = sys.stderr
+    if args.batch_size:
+        params.dev_batch_size = args.batch_size
     params.cuda = torch.cuda.is_available()
     main(params, args.greedy, args.beam_size, args.test)
@@ -0,0 +1,99 @@
+""" Token-budgeted batch planning from the lengths of the examples, shared by the training data iterators """
+import random
+import numpy as np
+
+
+class BatchPlan(object):
+    """
+    The batches planned by `plan_batches`
+
+    Arguments:
+        batches: list of arrays with the indices of the examples of each batch
+        num_tokens: number of (src and trg) tokens of the batches, with the <s> and </s> tokens
+        num_padded: number of (src and trg) tokens of the batches once they are padded
+    """
+
+    def __init__(self, batches, num_tokens, num_padded):
+        self.batches = batches
+        self.num_tokens = num_tokens
+        self.num_padded = num_padded
+
+    @property
+    def padding_ratio(self):
+        """ Fraction of the padded batches that is padding """
+        return 1.0 - self.num_tokens / self.num_padded if self.num_padded else 0.0
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+def plan_batches(src_lengths, trg_lengths, batch_size, shuffle=True):
+    """
+    Group examples into batches of at most `batch_size` tokens, where the size of a batch is its number
+    of examples times its longest (src or trg) sequence, including the <s> and </s> tokens
+
+    The examples are bucketed by the length of their longest sequence and the buckets are filled in
+    increasing order, so the batch boundaries are computed with one vectorized step per distinct length
+    rather than one Python step per example. The examples of each batch are sorted by decreasing
+    (src, trg) length, as the GRUEncoder packs the src sequences
+
+    Arguments:
+        src_lengths: length of the src sequence of each example (without the <s> and </s> tokens)
+        trg_lengths: length of the trg sequence of each example (without the <s> and </s> tokens)
+        batch_size: maximum number of (padded) tokens in a batch
+        shuffle: whether the examples of the same length and the batches are shuffled
+
+    Returns:
+        A BatchPlan
+    """
+    src_lengths = np.asarray(src_lengths, dtype=np.int64) + 2
+    trg_lengths = np.asarray(trg_lengths, dtype=np.int64) + 2
+    num_examples = len(src_lengths)
+    if num_examples == 0:
+        return BatchPlan([], 0, 0)
+
+    # seeded from `random`, so that every rank of data-parallel training plans the same batches
+    rng = np.random.RandomState(random.getrandbits(32))
+
+    # sort the examples by width (the stable sort keeps the shuffled order within a bucket)
+    widths = np.maximum(src_lengths, trg_lengths)
+    order = rng.permutation(num_examples) if shuffle else np.arange(num_examples)
+    order = order[np.argsort(widths[order], kind="mergesort")]
+    sorted_widths = widths[order]
+
+    # boundaries of the buckets of examples of the same width
+    bounds = np.concatenate(
+        ([0], np.flatnonzero(np.diff(sorted_widths)) + 1, [num_examples]))
+
+    # start of each batch in `order`; `count` is the number of examples of the last (open) batch
+    starts, count = [], 0
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        capacity = max(batch_size // int(sorted_widths[lo]), 1)
+        if count >= capacity:
+            count = 0
+        # the first examples of the bucket complete the open batch, the others start new batches
+        first = min(hi - lo, capacity - count) if count else 0
+        bucket_starts = np.arange(lo + first, hi, capacity)
+        starts.append(bucket_starts)
+        count = count + hi - lo if len(bucket_starts) == 0 else hi - bucket_starts[-1]
+    starts = np.concatenate(starts)
+
+    # sort the examples of each batch by decreasing length
+    batch_ids = np.zeros(num_examples, dtype=np.int64)
+    batch_ids[starts[1:]] = 1
+    batch_ids = np.cumsum(batch_ids)
+    order = order[np.lexsort(
+        (-trg_lengths[order], -src_lengths[order], batch_ids))]
+
+    counts = np.diff(np.append(starts, num_examples))
+    num_padded = int((counts * np.maximum.reduceat(src_lengths[order], starts)).sum() +
+                     (counts * np.maximum.reduceat(trg_lengths[order], starts)).sum())
+    num_tokens = int(src_lengths.sum() + trg_lengths.sum())
+
+    batches = np.split(order, starts[1:])
+    if shuffle:
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+    return BatchPlan(batches, num_tokens, num_padded)
@@ -1,376 +1,189 @@
-from operator import itemgetter
-from queue import PriorityQueue
 import torch.nn.functional as F
 import torch
 import numpy as np
 from utils.utils import make_tgt_mask
 
 
-class Beam():
-    '''
-    Class for managing the internals of the beam search process.
-
-    This class from OpenNMT's implementation
-
-    Arguments:
-        size: the size of the beam
-        alpha: length normalization strength
-        params: param related to the `model`
-    '''
-
-    def __init__(self, size, alpha, params):
-
-        self.size = size
-        self._done = False
-        self.params = params
-        self.alpha = alpha
-
-        # The score for each translation on the beam.
-        self.scores = torch.zeros(
-            (size,), dtype=torch.float, device=self.params.device)
-        self.all_scores = []
-
-        # The backpointers at each time-step.
-        self.prev_ks = []
-
-        # The outputs at each time-step.
-        self.next_ys = [torch.full(
-            (size,), self.params.pad_token, dtype=torch.long, device=self.params.device)]
-        self.next_ys[0][0] = self.params.sos_index
-
-    def get_current_state(self):
-        """Get the outputs for the current timestep."""
-        return self.get_tentative_hypothesis()
-
-    def get_current_origin(self):
-        """Get the backpointers for the current timestep."""
-        return self.prev_ks[-1]
-
-    @property
-    def done(self):
-        return self._done
-
-    def advance(self, word_prob):
-        """Update beam status and check if finished or not."""
-        num_words = word_prob.size(1)
-
-        # Sum the previous scores (apply length normalization penalty at each step).
-        if len(self.prev_ks) > 0:
-            beam_lk = word_prob + \
-                self.scores.unsqueeze(1).expand_as(word_prob)
-        else:
-            beam_lk = word_prob[0]
-
-        flat_beam_lk = beam_lk.view(-1)
-
-        # this is weird issue with torch.topk
-        # need to run it twice to get the correct outputs
-        best_scores, best_scores_id = flat_beam_lk.topk(
-            self.size, 0, True, True)  # 1st sort
-        best_scores, best_scores_id = flat_beam_lk.topk(
-            self.size, 0, True, True)  # 2nd sort
-
-        self.all_scores.append(self.scores)
-        self.scores = best_scores
-
-        # bestScoresId is flattened as a (beam x word) array,
-        # so we need to calculate which word and beam each score came from
-        prev_k = best_scores_id / num_words
-        self.prev_ks.append(prev_k)
-        self.next_ys.append(best_scores_id - prev_k * num_words)
-
-        # End condition is when top-of-beam is EOS.
-        if self.next_ys[-1][0].item() == self.params.eos_index:
-            self._done = True
-            self.all_scores.append(self.scores)
-
-        return self._done
-
-    def length_penalty(self, curr_len, alpha=0.0):
-        """
-        Add a length penalty to the scores of the hypotheses
-        See Google Neural Machine Translation System
-        """
-        return ((5 + curr_len) / 6.0) ** alpha
-
-    def sort_scores(self):
-        """Sort the scores."""
-        return torch.sort(self.scores, 0, True)
-
-    def get_the_best_score_and_idx(self):
-        """Get the score of the best in the beam."""
-        scores, ids = self.sort_scores()
-        return scores[1], ids[1]
-
-    def get_tentative_hypothesis(self):
-        """Get the decoded sequence for the current timestep."""
-        if len(self.next_ys) == 1:
-            dec_seq = self.next_ys[0].unsqueeze(1)
-        else:
-            _, keys = self.sort_scores()
-            hyps = [self.get_hypothesis(k) for k in keys]
-            hyps = [[self.params.sos_index] + h for h in hyps]
-            dec_seq = torch.LongTensor(hyps)
-
-        return dec_seq
-
-    def get_hypothesis(self, k):
-        """ Walk back to construct the full hypothesis. """
-        hyp = []
-        for j in range(len(self.prev_ks) - 1, -1, -1):
-            hyp.append(self.next_ys[j+1][k])
-            k = self.prev_ks[j][k]
-
-        return list(map(lambda x: x.item(), hyp[::-1]))
+def length_penalty(length, alpha=0.0):
+    """
+    Length penalty of a hypothesis with `length` words
+    See Google Neural Machine Translation System
+    """
+    return ((5 + length) / 6.0) ** alpha
 
 
-def translate_batch(model, src_enc, src_mask, beam_size, alpha, params, max_seq_len):
+def translate_batch(model, src_enc, src_mask, beam_size, alpha, params, max_seq_len, n_best=1, max_lengths=None,
+                    encoder_final=None):
     """ 
-    Translate all source sequences in a batch.
+    Translate all source sequences in a batch using Beam Search.
 
-    This code is heavilty borrowed from OpenNMT. We have adapted the code to fit our needs
-    and to our models
+    The beams of all the sentences in the batch live in flat tensors: the scores of
+    the beams, the words decoded by every beam (the beams are reordered with their
+    backpointers at every step, so a hypothesis never has to be rebuilt by walking
+    back through the backpointers) and the cached decoder state. Every step runs a
+    single topk over the whole batch. Hypotheses that produce </s> are moved to a pool
+    of finished hypotheses and a sentence is dropped from the batch once none of its
+    beams can beat its `n_best` finished hypotheses (or it reached its maximum length)
 
-    Note: this method only works for Seq2Seq models that use Transformer as the Encoder/Decoder.
-    This will not work for GRU Encoders/Decoders. If you want to use GRU, then look at the
-    'beam_search_single` method
+    This works for both the GRU and the Transformer models, since the decoding state of both
+    Decoders (see `init_state`) can be reordered along the beams
 
     Arguments:
         model: the pytorch model (Seq2Seq object)
-        src_enc: the encoder output
-        src_mask: the mask used on the source sequence
+        src_enc: the encoder output [n_inst, src_seq_len, d_model]
+        src_mask: the mask used on the source sequence [n_inst, 1, src_seq_len]
         beam_size: the size of the beam
         alpha: controls the strength of length normalization
-        max_seq_len: the maximum length of a sequence
         params: hyperparams related to the `model`
+        max_seq_len: the maximum length of a sequence
+        n_best: number of translations to return for each source sequence
+        max_lengths: maximum number of words to decode for each source sequence (defaults to `max_seq_len`)
+        encoder_final: the final hidden state of the Encoder [num_layers, n_inst, 2*hidden_size] (only for GRU)
+
     Returns:
         This method returns the translations/scores of each src sequence in the batch as a tuple
-        (translations, scores)
+        (translations, scores), where translations[i] holds the `n_best` translations of the i-th
+        src sequence (as lists of word ids without <s> and </s>) and scores[i] their scores
     """
-
-    def get_inst_idx_to_tensor_position_map(inst_idx_list):
-        """ Indicate the position of an instance in a tensor """
-        return {inst_idx: tensor_position for tensor_position, inst_idx in enumerate(inst_idx_list)}
-
-    def collect_active_part(beamed_tensor, curr_active_inst_idx, n_prev_active_inst, n_bm):
-        ''' Collect tensor parts associated to active instances. '''
-
-        _, *d_hs = beamed_tensor.size()
-        n_curr_active_inst = len(curr_active_inst_idx)
-        new_shape = (n_curr_active_inst * n_bm, *d_hs)
-
-        beamed_tensor = beamed_tensor.view(n_prev_active_inst, -1)
-        beamed_tensor = beamed_tensor.index_select(0, curr_active_inst_idx)
-        beamed_tensor = beamed_tensor.view(*new_shape)
-
-        return beamed_tensor
-
-    def collate_active_info(
-            src_enc, inst_idx_to_position_map, active_inst_idx_list):
-        # Sentences which are still active are collected,
-        # so the decoder will not run on completed sentences.
-        n_prev_active_inst = len(inst_idx_to_position_map)
-        active_inst_idx = [inst_idx_to_position_map[k]
-                           for k in active_inst_idx_list]
-        active_inst_idx = torch.LongTensor(active_inst_idx).to(params.device)
-
-        active_src_enc = collect_active_part(
-            src_enc, active_inst_idx, n_prev_active_inst, beam_size)
-        active_inst_idx_to_position_map = get_inst_idx_to_tensor_position_map(
-            active_inst_idx_list)
-
-        return active_src_enc, active_inst_idx_to_position_map
-
-    def beam_decode_step(
-            inst_dec_beams, len_dec_seq, enc_output, inst_idx_to_position_map, n_bm):
-        ''' Decode and update beam status, and then return active beam idx '''
-
-        def prepare_beam_dec_seq(inst_dec_beams, len_dec_seq):
-            dec_partial_seq = [b.get_current_state()
-                               for b in inst_dec_beams if not b.done]
-            dec_partial_seq = torch.stack(dec_partial_seq).to(params.device)
-            dec_partial_seq = dec_partial_seq.view(-1, len_dec_seq)
-            return dec_partial_seq
-
-        def prepare_beam_dec_pos(len_dec_seq, n_active_inst, n_bm):
-            dec_partial_pos = torch.arange(
-                1, len_dec_seq + 1, dtype=torch.long, device=params.device)
-            dec_partial_pos = dec_partial_pos.unsqueeze(
-                0).repeat(n_active_inst * n_bm, 1)
-            return dec_partial_pos
-
-        def predict_word(dec_seq, dec_pos, enc_output, n_active_inst, n_bm):
-            # make the target mask
-            # [beam_size, 1, seq_len]
-            trg_mask = make_tgt_mask(dec_seq, params.pad_token)
-
-            # do one step of the decoder
-            dec_output, _ = model.decoder(
-                dec_seq, enc_output, src_mask, trg_mask, None, None)
-
-            # Pick the last step: (bh * bm) * d_h
-            dec_output = dec_output[:, -1, :]
-
-            word_prob = F.log_softmax(
-                model.generator(dec_output), dim=1)
-            word_prob = word_prob.view(n_active_inst, n_bm, -1)
-
-            return word_prob
-
-        def collect_active_inst_idx_list(inst_beams, word_prob, inst_idx_to_position_map):
-            active_inst_idx_list = []
-            for inst_idx, inst_position in inst_idx_to_position_map.items():
-                is_inst_complete = inst_beams[inst_idx].advance(
-                    word_prob[inst_position])
-                if not is_inst_complete:
-                    active_inst_idx_list += [inst_idx]
-
-            return active_inst_idx_list
-
-        n_active_inst = len(inst_idx_to_position_map)
-
-        dec_seq = prepare_beam_dec_seq(inst_dec_beams, len_dec_seq)
-        dec_pos = prepare_beam_dec_pos(len_dec_seq, n_active_inst, n_bm)
-
-        # [seq_len, beam_size * n_inst, vocab_size]
-        word_prob = predict_word(
-            dec_seq, dec_pos, enc_output, n_active_inst, n_bm)
-
-        # Update the beam with predicted word prob information and collect incomplete instances
-        active_inst_idx_list = collect_active_inst_idx_list(
-            inst_dec_beams, word_prob, inst_idx_to_position_map)
-
-        return active_inst_idx_list
-
-    def collect_hypothesis_and_scores(inst_dec_beams, n_best):
-        all_hyp, all_scores = [], []
-        for inst_idx in range(len(inst_dec_beams)):
-            scores, tail_idxs = inst_dec_beams[inst_idx].sort_scores()
-            all_scores += [scores[:n_best]]
-
-            hyps = [inst_dec_beams[inst_idx].get_hypothesis(
-                i) for i in tail_idxs[:n_best]]
-            all_hyp += [hyps]
-        return all_hyp, all_scores
-
-    # Repeat
-    n_inst, len_s, d_h = src_enc.size()
-
-    # src_en: [n_inst, len_s, d_h] => [n_inst * beam_size, len_s, d_h]
-    src_enc = src_enc.repeat(1, beam_size, 1).view(
-        n_inst * beam_size, len_s, d_h)
-
-    # prepare Beams
-    inst_dec_beams = [Beam(beam_size, alpha, params)
-                      for _ in range(n_inst)]
-
-    # Bookkeeping for active or not
-    # if you have one sample in your batch:
-    # active_inst_idx_list = [0]
-    # inst_idx_to_position_map: {0: 0}
+    device = src_enc.device
+    n_inst = src_enc.size(0)
+    if max_lengths is None:
+        max_lengths = [max_seq_len] * n_inst
+    beam_idx = torch.arange(beam_size, dtype=torch.long, device=device)
+
+    def collect_beam_rows(inst_positions):
+        """ Rows (in the flat tensors) of all the beams of the instances at `inst_positions` """
+        return (inst_positions.unsqueeze(1) * beam_size + beam_idx).view(-1)
+
+    # the keys/values of the encoder-decoder attention (the projected keys of the GRU attention)
+    # are computed once for each instance and then repeated for every beam of the instance
+    dec_state = model.decoder.init_state(src_enc, encoder_final)
+    # the instance of every beam [n_inst * beam_size]
+    beam_expansion = torch.arange(n_inst, dtype=torch.long, device=device).unsqueeze(
+        1).expand(n_inst, beam_size).contiguous().view(-1)
+    dec_state.reorder(beam_expansion, memory_index=beam_expansion)
+
+    # src_enc: [n_inst, len_s, d_h] => [n_inst * beam_size, len_s, d_h]
+    src_enc = src_enc.index_select(0, beam_expansion)
+    src_mask = src_mask.index_select(0, beam_expansion)
+
+    # words decoded so far by every beam [n_active_inst * beam_size, len_dec_seq]
+    dec_seq = torch.full((n_inst * beam_size, 1), params.sos_index,
+                         dtype=torch.long, device=device)
+
+    # cumulative log probabilities of the beams [n_active_inst, beam_size]
+    # every beam starts with <s>, so only the first beam is alive at the first step
+    beam_scores = torch.zeros(n_inst, beam_size, device=device)
+    beam_scores[:, 1:] = -float("inf")
+
+    # Bookkeeping of the instances that are still being decoded and of the finished hypotheses
     active_inst_idx_list = list(range(n_inst))
-    inst_idx_to_position_map = get_inst_idx_to_tensor_position_map(
-        active_inst_idx_list)
+    finished_hyps = [[] for _ in range(n_inst)]
 
     # Decode
-    for len_dec_seq in range(1, max_seq_len + 1):
-
-        # perform one decode step
-        active_inst_idx_list = beam_decode_step(
-            inst_dec_beams, len_dec_seq, src_enc, inst_idx_to_position_map, beam_size)
-
-        if not active_inst_idx_list:
-            break  # all instances have finised their path to <EOS>
-
-        src_enc, inst_idx_to_position_map = collate_active_info(
-            src_enc, inst_idx_to_position_map, active_inst_idx_list)
-
-    batch_hyp, batch_scores = collect_hypothesis_and_scores(
-        inst_dec_beams, n_best=1)
-
-    return torch.Tensor(batch_hyp[0]), batch_scores
-
-
-def beam_search_single(model, encoder_final, encoder_outputs, src_mask, beam_size, alpha, params, max_seq_len=100):
-    """
-    Perform beam search on a **single example** to get the most likely translation for a given source sequence
-
-    Note: this code only works for Seq2Seq models that use the GRU as the Encoder/Decoder. This will
-    not work for the Transformer model. If you want to use beam search for the Transformer Model,
-    use the 'translate_batch` method
-
-    Arguments:
-        model: the pytorch model
-        encoder_final: the final hidden representation from the Encoder 
-        encoder_outputs: the outputs of the Encoder (this is a hidden state for each token in the src sequence)
-        beam_size: the size of the beam
-        src_mask: the src sequence mask
-        alpha: controls the strenght of lenght normalization
-        params: the hyperparams related to the `model`
-        max_seq_len: the maximum lenght of the sequence
-
-    Returns:
-        The translation for the src sequence as a torch tensor
-    """
-
-    decoder_input = torch.ones(1, 1).fill_(
-        params.sos_index).type(torch.LongTensor).to(params.device)
-
-    # decode the <s> input as the first input to the decoder
-    output, decoder_hidden = model.decode(decoder_input, encoder_outputs,
-                                          src_mask, None, encoder_final)
-
-    prob = F.log_softmax(model.generator(output), dim=-1)
-    vocab_size = prob.size(-1)
-
-    # get the top K words from the output from the decoder
-    topk, indices = torch.topk(prob, beam_size)
-    topk = topk.view(-1)
-    indices = indices.view(-1)
-
-    # len(list) = beam_size
-    tokens_seq = []
-    for i in range(beam_size):
-        tokens_seq.append(
-            [torch.tensor([params.sos_index]).to(params.device), indices[i]])
-
-    # [num_layers, beam_size, decoder_hidden_dim]
-    hidden_seq = decoder_hidden.transpose(
-        0, 1).repeat(beam_size, 1, 1).transpose(0, 1)
-
-    # logprob_seq = [beam_size]
-    logprob_seq = topk
-
-    # [beam_width, seq_len, 2 * encoder_hidden_dim]
-    encoder_outputs = encoder_outputs.squeeze(0).repeat(beam_size, 1, 1)
-
-    while True:
-        if indices[0].item() == params.eos_index or len(tokens_seq[0]) == max_seq_len:
-            return torch.tensor([j.item() for j in tokens_seq[0]])[1:]
-
-        # evaluate the k beams using the decoder
-        output, decoder_hidden = model.decode(indices.unsqueeze(1), encoder_outputs,
-                                              src_mask, None, encoder_final, hidden_seq.contiguous())
-
-        # [beam_size, 1, vocab_size]
-        prob = F.log_softmax(model.generator(output), dim=-1)
-
-        # [beam_size, 1, vocab_size]
-        prob += logprob_seq.unsqueeze(1).unsqueeze(1)
-
-        prob = prob.flatten()
-        logprob_seq, indices = torch.topk(prob, beam_size)
-        logprob_seq = logprob_seq.view(-1)
-        indices = indices.view(-1)
-
-        # which beams were choosen as the top k
-        beam_chosen = indices // vocab_size
-        indices = indices % vocab_size
-
-        temp_seq = []
-        for i in range(beam_size):
-            seq = tokens_seq[beam_chosen[i].item()][:]
-            seq.append(indices[i])
-            temp_seq.append(seq)
-            hidden_seq[:, i, :] = decoder_hidden[:, beam_chosen[i].item(), :]
-        tokens_seq = temp_seq
+    for len_dec_seq in range(1, max(max_lengths) + 1):
+        n_active_inst = len(active_inst_idx_list)
+
+        # the decoder state caches the previous words of every beam,
+        # so only the last word of each beam is fed to the decoder
+        trg = dec_seq[:, -1].unsqueeze(1)
+        trg_mask = make_tgt_mask(trg, params.pad_token)
+        dec_output, dec_state = model.decode(
+            trg, src_enc, src_mask, trg_mask, None, dec_state)
+
+        # [n_active_inst, beam_size, vocab_size]
+        word_prob = F.log_softmax(
+            model.generator(dec_output[:, -1]).float(), dim=-1)
+        vocab_size = word_prob.size(-1)
+        word_prob = word_prob.view(n_active_inst, beam_size, vocab_size)
+
+        # keep the 2 * beam_size best extensions of the beams of each instance
+        # (at most beam_size of them end with </s>, so there are always enough to continue)
+        cand_scores = (beam_scores.unsqueeze(2) +
+                       word_prob).view(n_active_inst, -1)
+        cand_scores, cand_idx = cand_scores.topk(2 * beam_size, dim=1)
+        cand_beams = cand_idx // vocab_size
+        cand_words = cand_idx - cand_beams * vocab_size
+        cand_eos = cand_words.eq(params.eos_index)
+
+        # candidates among the top beam_size that end with </s> are finished hypotheses
+        eos_finished = cand_eos[:, :beam_size] & cand_scores[:, :beam_size].gt(
+            -float("inf"))
+        eos_positions = eos_finished.nonzero()
+        if eos_positions.size(0) > 0:
+            inst_positions, cand_ranks = eos_positions[:, 0], eos_positions[:, 1]
+            rows = inst_positions * beam_size + \
+                cand_beams[inst_positions, cand_ranks]
+            hyps = dec_seq[rows, 1:].tolist()
+            scores = (cand_scores[inst_positions, cand_ranks] /
+                      length_penalty(len_dec_seq, alpha)).tolist()
+            for inst_position, hyp, score in zip(inst_positions.tolist(), hyps, scores):
+                finished_hyps[active_inst_idx_list[inst_position]].append(
+                    (score, hyp))
+
+        # the best beam_size candidates that don't end with </s> become the new beams
+        live_scores = cand_scores.masked_fill(cand_eos, -float("inf"))
+        beam_scores, live_ranks = live_scores.topk(beam_size, dim=1)
+        beam_origins = cand_beams.gather(1, live_ranks) + beam_size * torch.arange(
+            n_active_inst, dtype=torch.long, device=device).unsqueeze(1)
+        beam_origins = beam_origins.view(-1)
+
+        # follow the backpointers of the beams
+        dec_seq = torch.cat([dec_seq.index_select(0, beam_origins),
+                             cand_words.gather(1, live_ranks).view(-1, 1)], dim=1)
+        dec_state.reorder(beam_origins)
+
+        # collect the instances that are done decoding
+        best_live_scores = None
+        expired_positions, kept_positions = [], []
+        for inst_position, inst_idx in enumerate(active_inst_idx_list):
+            if len_dec_seq >= max_lengths[inst_idx]:
+                expired_positions.append(inst_position)
+                continue
+            scores = sorted([score for score, _ in finished_hyps[inst_idx]], reverse=True)
+            if len(scores) >= n_best:
+                if best_live_scores is None:
+                    best_live_scores = beam_scores[:, 0].tolist()
+                # the log probability of a beam can only decrease, whereas its length penalty grows
+                # with its length, so the best score a beam can still reach is its current log
+                # probability normalized by the penalty of the maximum length of the instance
+                best_reachable = best_live_scores[inst_position] / \
+                    length_penalty(max_lengths[inst_idx], alpha)
+                # none of the beams can beat the n_best finished hypotheses anymore
+                if scores[n_best - 1] >= best_reachable:
+                    continue
+            kept_positions.append(inst_position)
+
+        # instances that reached their maximum length finish with their best beams
+        if expired_positions:
+            expired = torch.LongTensor(expired_positions).to(device)
+            rows = collect_beam_rows(expired)
+            hyps = dec_seq[rows, 1:].tolist()
+            scores = (beam_scores.index_select(0, expired).view(-1) /
+                      length_penalty(len_dec_seq, alpha)).tolist()
+            for i, (hyp, score) in enumerate(zip(hyps, scores)):
+                if score > -float("inf"):
+                    finished_hyps[active_inst_idx_list[expired_positions[i // beam_size]]].append(
+                        (score, hyp))
+
+        if not kept_positions:
+            break  # all instances have finished decoding
+
+        # drop the instances that are done, so the decoder will not run on them
+        if len(kept_positions) < n_active_inst:
+            kept = torch.LongTensor(kept_positions).to(device)
+            rows = collect_beam_rows(kept)
+            dec_seq = dec_seq.index_select(0, rows)
+            beam_scores = beam_scores.index_select(0, kept)
+            src_enc = src_enc.index_select(0, rows)
+            src_mask = src_mask.index_select(0, rows)
+            dec_state.reorder(rows, memory_index=rows)
+            active_inst_idx_list = [active_inst_idx_list[inst_position]
+                                    for inst_position in kept_positions]
+
+    all_hyp, all_scores = [], []
+    for hyps in finished_hyps:
+        hyps = sorted(hyps, key=lambda hyp: hyp[0], reverse=True)[:n_best]
+        all_scores.append([score for score, _ in hyps])
+        all_hyp.append([hyp for _, hyp in hyps])
+    return all_hyp, all_scores
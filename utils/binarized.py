@@ -0,0 +1,347 @@
+""" A numericalized (binarized) copy of the corpus, stored as contiguous int32 token-id arrays that are memory-mapped """
+import argparse
+import hashlib
+import io
+import json
+import math
+import os
+import shutil
+from array import array
+from collections import Counter, OrderedDict
+
+import numpy as np
+import torch
+from torchtext.vocab import Vocab
+from utils.batching import plan_batches
+
+# bump when the layout of the binarized files changes
+FORMAT_VERSION = 1
+
+# (split, side) -> extension of the text file, the test set has no references
+SPLITS = [("train", "src", "train.de"), ("train", "trg", "train.en"),
+          ("dev", "src", "dev.de"), ("dev", "trg", "dev.en"),
+          ("test", "src", "test.de")]
+
+
+def file_digest(path):
+    """
+    Compute the sha1 digest of the contents of a file
+
+    Arguments:
+        path: path of the file
+
+    Returns:
+        The hex digest of the file
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def corpus_key(data_path, max_len):
+    """
+    Build the key of the binarized corpus: it changes whenever one of the text files
+    (or the maximum length of the training pairs, which changes the vocab) changes
+
+    Arguments:
+        data_path: path of the dataset
+        max_len: max length of the training pairs
+
+    Returns:
+        A hex digest identifying the binarized corpus
+    """
+    files = {ext: file_digest(os.path.join(data_path, ext))
+             for _, _, ext in SPLITS}
+    description = json.dumps({"version": FORMAT_VERSION, "max_len": max_len, "files": files},
+                             sort_keys=True)
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+def read_pairs(src_path, trg_path):
+    """ Read the tokenized (src, trg) pairs of a parallel corpus, skipping the pairs with an empty side (as TranslationDataset does) """
+    with io.open(src_path, mode="r", encoding="utf-8") as src_file, \
+            io.open(trg_path, mode="r", encoding="utf-8") as trg_file:
+        for src_line, trg_line in zip(src_file, trg_file):
+            src_line, trg_line = src_line.strip(), trg_line.strip()
+            if src_line != "" and trg_line != "":
+                yield src_line.split(), trg_line.split()
+
+
+def read_sentences(path):
+    """ Read the tokenized sentences of a (monolingual) file, keeping the empty lines """
+    with io.open(path, mode="r", encoding="utf-8") as f:
+        for line in f:
+            yield line.split()
+
+
+def write_side(prefix, sentences, stoi, unk_index):
+    """
+    Numericalize sentences and write them as a flat int32 array of token ids (`.ids.npy`),
+    the offset of each sentence in that array (`.offsets.npy`) and its length (`.lengths.npy`)
+
+    Arguments:
+        prefix: path prefix of the files
+        sentences: iterable of sentences (lists of tokens), without the <s> and </s> tokens
+        stoi: mapping from tokens to ids
+        unk_index: id of the tokens that are not in `stoi`
+    """
+    ids, lengths = array("i"), array("i")
+    for sentence in sentences:
+        ids.extend(stoi.get(token, unk_index) for token in sentence)
+        lengths.append(len(sentence))
+
+    lengths = np.frombuffer(lengths, dtype=np.int32) if lengths else np.zeros(0, dtype=np.int32)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    np.save(prefix + ".ids.npy", np.frombuffer(ids, dtype=np.int32) if ids else np.zeros(0, dtype=np.int32))
+    np.save(prefix + ".offsets.npy", offsets)
+    np.save(prefix + ".lengths.npy", lengths)
+
+
+def binarize_corpus(data_path, max_len=100, cache_dir=None):
+    """
+    Write the numericalized train/dev/test sets of `data_path` (if they are not already cached)
+
+    The vocab is counted on the training pairs of at most `max_len` tokens, in the same way as
+    `load_dataset` builds it, and every split is written with `write_side`. The files are written
+    to a temporary directory that is renamed once complete, so a partially written corpus is never read
+
+    Arguments:
+        data_path: path of the dataset
+        max_len: max length of the training pairs
+        cache_dir: directory of the binarized corpora (defaults to `data_path`/binarized)
+
+    Returns:
+        The directory of the binarized corpus
+    """
+    cache_dir = cache_dir or os.path.join(data_path, "binarized")
+    key = corpus_key(data_path, max_len)
+    corpus_dir = os.path.join(cache_dir, key)
+    if os.path.isfile(os.path.join(corpus_dir, "meta.json")):
+        return corpus_dir
+
+    def train_pairs():
+        for src, trg in read_pairs(os.path.join(data_path, "train.de"), os.path.join(data_path, "train.en")):
+            if len(src) <= max_len and len(trg) <= max_len:
+                yield src, trg
+
+    # count the tokens of both sides of the training pairs (shared vocab)
+    counter = Counter()
+    for src, trg in train_pairs():
+        counter.update(src)
+        counter.update(trg)
+
+    # the specials of the src/trg Fields of `load_dataset` (unk, pad, init and eos tokens)
+    specials = ["<unk>", "<pad>", "<s>", "</s>"]
+    vocab = Vocab(counter, specials=specials)
+
+    tmp_dir = "{}.tmp-{}".format(corpus_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    dev_pairs = list(read_pairs(os.path.join(data_path, "dev.de"),
+                                os.path.join(data_path, "dev.en")))
+    sides = OrderedDict([
+        ("train.src", (src for src, _ in train_pairs())),
+        ("train.trg", (trg for _, trg in train_pairs())),
+        ("dev.src", (src for src, _ in dev_pairs)),
+        ("dev.trg", (trg for _, trg in dev_pairs)),
+        ("test.src", read_sentences(os.path.join(data_path, "test.de"))),
+    ])
+    for name, sentences in sides.items():
+        write_side(os.path.join(tmp_dir, name), sentences,
+                   vocab.stoi, vocab.stoi["<unk>"])
+
+    with open(os.path.join(tmp_dir, "counts.json"), "w") as f:
+        json.dump(counter, f)
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({"version": FORMAT_VERSION, "max_len": max_len, "data_path": data_path,
+                   "specials": specials}, f, indent=4)
+
+    try:
+        os.rename(tmp_dir, corpus_dir)
+    except OSError:
+        # another process (eg. another rank) binarized the same corpus in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return corpus_dir
+
+
+class BinarizedSide(object):
+    """
+    Memory-mapped token ids of one side (src or trg) of a binarized split
+
+    Arguments:
+        prefix: path prefix of the `.ids.npy`, `.offsets.npy` and `.lengths.npy` files
+    """
+
+    def __init__(self, prefix):
+        self.ids = np.load(prefix + ".ids.npy", mmap_mode="r")
+        self.offsets = np.load(prefix + ".offsets.npy", mmap_mode="r")
+        self.lengths = np.load(prefix + ".lengths.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def pad(self, indices, pad_index, sos_index, eos_index, device=None):
+        """
+        Build the padded tensor of the sentences at `indices`, with the <s> and </s> tokens
+
+        Arguments:
+            indices: indices of the sentences
+            pad_index, sos_index, eos_index: ids of the <pad>, <s> and </s> tokens
+            device: CPU/GPU device
+
+        Returns:
+            A tuple (tensor [batch_size, seq_len], lengths [batch_size]), as a torchtext Field with include_lengths=True
+        """
+        lengths = self.lengths[indices].astype(np.int64) + 2
+        tensor = np.full((len(indices), lengths.max()), pad_index, dtype=np.int64)
+        tensor[:, 0] = sos_index
+        for row, (index, length) in enumerate(zip(indices, lengths)):
+            start = self.offsets[index]
+            tensor[row, 1:length - 1] = self.ids[start:start + length - 2]
+            tensor[row, length - 1] = eos_index
+        return torch.from_numpy(tensor).to(device), torch.from_numpy(lengths).to(device)
+
+
+class TensorBatch(object):
+    """
+    A batch of a binarized split, with the same `src`/`trg` attributes as a torchtext Batch
+
+    Arguments:
+        src: tuple (src tensor [batch_size, src_seq_len], src lengths [batch_size])
+        trg: tuple (trg tensor [batch_size, trg_seq_len], trg lengths [batch_size]), None for the test set
+        indices: index (in the split) of each example of the batch
+    """
+
+    def __init__(self, src, trg=None, indices=None):
+        self.src = src
+        self.trg = trg
+        self.indices = indices
+        self.batch_size = len(src[1])
+
+    def __len__(self):
+        return self.batch_size
+
+
+class BinarizedDataset(object):
+    """
+    A binarized split (train, dev or test) of the corpus
+
+    Arguments:
+        corpus_dir: directory of the binarized corpus
+        split: name of the split
+        vocab: the vocab the corpus was numericalized with
+    """
+
+    def __init__(self, corpus_dir, split, vocab):
+        self.src = BinarizedSide(os.path.join(corpus_dir, split + ".src"))
+        trg_prefix = os.path.join(corpus_dir, split + ".trg")
+        self.trg = BinarizedSide(trg_prefix) if os.path.isfile(
+            trg_prefix + ".ids.npy") else None
+        self.special_indices = (vocab.stoi["<pad>"], vocab.stoi["<s>"], vocab.stoi["</s>"])
+
+    def __len__(self):
+        return len(self.src)
+
+    def batch(self, indices, device=None):
+        """
+        Build the batch of the examples at `indices`
+
+        Arguments:
+            indices: list of indices of the examples
+            device: CPU/GPU device
+
+        Returns:
+            A TensorBatch
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        src = self.src.pad(indices, *self.special_indices, device=device)
+        trg = self.trg.pad(indices, *self.special_indices,
+                           device=device) if self.trg is not None else None
+        return TensorBatch(src, trg, indices.tolist())
+
+
+class BinarizedIterator(object):
+    """
+    Iterator over the batches of a BinarizedDataset
+
+    For training, the batches are planned in the same way as the `DataIterator` plans them
+    (see `plan_batches`). Otherwise, the examples are taken in order, `batch_size` sentences at a time
+
+    Arguments:
+        dataset: the BinarizedDataset
+        batch_size: number of tokens (train=True) or number of sentences (train=False) in a batch
+        device: CPU/GPU device
+        train: whether the iterator is used for training
+    """
+
+    def __init__(self, dataset, batch_size, device=None, train=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.train = train
+
+        # keeps the batches of the rank in data-parallel training (set by the ShardedIterator)
+        self.shard = None
+
+    def create_batches(self):
+        """ Get the indices of the examples of each batch (of the rank, if the iterator is sharded) """
+        if not self.train:
+            batches = [list(range(start, min(start + self.batch_size, len(self.dataset))))
+                       for start in range(0, len(self.dataset), self.batch_size)]
+        else:
+            self.plan = plan_batches(self.dataset.src.lengths,
+                                     self.dataset.trg.lengths, self.batch_size)
+            batches = self.plan.batches
+        return batches if self.shard is None else list(self.shard(batches))
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def __iter__(self):
+        for indices in self.create_batches():
+            yield self.dataset.batch(indices, self.device)
+
+
+def load_binarized_dataset(data_path, SRC, TRG, train_batch_size, dev_batch_size, max_len, device):
+    """
+    Load the binarized corpus of `data_path` (binarizing it first if it is not cached)
+
+    Arguments:
+        data_path: path of the dataset
+        SRC, TRG: the src/trg Fields, whose vocab is set to the vocab of the corpus
+        train_batch_size: number of tokens in a training batch
+        dev_batch_size: number of sentences in a dev/test batch
+        max_len: max length of the training pairs
+        device: CPU/GPU device
+
+    Returns:
+        The train, dev and test BinarizedIterators
+    """
+    corpus_dir = binarize_corpus(data_path, max_len)
+    with open(os.path.join(corpus_dir, "counts.json")) as f:
+        counter = Counter(json.load(f))
+    for field in (SRC, TRG):
+        specials = list(OrderedDict.fromkeys(
+            tok for tok in [field.unk_token, field.pad_token, field.init_token, field.eos_token] if tok is not None))
+        field.vocab = field.vocab_cls(counter, specials=specials)
+
+    train_iterator = BinarizedIterator(BinarizedDataset(corpus_dir, "train", TRG.vocab),
+                                       train_batch_size, device, train=True)
+    dev_iterator = BinarizedIterator(BinarizedDataset(corpus_dir, "dev", TRG.vocab),
+                                     dev_batch_size, device)
+    test_iterator = BinarizedIterator(BinarizedDataset(corpus_dir, "test", TRG.vocab),
+                                      dev_batch_size, device)
+    return train_iterator, dev_iterator, test_iterator
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(
+        description="Write the numericalized train/dev/test sets of a dataset")
+    p.add_argument("-data_path", type=str, help="location of data")
+    p.add_argument("-max_len", type=int, default=100,
+                   help="max length of the training pairs")
+    args = p.parse_args()
+    print("Binarized corpus written to {}".format(
+        binarize_corpus(args.data_path, args.max_len)))
@@ -0,0 +1,150 @@
+""" Continuous (iteration-level) batching for greedy decoding with the Transformer """
+import torch
+from utils.utils import mixed_precision
+
+
+class ContinuousDecoder(object):
+    """
+    Greedily decode a stream of src sentences with a fixed number of decoder slots.
+
+    With a regular batch, the decoder keeps running until the longest sentence of
+    the batch is done, while the slots of the finished sentences sit idle. Here, the
+    new sentences are encoded and admitted into the free slots between two decoding
+    steps and every sentence leaves its slot as soon as it is done, so the decoder
+    keeps working on `num_slots` sentences for as long as there are sentences to translate.
+    The decoding state of the slots lives in pre-allocated buffers (see `SlotDecoderState`)
+
+    Arguments:
+        translator: Translator object wrapping the trained (Transformer) model
+        num_slots: number of sentences decoded at once
+        max_len: maximum length of the translations (including <s>)
+        max_len_a, max_len_b: limit the length of each translation to `max_len_a * src_len + max_len_b` words
+        max_src_len: expected maximum length of the src sequences (the buffers grow if needed)
+    """
+
+    def __init__(self, translator, num_slots, max_len=100, max_len_a=0.0, max_len_b=None, max_src_len=128):
+        self.translator = translator
+        self.model = translator.model
+        self.params = translator.params
+        self.num_slots = num_slots
+        self.max_len = max_len
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
+        self.max_src_len = max_src_len
+
+        # the key of the sentence held by each slot (None if the slot is free)
+        self.keys = [None] * num_slots
+
+        # number of decoding steps and number of busy slots summed over all steps
+        self.num_steps = 0
+        self.busy_slots = 0
+
+    def run(self, next_sentences):
+        """
+        Decode the sentences returned by `next_sentences` until it runs out of sentences
+
+        Arguments:
+            next_sentences: function called with the number of free slots and a `block` flag (True if
+                            every slot is free). It returns a list of at most that many (key, src sentence)
+                            pairs, where the src sentence is a list of tokens, or None if there are no
+                            sentences left to translate
+
+        Returns:
+            A generator of (key, translation) pairs, where the translation is a list of tokens.
+            The translations are generated as soon as they are done (not in the order of the sentences)
+        """
+        self.model.eval()
+        device = self.model.generator.weight.device
+        state = self.model.decoder.init_slot_state(
+            self.num_slots, self.max_len, self.max_src_len)
+
+        # words decoded by every slot (<s> first) [num_slots, max_len]
+        tokens = torch.full((self.num_slots, self.max_len), self.params.pad_token,
+                            dtype=torch.long, device=device)
+
+        # maximum number of words to decode and whether the slot holds a sentence [num_slots]
+        max_lengths = torch.zeros(
+            self.num_slots, dtype=torch.long, device=device)
+        active = torch.zeros(self.num_slots, dtype=torch.bool, device=device)
+
+        self.keys = [None] * self.num_slots
+        exhausted = False
+        with torch.no_grad(), mixed_precision(getattr(self.params, "bf16", False)):
+            while True:
+                free_slots = [slot for slot, key in enumerate(
+                    self.keys) if key is None]
+                if free_slots and not exhausted:
+                    sentences = next_sentences(
+                        len(free_slots), block=len(free_slots) == self.num_slots)
+                    if sentences is None:
+                        exhausted = True
+                    elif sentences:
+                        slots = free_slots[:len(sentences)]
+                        self.admit(state, tokens, max_lengths,
+                                   active, slots, sentences)
+
+                if not active.any():
+                    if exhausted:
+                        return
+                    continue
+
+                # every slot feeds its last decoded word
+                trg = tokens.gather(1, state.positions.unsqueeze(1))
+                output, state = self.model.decode(
+                    trg, None, state.memory_mask(), None, None, state)
+
+                # [num_slots]
+                next_word = torch.argmax(
+                    self.model.generator(output[:, -1]), dim=-1)
+
+                # only the busy slots move to their next position
+                state.positions += active.long()
+                tokens.scatter_(1, state.positions.unsqueeze(1),
+                                next_word.unsqueeze(1))
+
+                self.num_steps += 1
+                self.busy_slots += int(active.sum())
+
+                finished = active & (next_word.eq(self.params.eos_index) |
+                                     state.positions.ge(max_lengths))
+                if finished.any():
+                    finished_slots = finished.nonzero().view(-1)
+                    for slot in finished_slots.tolist():
+                        length = int(state.positions[slot])
+                        translation = self.translator.batch_reverse_tokenization(
+                            [tokens[slot, 1:length + 1].tolist()])[0]
+                        key, self.keys[slot] = self.keys[slot], None
+                        yield key, translation
+                    active[finished_slots] = False
+                    state.release(finished_slots)
+
+    def admit(self, state, tokens, max_lengths, active, slots, sentences):
+        """
+        Encode the new sentences and admit them into the free `slots`
+
+        Arguments:
+            state: SlotDecoderState
+            tokens, max_lengths, active: per-slot buffers of `run`
+            slots: list of free slots
+            sentences: list of (key, src sentence) pairs (as many as `slots`)
+        """
+        src, src_lengths = self.params.SRC.process(
+            [sentence for _, sentence in sentences], device=tokens.device)
+        src_mask = (src != self.params.pad_token).unsqueeze(-2)
+        encoder_output, _ = self.model.encode(src, src_mask, src_lengths)
+
+        slots_index = torch.tensor(slots, dtype=torch.long, device=tokens.device)
+        self.model.decoder.fill_slots(
+            state, slots_index, encoder_output, src_mask)
+
+        tokens[slots_index] = self.params.pad_token
+        tokens[slots_index, 0] = self.params.sos_index
+        max_lengths[slots_index] = self.translator.max_decode_lengths(
+            src_lengths, self.max_len, self.max_len_a, self.max_len_b).to(tokens.device)
+        active[slots_index] = True
+        for slot, (key, _) in zip(slots, sentences):
+            self.keys[slot] = key
+
+    def occupancy(self):
+        """ Average fraction of busy slots per decoding step """
+        return self.busy_slots / max(1, self.num_steps * self.num_slots)
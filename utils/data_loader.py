@@ -1,7 +1,15 @@
 from torchtext import data, datasets
 from torchtext.data import Field, BucketIterator, Iterator
+from torchtext.vocab import Vocab
+from collections import Counter
 import torch
 import math
+import json
+import sys
+import numpy as np
+from utils.batching import plan_batches
+from utils.binarized import BinarizedDataset, load_binarized_dataset
+from utils.data_stream import StreamingDataIterator, find_shards
 
 # Why BucketIterator doesn't do us justice?
 # Often the sentences aren't of the same length at all, and you
@@ -19,72 +27,147 @@ import math
 # thus we need to patch the current torch text iterators
 # to define a more efficient iterator
 
-# code from http://nlp.seas.harvard.edu/2018/04/03/attention.html
+# batching matters a ton for speed. We want to have very
+# evenly divided batches with absolute minimal padding
+# This code patches their default batching to plan token-budgeted
+# batches from the lengths of all the examples at once (see `plan_batches`)
+class DataIterator(data.Iterator):
+    # keeps the batches of the rank in data-parallel training (set by the ShardedIterator),
+    # so that only these batches are numericalized. None keeps all the batches
+    shard = None
+
+    def create_batches(self):
+        # the examples are shuffled by `data()` if shuffle=True
+        examples = list(self.data())
+        src_lengths = np.fromiter((len(example.src) for example in examples),
+                                  dtype=np.int64, count=len(examples))
+        trg_lengths = np.fromiter((len(example.trg) for example in examples),
+                                  dtype=np.int64, count=len(examples))
+        self.plan = plan_batches(
+            src_lengths, trg_lengths, self.batch_size, shuffle=self.train)
+        batches = self.plan if self.shard is None else self.shard(self.plan)
+        self.batches = [[examples[i] for i in batch] for batch in batches]
 
-global max_src_in_batch, max_tgt_in_batch
 
+class InferenceIterator(object):
+    """
+    Iterator to translate a dev/test `Dataset` in token-budgeted batches
+
+    The examples are sorted by source length and grouped into batches of at most
+    `max_tokens` source tokens (padding included). The budget is divided by the beam
+    width, since every sentence is expanded into `beam_width` hypotheses during
+    beam search. Each batch carries the `indices` of its examples in the dataset,
+    so that the translations can be put back in the order of the dev/test file
 
-def batch_size_fn(new, count, sofar):
-    """ 
-    Keep augmenting batch and calculate the total number of tokens + padding 
     Arguments:
-        new: new example to add
-        count: current count of examples in the batch
-        sofar: current effecctive batch size
+        dataset: the dev/test Dataset (or BinarizedDataset)
+        max_tokens: maximum number of (padded) source tokens in a batch
+        beam_width: size of the beam used to decode the batches (1 for greedy decoding)
+        device: CPU/GPU device
     """
-    global max_src_in_batch, max_tgt_in_batch
-    if count == 1:
-        max_src_in_batch = 0
-        max_tgt_in_batch = 0
-    max_src_in_batch = max(max_src_in_batch, len(new.src) + 2)
-    max_tgt_in_batch = max(max_tgt_in_batch, len(new.trg) + 2)
-    src_elements = count * max_src_in_batch
-    tgt_elements = count * max_tgt_in_batch
-    return max(src_elements, tgt_elements)
 
+    def __init__(self, dataset, max_tokens, beam_width=1, device=None):
+        self.dataset = dataset
+        self.device = device
+        self.batch_indices = self.create_batches(max_tokens, beam_width)
 
-# batching matters a ton for speed. We want to have very
-# evenly divided batches with absolute minimal padding
-# This code patches their default batching to make sure we searh over enough sentences
-# to bind tight batches
-class DataIterator(data.Iterator):
-    def create_batches(self):
-        if self.train:
-            def pool(d, random_shufler):
-                for p in data.batch(d, self.batch_size * 100):
-                    p_batch = data.batch(
-                        sorted(p, key=self.sort_key),
-                        self.batch_size, self.batch_size_fn
-                    )
-                    for b in random_shufler(list(p_batch)):
-                        yield b
-            self.batches = pool(self.data(), self.random_shuffler)
+    def create_batches(self, max_tokens, beam_width):
+        """ Group the example indices into length-sorted, token-budgeted batches """
+        # length of the src sequences including the <s> and </s> tokens
+        if isinstance(self.dataset, BinarizedDataset):
+            lengths = (self.dataset.src.lengths + 2).tolist()
         else:
-            self.batches = []
-            for b in data.batch(self.data(), self.batch_size, self.batch_size_fn):
-                self.batches.append(sorted(sorted(b, key=self.sort_key)))
+            lengths = [len(example.src) + 2 for example in self.dataset]
+        order = sorted(range(len(lengths)),
+                       key=lambda i: lengths[i], reverse=True)
 
+        batches, batch = [], []
+        for i in order:
+            # the examples are sorted by decreasing length, so the first
+            # example of a batch determines its padded length
+            if batch and (len(batch) + 1) * lengths[batch[0]] * beam_width > max_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
 
-def load_dataset(data_path, train_batch_size=4096, dev_batch_size=1, max_len=100):
-    """
-    This assumes that the data is already pre-processed using Moses Tokenizer
-    Returns iterators for the training/dev dataset
+    def __len__(self):
+        return len(self.batch_indices)
+
+    def __iter__(self):
+        for indices in self.batch_indices:
+            if isinstance(self.dataset, BinarizedDataset):
+                yield self.dataset.batch(indices, self.device)
+                continue
+            batch = data.Batch([self.dataset[i] for i in indices],
+                               self.dataset, self.device)
+            batch.indices = indices
+            yield batch
 
-    Arguments:
-        data_path: path of the dataset
-        train_batch_size: batch size of the training data (defined in terms of number of tokens or sentences, depending on the model_type)
-        dev_batch_size: batch size of the dev data (usually one)
-        max_len: max length of sequeences in a batch
-    """
 
+def make_fields():
+    """ Make the src/trg Fields (the sentences are already tokenized, so they are split on whitespace) """
     SRC = Field(tokenize=lambda s: s.split(), init_token="<s>",
                 eos_token="</s>", batch_first=True, include_lengths=True)
     TRG = Field(tokenize=lambda s: s.split(), init_token="<s>",
                 eos_token="</s>", batch_first=True, include_lengths=True)
+    return SRC, TRG
 
-    # create a TranslationDataset for both the train and dev set
-    train_data = datasets.TranslationDataset(exts=("train.de", "train.en"), fields=(
-        SRC, TRG), path=data_path, filter_pred=lambda x: len(vars(x)['src']) <= max_len and len(vars(x)['trg']) <= max_len)
+
+def save_vocab(vocab_path, SRC, TRG):
+    """
+    Save the vocabs of the src/trg Fields (and the indices of the special tokens) to a json file,
+    so that a trained model can be loaded without rebuilding the vocab from the training data
+
+    Arguments:
+        vocab_path: path of the json file (eg. model_dir/vocab.json)
+        SRC, TRG: the src/trg Fields
+    """
+    vocab = {
+        "src_itos": SRC.vocab.itos,
+        "trg_itos": TRG.vocab.itos,
+        "unk_index": TRG.vocab.stoi[TRG.unk_token],
+        "pad_index": TRG.vocab.stoi[TRG.pad_token],
+        "sos_index": TRG.vocab.stoi[TRG.init_token],
+        "eos_index": TRG.vocab.stoi[TRG.eos_token],
+    }
+    with open(vocab_path, "w") as f:
+        json.dump(vocab, f)
+
+
+def load_vocab(vocab_path):
+    """
+    Load the vocabs saved by `save_vocab`
+
+    Arguments:
+        vocab_path: path of the json file
+
+    Returns:
+        The src/trg Fields with their vocab
+    """
+    with open(vocab_path) as f:
+        vocab = json.load(f)
+
+    SRC, TRG = make_fields()
+    for field, itos in [(SRC, vocab["src_itos"]), (TRG, vocab["trg_itos"])]:
+        # all the words are passed as specials, so that they keep their index (and unknown words map to <unk>)
+        field.vocab = field.vocab_cls(Counter(), specials=itos)
+        assert field.vocab.stoi[field.unk_token] == vocab["unk_index"]
+    return SRC, TRG
+
+
+def load_eval_dataset(data_path, SRC, TRG, dev_batch_size=1):
+    """
+    Returns iterators for the dev/test dataset, numericalized with the vocab of the given Fields
+
+    Arguments:
+        data_path: path of the dataset
+        SRC, TRG: the src/trg Fields (with their vocab)
+        dev_batch_size: batch size of the dev/test data (usually one)
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     dev_data = datasets.TranslationDataset(
         exts=("dev.de", "dev.en"), fields=(SRC, TRG), path=data_path)
@@ -99,29 +182,76 @@ def load_dataset(data_path, train_batch_size=4096, dev_batch_size=1, max_len=100
 
     test_data = data.Dataset(test_examples, fields=[("src", SRC)])
 
+    # use a regular Iterator since we want to be able to compare
+    # our translations to a gold standard file. If we use a
+    # `DataIterator` then we will get our translations in shuffled/random
+    # order
+    dev_iterator = Iterator(dev_data, batch_size=dev_batch_size,
+                            train=False, sort=False, repeat=False, device=device)
+
+    # create Test Iterator for the test data
+    test_iterator = Iterator(
+        test_data, batch_size=dev_batch_size, train=False, sort=False, repeat=False, device=device)
+
+    return dev_iterator, test_iterator
+
+
+def load_dataset(data_path, train_batch_size=4096, dev_batch_size=1, max_len=100, binarized=False, stream_buffer=0):
+    """
+    This assumes that the data is already pre-processed using Moses Tokenizer
+    Returns iterators for the training/dev dataset
+
+    Arguments:
+        data_path: path of the dataset
+        train_batch_size: batch size of the training data (defined in terms of number of tokens or sentences, depending on the model_type)
+        dev_batch_size: batch size of the dev/test data (usually one)
+        max_len: max length of sequeences in a batch
+        binarized: read the numericalized copy of the dataset (see `utils.binarized`), which is
+                   written the first time and memory-mapped afterwards, instead of the text files
+        stream_buffer: if > 0, stream the training data from disk through a buffer of `stream_buffer` pairs
+                       (see `StreamingDataIterator`) instead of loading it in memory
+    """
+
+    SRC, TRG = make_fields()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    if binarized:
+        train_iterator, dev_iterator, test_iterator = load_binarized_dataset(
+            data_path, SRC, TRG, train_batch_size, dev_batch_size, max_len, device)
+        return train_iterator, dev_iterator, test_iterator, SRC, TRG
+
+    if stream_buffer > 0:
+        train_iterator = StreamingDataIterator(find_shards(data_path), SRC, TRG, train_batch_size,
+                                               buffer_size=stream_buffer, max_len=max_len, device=device)
+
+        # the vocab is counted while the corpus is read (the src and trg sides share the same vocab)
+        SRC.build_vocab(train_iterator.sentences(0),
+                        train_iterator.sentences(1))
+        TRG.vocab = SRC.vocab
+
+        dev_iterator, test_iterator = load_eval_dataset(
+            data_path, SRC, TRG, dev_batch_size)
+        return train_iterator, dev_iterator, test_iterator, SRC, TRG
+
+    # create a TranslationDataset for the train set
+    train_data = datasets.TranslationDataset(exts=("train.de", "train.en"), fields=(
+        SRC, TRG), path=data_path, filter_pred=lambda x: len(vars(x)['src']) <= max_len and len(vars(x)['trg']) <= max_len)
+
     # build he vocab using the training data
     SRC.build_vocab(train_data.src, train_data.trg)
     TRG.build_vocab(train_data.src, train_data.trg)
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
     # use custom DataIterator in order to minimize padding in a sequence
     # and inoder to `pack` a batch fully inorder to maximmize the computation
     # in a GPU
     train_iterator = DataIterator(train_data, batch_size=train_batch_size, device=device,
                                   repeat=False, sort_key=lambda x: (len(x.src), len(x.trg)),
-                                  batch_size_fn=batch_size_fn, train=True, sort_within_batch=True, shuffle=True)
-
-    # use a regular Iterator since we want to be able to compare
-    # our translations to a gold standard file. If we use a
-    # `DataIterator` then we will get our translations in shuffled/random
-    # order
-    dev_iterator = Iterator(dev_data, batch_size=dev_batch_size,
-                            train=False, sort=False, repeat=False, device=device)
+                                  train=True, sort_within_batch=True, shuffle=True)
 
-    # create Test Iterator for the test data
-    test_iterator = Iterator(
-        test_data, batch_size=1, train=False, sort=False, repeat=False, device=device)
+    dev_iterator, test_iterator = load_eval_dataset(
+        data_path, SRC, TRG, dev_batch_size)
 
-    print(len(test_iterator))
+    # stderr, so it never mixes with the translations written to stdout in -stream mode
+    print(len(test_iterator), file=sys.stderr)
     return train_iterator, dev_iterator, test_iterator, SRC, TRG
@@ -0,0 +1,108 @@
+""" A training data iterator that streams the corpus from disk, for corpora that do not fit in memory """
+import glob
+import os
+import random
+from utils.batching import plan_batches
+from utils.binarized import TensorBatch, read_pairs
+
+
+def find_shards(data_path):
+    """
+    Find the shards of the training data: every `train*.de` file of `data_path` with its `.en` counterpart
+    (eg. train.de/train.en and train.bt.de/train.bt.en for back-translated data)
+
+    Arguments:
+        data_path: path of the dataset
+
+    Returns:
+        A list of (src_path, trg_path) pairs
+    """
+    shards = []
+    for src_path in sorted(glob.glob(os.path.join(data_path, "train*.de"))):
+        trg_path = src_path[:-len(".de")] + ".en"
+        if os.path.isfile(trg_path):
+            shards.append((src_path, trg_path))
+    return shards
+
+
+class StreamingDataIterator(object):
+    """
+    Iterator over the token-budgeted batches of a training corpus that is read from disk as it is consumed
+
+    The (src, trg) pairs of the shards are read line by line into a buffer of `buffer_size` pairs.
+    Every time the buffer is full, it is grouped into batches with `plan_batches` (as the `DataIterator`
+    does with the whole dataset) and emptied, so at most `buffer_size` pairs are in memory, whatever
+    the size of the corpus. The order of the shards is shuffled at every epoch, but the pairs are only
+    shuffled within a buffer, so the lines of each shard should be shuffled once when the shard is written
+
+    Arguments:
+        shards: list of (src_path, trg_path) pairs
+        SRC, TRG: the src/trg Fields (with their vocab) used to numericalize the batches
+        batch_size: maximum number of (padded) tokens in a batch
+        buffer_size: number of pairs that are sorted and batched together
+        max_len: pairs with a longer src or trg sequence are skipped
+        device: CPU/GPU device
+    """
+
+    def __init__(self, shards, SRC, TRG, batch_size, buffer_size=100000, max_len=100, device=None):
+        self.shards = shards
+        self.SRC = SRC
+        self.TRG = TRG
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.max_len = max_len
+        self.device = device
+
+        # keeps the batches of the rank in data-parallel training (set by the ShardedIterator)
+        self.shard = None
+
+    def pairs(self, shuffle=True):
+        """
+        Read the (src, trg) pairs of the shards (the pairs with an empty or a too long side are skipped)
+
+        Arguments:
+            shuffle: whether the shards are read in a random order
+
+        Returns:
+            A generator of (src, trg) pairs of lists of tokens
+        """
+        shards = list(self.shards)
+        if shuffle:
+            random.shuffle(shards)
+        for src_path, trg_path in shards:
+            for src, trg in read_pairs(src_path, trg_path):
+                if len(src) <= self.max_len and len(trg) <= self.max_len:
+                    yield src, trg
+
+    def sentences(self, side):
+        """
+        Read the sentences of one side of the corpus (eg. to build the vocab)
+
+        Arguments:
+            side: 0 for the src sentences, 1 for the trg sentences
+
+        Returns:
+            A generator of lists of tokens
+        """
+        for pair in self.pairs(shuffle=False):
+            yield pair[side]
+
+    def buffer_batches(self, buffer):
+        """ Group the pairs of the buffer into numericalized batches (only the batches of the rank, if sharded) """
+        src_lengths = [len(src) for src, _ in buffer]
+        trg_lengths = [len(trg) for _, trg in buffer]
+        batches = plan_batches(src_lengths, trg_lengths, self.batch_size)
+        for indices in batches if self.shard is None else self.shard(batches):
+            src = self.SRC.process([buffer[i][0] for i in indices], device=self.device)
+            trg = self.TRG.process([buffer[i][1] for i in indices], device=self.device)
+            yield TensorBatch(src, trg)
+
+    def __iter__(self):
+        buffer = []
+        for pair in self.pairs():
+            buffer.append(pair)
+            if len(buffer) == self.buffer_size:
+                yield from self.buffer_batches(buffer)
+                buffer = []
+        if buffer:
+            yield from self.buffer_batches(buffer)
@@ -0,0 +1,126 @@
+""" Utilities for multi-process data-parallel training with torch.distributed """
+import torch
+import torch.distributed as dist
+
+
+class ShardedIterator(object):
+    """
+    Give each process (rank) its own shard of the batches of a DataIterator
+
+    Every rank plans the same sequence of batches (the data iterators of all the ranks are
+    shuffled with the same seed) and keeps every `world_size`-th batch, starting at its `rank`.
+    The batches are taken in groups of `world_size`, so that all the ranks go through the same
+    number of batches (a last incomplete group is dropped) and stay in lockstep when the
+    gradients are all-reduced
+
+    The training iterators (DataIterator, BinarizedIterator, StreamingDataIterator) shard their plan
+    of example indices (see their `shard` attribute), so every rank only builds and numericalizes
+    its own batches. The batches of other iterators are built by every rank and then sharded
+
+    Arguments:
+        data_iter: the DataIterator to shard
+        rank: rank of the process
+        world_size: number of processes
+    """
+
+    def __init__(self, data_iter, rank, world_size):
+        self.data_iter = data_iter
+        self.rank = rank
+        self.world_size = world_size
+
+    def shard(self, batches):
+        """ Keep the batches of the rank (eg. the batches of the data iterator, or the indices of their examples) """
+        group = []
+        for batch in batches:
+            group.append(batch)
+            if len(group) == self.world_size:
+                yield group[self.rank]
+                group = []
+
+    def __iter__(self):
+        if not hasattr(self.data_iter, "shard"):
+            yield from self.shard(self.data_iter)
+            return
+
+        self.data_iter.shard = self.shard
+        try:
+            yield from self.data_iter
+        finally:
+            self.data_iter.shard = None
+
+
+class NullSummaryWriter(object):
+    """ SummaryWriter of the ranks other than 0 (only rank 0 writes to TensorBoard) """
+
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+    def add_text(self, *args, **kwargs):
+        pass
+
+
+def all_reduce_gradients(model):
+    """
+    Sum the gradients of the parameters of `model` over all the processes.
+    The gradients are flattened into a single buffer so that only one all-reduce is needed
+
+    Arguments:
+        model: the pytorch model (the same on every process)
+    """
+    grads = [p.grad.data for p in model.parameters() if p.grad is not None]
+    if not grads:
+        return
+    flat_grads = torch.cat([grad.contiguous().view(-1) for grad in grads])
+    dist.all_reduce(flat_grads)
+
+    offset = 0
+    for grad in grads:
+        numel = grad.numel()
+        grad.copy_(flat_grads[offset:offset + numel].view_as(grad))
+        offset += numel
+
+
+def all_reduce_sum(values):
+    """
+    Sum a list of numbers over all the processes. The 0-dim tensors are reduced as they
+    are (not converted to Python numbers), so this does not wait for them to be computed
+
+    Arguments:
+        values: list of numbers or 0-dim tensors (eg. loss, number of target tokens)
+
+    Returns:
+        The list of summed values (0-dim double tensors)
+    """
+    tensor = torch.stack([torch.as_tensor(value, dtype=torch.double)
+                          for value in values])
+    dist.all_reduce(tensor)
+    return list(tensor.unbind())
+
+
+def broadcast_value(value, src=0):
+    """
+    Send a number from the process `src` to all the processes
+
+    Arguments:
+        value: the number to send (ignored on the processes other than `src`)
+        src: rank of the process that sends the number
+
+    Returns:
+        The number of the process `src`
+    """
+    tensor = torch.tensor([value], dtype=torch.double)
+    dist.broadcast(tensor, src)
+    return tensor.item()
+
+
+def broadcast_parameters(model, src=0):
+    """
+    Copy the parameters of `model` in the process `src` to all the processes,
+    so that every process starts training from the same weights
+
+    Arguments:
+        model: the pytorch model
+        src: rank of the process whose parameters are copied
+    """
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, src)
@@ -1,4 +1,5 @@
 """ Implementation of LabelSmoothingLoss from OpenNMT """
+import math
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -43,3 +44,50 @@ class LabelSmoothingLoss(nn.Module):
         model_prob.scatter_(1, target.unsqueeze(1), self.confidence)
         model_prob.masked_fill_((target == self.pad_index).unsqueeze(1), 0)
         return F.kl_div(output, model_prob.type(torch.DoubleTensor), reduction='sum')
+
+
+class FusedLabelSmoothingLoss(nn.Module):
+    """
+    Computes the same loss as LabelSmoothingLoss directly from the log probabilities,
+    without building the dense [batch_size * seq_len, tgt_vocab_size] smoothed distribution q.
+
+    For a (non padding) target word g, q puts `confidence` on g, 0 on the padding token
+    and `smoothing_value` on every other word, so the KL-Divergence of the row is
+
+        sum(q * log(q)) - confidence * lp[g] - smoothing_value * (sum(lp) - lp[g] - lp[pad])
+
+    where the first term is a constant. Only a gather and a row-sum over the log probabilities
+    are needed, and the loss stays in the dtype and on the device of the model outputs
+    """
+
+    def __init__(self, label_smoothing, tgt_vocab_size, pad_index):
+        assert 0.0 <= label_smoothing <= 1.0, "Label Smoothing parameter must between 0 and 1"
+        super().__init__()
+        self.pad_index = pad_index
+        # (-2 to account for padding token)
+        self.smoothing_value = label_smoothing / (tgt_vocab_size - 2)
+        self.confidence = 1.0 - label_smoothing
+
+        # sum(q * log(q)) of a (non padding) row, with 0 * log(0) = 0
+        self.entropy_term = 0.0
+        if self.confidence > 0:
+            self.entropy_term += self.confidence * math.log(self.confidence)
+        if self.smoothing_value > 0:
+            self.entropy_term += (tgt_vocab_size - 2) * \
+                self.smoothing_value * math.log(self.smoothing_value)
+
+    def forward(self, output, target):
+        """
+        output (FloatTensor): [batch_size * seq_len,  trg_vocab_size] log probabilities
+        target (Long Tensor): [batch_size * seq_len]
+        """
+        non_pad = target.ne(self.pad_index)
+
+        # [batch_size * seq_len]
+        gold_log_prob = output.gather(1, target.unsqueeze(1)).squeeze(1)
+        smoothed_log_prob = output.sum(
+            dim=1) - gold_log_prob - output[:, self.pad_index]
+
+        loss = self.entropy_term - self.confidence * gold_log_prob - \
+            self.smoothing_value * smoothed_log_prob
+        return loss.masked_select(non_pad).sum()
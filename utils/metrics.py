@@ -0,0 +1,87 @@
+""" Low-overhead training metrics that are aggregated on the device and written from a background thread """
+import math
+import queue
+import threading
+import time
+
+
+class TrainingMetrics(object):
+    """
+    Accumulate the loss and the number of target tokens of the training steps without
+    synchronizing with the device (the statistics stay in tensors) and write their average
+    over every `flush_every` steps to TensorBoard from a background thread, along with the
+    learning rate and the number of target tokens processed per second
+
+    Arguments:
+        summary_writer: TensorBoard SummaryWriter (or NullSummaryWriter)
+        flush_every: number of optimizer steps between two writes
+    """
+
+    def __init__(self, summary_writer, flush_every=100):
+        self.summary_writer = summary_writer
+        self.flush_every = flush_every
+
+        # (summed) loss and number of target tokens of the steps since the last flush
+        self.window_loss = 0.0
+        self.window_words = 0
+        self.window_steps = 0
+        self.window_start = time.time()
+        self.lr = None
+
+        self.pending = queue.Queue()
+        self.writer = threading.Thread(target=self.write_metrics)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def step(self, iteration, loss, words, lr=None):
+        """
+        Record an optimizer step
+
+        Arguments:
+            iteration: number of optimizer steps so far
+            loss: (summed) loss of the step (a tensor, or a number)
+            words: number of (non pad) target tokens of the step (a tensor, or a number)
+            lr: learning rate of the step (if any)
+        """
+        self.window_loss = self.window_loss + loss
+        self.window_words = self.window_words + words
+        self.window_steps += 1
+        self.lr = lr
+        if self.window_steps == self.flush_every:
+            self.flush(iteration)
+
+    def flush(self, iteration):
+        """ Hand the statistics of the current window to the background thread and start a new window """
+        if self.window_steps == 0:
+            return
+        now = time.time()
+        self.pending.put((iteration, self.window_loss, self.window_words,
+                          self.lr, now - self.window_start))
+        self.window_loss, self.window_words, self.window_steps = 0.0, 0, 0
+        self.window_start = now
+
+    def write_metrics(self):
+        """ Write the windows of statistics to TensorBoard (runs in the background thread) """
+        while True:
+            window = self.pending.get()
+            if window is None:
+                return
+            iteration, loss, words, lr, elapsed = window
+
+            # only this thread waits for the values of the tensors
+            loss, words = float(loss), float(words)
+            loss_per_word = loss / max(words, 1)
+            self.summary_writer.add_scalar(
+                "train/loss_per_iteration", loss_per_word, iteration)
+            self.summary_writer.add_scalar(
+                "train/perplexity_per_iteration", math.exp(loss_per_word), iteration)
+            self.summary_writer.add_scalar(
+                "train/tokens_per_sec", words / max(elapsed, 1e-6), iteration)
+            if lr is not None:
+                self.summary_writer.add_scalar("train/lr", lr, iteration)
+
+    def close(self, iteration):
+        """ Write the last (incomplete) window and wait for the background thread """
+        self.flush(iteration)
+        self.pending.put(None)
+        self.writer.join()
@@ -0,0 +1,161 @@
+""" Sequence packing: several (src, trg) pairs are concatenated into each row of a batch to avoid padding """
+import torch
+from utils.prefetch import PreparedBatch
+from utils.utils import mask_invalid_positions
+
+
+def segment_masks(src_segments, trg_segments):
+    """
+    Make the attention masks of packed sequences, where a token only attends to the tokens of its own segment
+
+    Arguments:
+        src_segments: segment of each src token [batch_size, src_seq_len] (1, 2, ... within a row, 0 for padding)
+        trg_segments: segment of each trg token [batch_size, trg_seq_len]
+
+    Returns:
+        A tuple (src_mask [batch_size, src_seq_len, src_seq_len] of the Encoder self-attention,
+                 trg_mask [batch_size, trg_seq_len, trg_seq_len] of the Decoder self-attention (block-diagonal and causal),
+                 memory_mask [batch_size, trg_seq_len, src_seq_len] of the encoder-decoder attention)
+    """
+    src_valid = (src_segments != 0).unsqueeze(1)
+    trg_valid = (trg_segments != 0).unsqueeze(1)
+
+    src_mask = (src_segments.unsqueeze(2) == src_segments.unsqueeze(1)) & src_valid
+    trg_mask = (trg_segments.unsqueeze(2) == trg_segments.unsqueeze(1)) & trg_valid
+    trg_mask = trg_mask & mask_invalid_positions(
+        trg_segments.size(1)).type_as(trg_mask).to(trg_mask.device)
+    memory_mask = (trg_segments.unsqueeze(2) == src_segments.unsqueeze(1)) & src_valid
+    return src_mask, trg_mask, memory_mask
+
+
+class PackedBatch(PreparedBatch):
+    """
+    A batch where every row holds several (src, trg) pairs (the segments of the row) one after another.
+    The masks confine the attention of every token to its own segment (and the trg segment to its own
+    src segment) and the positions restart at 0 at the beginning of every segment
+
+    Arguments:
+        src: tuple (src tensor [batch_size, src_seq_len], number of src tokens of each row [batch_size])
+        trg: tuple (trg tensor [batch_size, trg_seq_len], number of trg tokens of each row [batch_size])
+        src_segments, trg_segments: segment of each token [batch_size, seq_len] (1, 2, ... within a row, 0 for padding)
+        src_positions, trg_positions: position of each token in its segment [batch_size, seq_len]
+    """
+
+    def __init__(self, src, trg, src_segments, trg_segments, src_positions, trg_positions):
+        src_mask, trg_mask, memory_mask = segment_masks(
+            src_segments, trg_segments)
+        super().__init__(src, trg, src_mask, trg_mask)
+        self.memory_mask = memory_mask
+        self.src_positions = src_positions
+        self.trg_positions = trg_positions
+
+        # the first token (<s>) of a segment is not predicted from the last token of the previous segment
+        self.segment_starts = (trg_positions == 0) & (trg_segments != 0)
+
+    def model_inputs(self):
+        """ Keyword arguments of `EncoderDecoder.forward` for the packed batch """
+        return {"memory_mask": self.memory_mask, "src_positions": self.src_positions,
+                "trg_positions": self.trg_positions}
+
+
+def scatter_segments(tokens, lengths, rows, offsets, segments, num_rows, row_len, pad_index):
+    """
+    Copy the (unpadded) sequences of a batch into the rows of a packed batch
+
+    Arguments:
+        tokens: padded sequences [batch_size, seq_len]
+        lengths: length of each sequence [batch_size]
+        rows, offsets, segments: row, offset in the row and segment of each sequence [batch_size]
+        num_rows, row_len: size of the packed batch
+        pad_index: id of the padding token
+
+    Returns:
+        A tuple (packed tokens, segments, positions), each one of shape [num_rows, row_len]
+    """
+    steps = torch.arange(tokens.size(1), device=tokens.device).unsqueeze(0)
+    valid = steps < lengths.unsqueeze(1)
+    token_rows = rows.unsqueeze(1).expand_as(tokens)[valid]
+    token_cols = (offsets.unsqueeze(1) + steps)[valid]
+
+    packed = tokens.new_full((num_rows, row_len), pad_index)
+    packed[token_rows, token_cols] = tokens[valid]
+    packed_segments = tokens.new_zeros((num_rows, row_len))
+    packed_segments[token_rows, token_cols] = segments.unsqueeze(1).expand_as(tokens)[valid]
+    positions = tokens.new_zeros((num_rows, row_len))
+    positions[token_rows, token_cols] = steps.expand_as(tokens)[valid]
+    return packed, packed_segments, positions
+
+
+class PackingIterator(object):
+    """
+    Pack the batches of a data iterator: the (src, trg) pairs of each batch are placed first-fit (in the
+    order of the batch, ie. by decreasing length) into rows of at least `pack_len` src and trg tokens
+    (or of the padded length of the batch, if longer), so a batch of short pairs becomes a few dense rows
+
+    The iterator also counts the (src and trg) tokens of the batches, and the size of the padded batches
+    before and after packing
+
+    Arguments:
+        data_iter: the data iterator (its batches must have `src` and `trg` attributes with lengths)
+        pad_index: id of the padding token
+        pack_len: minimum length of the packed rows
+    """
+
+    def __init__(self, data_iter, pad_index, pack_len):
+        self.data_iter = data_iter
+        self.pad_index = pad_index
+        self.pack_len = pack_len
+        self.num_tokens = 0
+        self.num_padded = 0
+        self.num_packed = 0
+
+    def pack(self, batch):
+        """ Pack a batch into a PackedBatch """
+        src, src_lengths = batch.src
+        trg, trg_lengths = batch.trg
+        src_len, trg_len = max(self.pack_len, src.size(1)), max(self.pack_len, trg.size(1))
+
+        # [src tokens, trg tokens, segments] of each row
+        rows = []
+        example_rows, src_offsets, trg_offsets, segments = [], [], [], []
+        for n_src, n_trg in zip(src_lengths.tolist(), trg_lengths.tolist()):
+            for index, row in enumerate(rows):
+                if row[0] + n_src <= src_len and row[1] + n_trg <= trg_len:
+                    break
+            else:
+                index, row = len(rows), [0, 0, 0]
+                rows.append(row)
+            example_rows.append(index)
+            src_offsets.append(row[0])
+            trg_offsets.append(row[1])
+            row[0], row[1], row[2] = row[0] + n_src, row[1] + n_trg, row[2] + 1
+            segments.append(row[2])
+
+        device = src.device
+        example_rows = torch.tensor(example_rows, device=device)
+        segments = torch.tensor(segments, device=device)
+        src_row_lengths = torch.tensor([row[0] for row in rows], device=device)
+        trg_row_lengths = torch.tensor([row[1] for row in rows], device=device)
+
+        packed_src, src_segments, src_positions = scatter_segments(
+            src, src_lengths, example_rows, torch.tensor(src_offsets, device=device), segments,
+            len(rows), int(src_row_lengths.max()), self.pad_index)
+        packed_trg, trg_segments, trg_positions = scatter_segments(
+            trg, trg_lengths, example_rows, torch.tensor(trg_offsets, device=device), segments,
+            len(rows), int(trg_row_lengths.max()), self.pad_index)
+
+        self.num_tokens += int(src_lengths.sum()) + int(trg_lengths.sum())
+        self.num_padded += src.numel() + trg.numel()
+        self.num_packed += packed_src.numel() + packed_trg.numel()
+        return PackedBatch((packed_src, src_row_lengths), (packed_trg, trg_row_lengths),
+                           src_segments, trg_segments, src_positions, trg_positions)
+
+    def padding_ratios(self):
+        """ Fraction of the batches that was padding, without and with packing """
+        if not self.num_padded:
+            return 0.0, 0.0
+        return 1.0 - self.num_tokens / self.num_padded, 1.0 - self.num_tokens / self.num_packed
+
+    def __iter__(self):
+        for batch in self.data_iter:
+            yield self.pack(batch)
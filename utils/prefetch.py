@@ -0,0 +1,187 @@
+""" Prepare the batches of a data iterator (tensors and masks) ahead of the training/validation loops """
+import collections
+import queue
+import threading
+import torch
+import torch.multiprocessing as mp
+from utils.binarized import BinarizedIterator
+from utils.distributed import ShardedIterator
+from utils.utils import make_tgt_mask
+
+
+class PreparedBatch(object):
+    """
+    A batch with its masks, with the same `src`/`trg` attributes as a torchtext Batch
+
+    Arguments:
+        src: tuple (src tensor [batch_size, src_seq_len], src lengths [batch_size])
+        trg: tuple (trg tensor [batch_size, trg_seq_len], trg lengths [batch_size]), None if the batch has no trg
+        src_mask: mask of the src sequences [batch_size, 1, src_seq_len]
+        trg_mask: mask of the trg sequences [batch_size, trg_seq_len, trg_seq_len], None if the batch has no trg
+        indices: index (in the dataset) of each example of the batch (if known)
+    """
+
+    def __init__(self, src, trg, src_mask, trg_mask, indices=None):
+        self.src = src
+        self.trg = trg
+        self.src_mask = src_mask
+        self.trg_mask = trg_mask
+        self.indices = indices
+
+
+def prepare_batch(batch, pad_index):
+    """
+    Compute the masks of a batch (a PreparedBatch, eg. a PackedBatch, is returned as is)
+
+    Arguments:
+        batch: a batch with `src` (and `trg`) attributes (eg. a torchtext Batch or a TensorBatch)
+        pad_index: id of the padding token
+
+    Returns:
+        A PreparedBatch
+    """
+    if isinstance(batch, PreparedBatch):
+        return batch
+    trg = getattr(batch, "trg", None)
+    src_mask = (batch.src[0] != pad_index).unsqueeze(-2)
+    trg_mask = make_tgt_mask(trg[0], pad_index) if trg is not None else None
+    return PreparedBatch(batch.src, trg, src_mask, trg_mask, getattr(batch, "indices", None))
+
+
+def batch_masks(batch, pad_index):
+    """
+    Get the masks of a batch (computed by the BatchPrefetcher, or computed now)
+
+    Arguments:
+        batch: a PreparedBatch or a batch with `src` and `trg` attributes
+        pad_index: id of the padding token
+
+    Returns:
+        A tuple (src_mask [batch_size, 1, src_seq_len], trg_mask [batch_size, trg_seq_len, trg_seq_len])
+    """
+    if not isinstance(batch, PreparedBatch):
+        batch = prepare_batch(batch, pad_index)
+    return batch.src_mask, batch.trg_mask
+
+
+def planned_batches(data_iter):
+    """
+    Get the dataset and the example indices of the batches of a BinarizedIterator (or of its shard)
+
+    Arguments:
+        data_iter: the data iterator
+
+    Returns:
+        A tuple (dataset, list of batches of indices), or None if the batches are not planned from indices
+    """
+    if isinstance(data_iter, ShardedIterator):
+        planned = planned_batches(data_iter.data_iter)
+        if planned is None:
+            return None
+        dataset, batches = planned
+        return dataset, list(data_iter.shard(batches))
+    if isinstance(data_iter, BinarizedIterator):
+        return data_iter.dataset, data_iter.create_batches()
+    return None
+
+
+# state of the worker processes, inherited from the parent process when they are forked
+worker_dataset = None
+worker_pad_index = None
+
+
+def init_worker(dataset, pad_index):
+    """ Initialize a worker process of the BatchPrefetcher """
+    global worker_dataset, worker_pad_index
+    worker_dataset, worker_pad_index = dataset, pad_index
+    # the workers share the cores with the training process
+    torch.set_num_threads(1)
+
+
+def build_batch(indices):
+    """ Build the PreparedBatch of the examples at `indices` (runs in a worker process) """
+    return prepare_batch(worker_dataset.batch(indices), worker_pad_index)
+
+
+class BatchPrefetcher(object):
+    """
+    Iterate over the batches of a data iterator while the next `prefetch` batches are prepared
+    (numericalized, padded and masked) in the background
+
+    The batches of a BinarizedIterator are planned up front as lists of example indices, so they are
+    built by `num_workers` forked processes. Their tensors are sent back through shared memory (the
+    tensors that torch.multiprocessing sends between processes are moved to shared memory instead of
+    being copied through the pipe). The batches of the other iterators are prepared by a background thread
+
+    Arguments:
+        data_iter: the data iterator (eg. a DataIterator, a BinarizedIterator, or a ShardedIterator of one)
+        pad_index: id of the padding token
+        prefetch: number of batches prepared ahead
+        num_workers: number of worker processes for the planned batches (0 always uses a thread)
+    """
+
+    def __init__(self, data_iter, pad_index, prefetch=2, num_workers=0):
+        self.data_iter = data_iter
+        self.pad_index = pad_index
+        self.prefetch = max(prefetch, 1)
+        self.num_workers = num_workers
+
+    def __iter__(self):
+        planned = planned_batches(
+            self.data_iter) if self.num_workers > 0 else None
+        if planned is not None:
+            return self.process_batches(*planned)
+        return self.thread_batches()
+
+    def process_batches(self, dataset, batches):
+        """ Build the planned batches in the worker processes, in order """
+        pool = mp.get_context("fork").Pool(self.num_workers, initializer=init_worker,
+                                           initargs=(dataset, self.pad_index))
+        try:
+            pending = collections.deque()
+            for indices in batches:
+                pending.append(pool.apply_async(build_batch, (indices,)))
+                if len(pending) > self.prefetch:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+    def thread_batches(self):
+        """ Prepare the batches of the data iterator in a background thread """
+        prepared = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # give up if the consumer stopped iterating (eg. after an exception in the training loop)
+            while not stop.is_set():
+                try:
+                    prepared.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.data_iter:
+                    if not put(prepare_batch(batch, self.pad_index)):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                item = prepared.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
@@ -0,0 +1,280 @@
+""" A local HTTP translation server that coalesces concurrent requests into batches """
+import json
+import queue
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class TranslationRequest(object):
+    """
+    A request for the translation of one or more (BPE'd) src sentences.
+    The sentences of a request are queued (and possibly batched) independently,
+    the request is complete once all of them have been translated
+
+    Arguments:
+        sentences: list of src sentences, where each sentence is a list of tokens
+    """
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.translations = [None] * len(sentences)
+        self.remaining = len(sentences)
+        self.error = None
+        self.done = threading.Event()
+        if not sentences:
+            self.done.set()
+
+    def set_translation(self, index, translation):
+        """ Store the translation of the `index`-th sentence of the request """
+        self.translations[index] = translation
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.done.set()
+
+    def set_error(self, error):
+        """ Fail the request (eg. because decoding raised an exception) """
+        self.error = error
+        self.done.set()
+
+
+class RequestBatcher(object):
+    """
+    Queue the sentences of concurrent TranslationRequests and translate them in batches.
+    A single worker thread owns the model: it takes the oldest queued sentence and keeps
+    adding sentences to its batch until the batch holds `max_batch_size` sentences,
+    the next sentence would exceed the `max_tokens` budget, or `max_wait` seconds have passed
+
+    Arguments:
+        translator: Translator object wrapping the loaded model
+        max_batch_size: maximum number of sentences in a batch
+        max_tokens: maximum number of (padded) source tokens (times the beam size) in a batch
+        max_wait: maximum time (in seconds) the first sentence of a batch waits for other sentences
+        beam_width: size of beam (greedy decoding if None)
+        max_len: maximum length of the translations
+        decoder: if given, a ContinuousDecoder that admits the queued sentences into its free slots
+                 between decoding steps, instead of decoding the sentences batch by batch
+    """
+
+    def __init__(self, translator, max_batch_size=64, max_tokens=4096, max_wait=0.01, beam_width=None, max_len=100,
+                 decoder=None):
+        self.translator = translator
+        self.decoder = decoder
+        self.max_batch_size = max_batch_size
+        self.max_tokens = max_tokens
+        self.max_wait = max_wait
+        self.beam_width = beam_width
+        self.max_len = max_len
+
+        # queue of (request, index of the sentence in the request)
+        self.queue = queue.Queue()
+
+        # sentence that did not fit in the previous batch (it starts the next one)
+        self.pending = None
+
+        self.stats_lock = threading.Lock()
+        self.num_requests = 0
+        self.num_sentences = 0
+        self.num_batches = 0
+        self.batch_sizes = Counter()
+        self.decoding_time = 0.0
+
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def translate(self, sentences):
+        """
+        Queue the sentences and wait for their translations (called by the request handlers)
+
+        Arguments:
+            sentences: list of src sentences, where each sentence is a list of tokens
+
+        Returns:
+            The translations of the src sentences (lists of tokens) in the same order as `sentences`
+        """
+        request = TranslationRequest(sentences)
+        with self.stats_lock:
+            self.num_requests += 1
+            self.num_sentences += len(sentences)
+        for index in range(len(sentences)):
+            self.queue.put((request, index))
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.translations
+
+    def next_batch(self):
+        """
+        Block until a batch of queued sentences is ready
+
+        Returns:
+            A list of (request, index of the sentence in the request)
+        """
+        if self.pending is not None:
+            item, self.pending = self.pending, None
+        else:
+            item = self.queue.get()
+
+        batch = [item]
+        max_length = len(item[0].sentences[item[1]]) + 2
+        deadline = time.time() + self.max_wait
+        beam_width = self.beam_width or 1
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+
+            # length of the sentence including the <s> and </s> tokens
+            length = len(item[0].sentences[item[1]]) + 2
+            if (len(batch) + 1) * max(max_length, length) * beam_width > self.max_tokens:
+                self.pending = item
+                break
+            batch.append(item)
+            max_length = max(max_length, length)
+        return batch
+
+    def run(self):
+        """ Translate the queued sentences batch by batch (runs in the worker thread) """
+        if self.decoder is not None:
+            self.run_continuous()
+            return
+
+        while True:
+            batch = self.next_batch()
+            start = time.time()
+            try:
+                translations = self.translator.translate_sentences(
+                    [request.sentences[index] for request, index in batch],
+                    beam_width=self.beam_width, max_len=self.max_len)
+            except Exception as e:
+                for request, _ in batch:
+                    request.set_error(e)
+                continue
+
+            for (request, index), translation in zip(batch, translations):
+                request.set_translation(index, translation)
+
+            with self.stats_lock:
+                self.num_batches += 1
+                self.batch_sizes[len(batch)] += 1
+                self.decoding_time += time.time() - start
+
+    def next_sentences(self, num_free, block):
+        """
+        Take at most `num_free` queued sentences for the ContinuousDecoder
+
+        Arguments:
+            num_free: number of free slots in the decoder
+            block: whether to wait for a sentence (the decoder is idle)
+
+        Returns:
+            A list of ((request, index of the sentence in the request), src sentence)
+        """
+        sentences = []
+        while len(sentences) < num_free:
+            try:
+                item = self.queue.get(block=block and not sentences)
+            except queue.Empty:
+                break
+            sentences.append((item, item[0].sentences[item[1]]))
+        if sentences:
+            with self.stats_lock:
+                self.num_batches += 1
+                self.batch_sizes[len(sentences)] += 1
+        return sentences
+
+    def run_continuous(self):
+        """ Translate the queued sentences with continuous batching (runs in the worker thread) """
+        while True:
+            try:
+                for (request, index), translation in self.decoder.run(self.next_sentences):
+                    request.set_translation(index, translation)
+            except Exception as e:
+                # fail the requests of the sentences that were being decoded
+                for key in self.decoder.keys:
+                    if key is not None:
+                        key[0].set_error(e)
+
+    def stats(self):
+        """ Get the queue depth and batching statistics of the server """
+        with self.stats_lock:
+            return {"queue_depth": self.queue.qsize() + (self.pending is not None),
+                    "requests": self.num_requests,
+                    "sentences": self.num_sentences,
+                    "batches": self.num_batches,
+                    "mean_batch_size": sum(size * count for size, count in self.batch_sizes.items()) / max(1, self.num_batches),
+                    "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                    "decoding_time": self.decoding_time,
+                    "slot_occupancy": self.decoder.occupancy() if self.decoder is not None else None,
+                    "cache": self.translator.cache.stats() if self.translator.cache is not None else None}
+
+
+class TranslationRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the HTTP requests of the TranslationServer
+
+        POST /translate  {"sentences": ["BPE'd German sentence", ...]}
+                         => {"translations": ["English translation", ...]}
+        GET  /stats      => queue depth and batching statistics
+    """
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.send_json(404, {"error": "unknown path {}".format(self.path)})
+            return
+        self.send_json(200, self.server.batcher.stats())
+
+    def do_POST(self):
+        if self.path != "/translate":
+            self.send_json(404, {"error": "unknown path {}".format(self.path)})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            sentences = json.loads(self.rfile.read(length).decode("utf-8"))[
+                "sentences"]
+            sentences = [sentence.split() for sentence in sentences]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_json(
+                400, {"error": "expected a JSON object with a list of `sentences`"})
+            return
+
+        try:
+            translations = self.server.batcher.translate(sentences)
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, {"translations": [
+                       " ".join(translation) for translation in translations]})
+
+    def send_json(self, code, body):
+        """ Send `body` as a JSON response with the status `code` """
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # do not log every request
+        pass
+
+
+class TranslationServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server that handles each connection in its own thread.
+    All the connections share the RequestBatcher (and so the loaded model)
+
+    Arguments:
+        address: (host, port) to listen on
+        batcher: RequestBatcher that translates the sentences of the requests
+    """
+    daemon_threads = True
+
+    def __init__(self, address, batcher):
+        HTTPServer.__init__(self, address, TranslationRequestHandler)
+        self.batcher = batcher
@@ -0,0 +1,121 @@
+""" Utilities to translate a stream of sentences (eg. stdin) in micro-batches """
+import queue
+import threading
+import time
+
+
+def read_lines(stream, line_queue):
+    """
+    Read the lines of `stream` into `line_queue` (runs in a background thread)
+    A `None` is put on the queue once the stream is exhausted
+
+    Arguments:
+        stream: file-like object to read the lines from
+        line_queue: queue where the lines are put
+    """
+    try:
+        for line in stream:
+            line_queue.put(line)
+    finally:
+        line_queue.put(None)
+
+
+def micro_batches(stream, max_tokens, timeout, beam_width=1):
+    """
+    Group the lines of a stream into micro-batches
+
+    A micro-batch is emitted as soon as adding the next line would exceed the token
+    budget, or when `timeout` seconds have passed since its first line was read, so
+    a slow producer never holds back the lines that have already been received.
+    The lines are read in a background thread and the batches keep the order of the stream
+
+    Arguments:
+        stream: file-like object with one (BPE'd) sentence per line
+        max_tokens: maximum number of (padded) source tokens in a micro-batch
+        timeout: maximum time (in seconds) a line waits for its micro-batch to be emitted
+        beam_width: size of the beam used to decode the micro-batches (1 for greedy decoding)
+
+    Returns:
+        A generator of micro-batches, each one a list of sentences (lists of tokens)
+    """
+    line_queue = queue.Queue()
+    reader = threading.Thread(target=read_lines, args=(stream, line_queue))
+    reader.daemon = True
+    reader.start()
+
+    batch, max_length, deadline = [], 0, None
+    while True:
+        try:
+            line = line_queue.get(timeout=max(0, deadline - time.time())
+                                  if batch else None)
+        except queue.Empty:
+            # the first line of the batch has waited long enough
+            yield batch
+            batch, max_length = [], 0
+            continue
+
+        if line is None:
+            if batch:
+                yield batch
+            return
+
+        tokens = line.split()
+
+        # length of the sentence including the <s> and </s> tokens
+        length = len(tokens) + 2
+        if batch and (len(batch) + 1) * max(max_length, length) * beam_width > max_tokens:
+            yield batch
+            batch, max_length = [], 0
+
+        if not batch:
+            deadline = time.time() + timeout
+        batch.append(tokens)
+        max_length = max(max_length, length)
+
+
+def continuous_translations(stream, decoder):
+    """
+    Translate the lines of a stream with continuous batching: the lines are admitted into
+    the free slots of the `decoder` as soon as they are read (see `ContinuousDecoder`)
+
+    Arguments:
+        stream: file-like object with one (BPE'd) sentence per line
+        decoder: ContinuousDecoder used to translate the lines
+
+    Returns:
+        A generator of translations (lists of tokens), in the order of the stream
+    """
+    line_queue = queue.Queue()
+    reader = threading.Thread(target=read_lines, args=(stream, line_queue))
+    reader.daemon = True
+    reader.start()
+
+    # index of the next line that is read and whether the stream is exhausted
+    reading = {"index": 0, "done": False}
+
+    def next_sentences(num_free, block):
+        if reading["done"]:
+            return None
+        sentences = []
+        while len(sentences) < num_free:
+            try:
+                # only wait for a line if the decoder has nothing else to do
+                line = line_queue.get(block=block and not sentences)
+            except queue.Empty:
+                break
+            if line is None:
+                reading["done"] = True
+                break
+            sentences.append((reading["index"], line.split()))
+            reading["index"] += 1
+        if not sentences and reading["done"]:
+            return None
+        return sentences
+
+    # the translations are done out of order, so they are held back until the previous lines are written
+    translations, next_index = {}, 0
+    for index, translation in decoder.run(next_sentences):
+        translations[index] = translation
+        while next_index in translations:
+            yield translations.pop(next_index)
+            next_index += 1
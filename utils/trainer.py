@@ -7,12 +7,16 @@ from torch.utils.tensorboard import SummaryWriter
 from utils.utils import HyperParams, set_logger, RunningAverage
 from models.transformer.optim import ScheduledOptimizer
 from torch.nn.utils import clip_grad_norm
-from utils.utils import make_tgt_mask
-from utils.data_loader import DataIterator, batch_size_fn
+from utils.utils import mixed_precision
+from utils.data_loader import DataIterator
 from collections import defaultdict
 from torchtext.data.example import Example
 from torchtext.data.dataset import Dataset
 from utils.translator import Translator
+from utils.metrics import TrainingMetrics
+from utils.prefetch import BatchPrefetcher, batch_masks
+from utils.packing import PackingIterator, PackedBatch
+from utils.distributed import ShardedIterator, NullSummaryWriter, all_reduce_gradients, all_reduce_sum, broadcast_value
 from typing import Tuple, List
 import time
 import math
@@ -47,28 +51,100 @@ class Trainer(object):
         self.iterations = 0
         self.max_num_epochs = params.epochs
         self.best_val_loss = float("inf")
-        self.summary_writer = SummaryWriter(params.model_dir + "runs")
         self.decode_every_num_epochs = 3
 
-    def train_epoch(self, data_iter: DataIterator) -> Tuple[float, list]:
+        # data-parallel training: every process (rank) trains on its own shard of the batches
+        # and only rank 0 logs to TensorBoard, validates and saves checkpoints
+        self.rank = getattr(params, "rank", 0)
+        self.world_size = getattr(params, "world_size", 1)
+        self.summary_writer = SummaryWriter(
+            params.model_dir + "runs") if self.rank == 0 else NullSummaryWriter()
+
+        # number of target tokens for which the generator and the loss are computed at once
+        # (0 computes them for the whole batch)
+        self.loss_chunk_size = getattr(params, "loss_chunk_size", 0)
+
+        # number of batches over which the gradients are accumulated before updating the parameters
+        self.update_freq = getattr(params, "update_freq", 1)
+
+        # run the forward passes in bfloat16 (autocast on the CPU)
+        self.bf16 = getattr(params, "bf16", False)
+
+        # the training statistics are aggregated over `log_every` updates before being written to TensorBoard
+        self.metrics = TrainingMetrics(
+            self.summary_writer, getattr(params, "log_every", 100))
+
+        # number of batches prepared ahead in the background (0 prepares them in the loops)
+        # and number of worker processes preparing them (see `BatchPrefetcher`)
+        self.prefetch = getattr(params, "prefetch", 0)
+        self.num_workers = getattr(params, "num_workers", 0)
+
+        # pack several training pairs into each row of at least `pack_len` tokens (0 disables packing)
+        self.pack_len = getattr(params, "pack_len", 0)
+
+    def batches(self, data_iter):
+        """ Iterate over the batches of `data_iter`, prefetching them if `prefetch` > 0 """
+        if not self.prefetch:
+            return data_iter
+        return BatchPrefetcher(data_iter, self.params.pad_token, self.prefetch, self.num_workers)
+
+    def loss_targets(self, batch, trg: torch.Tensor) -> torch.Tensor:
+        """
+        Get the target tokens predicted by the outputs of the Decoder: `trg` without <s>, except that
+        in a PackedBatch the <s> of every segment is not predicted from the previous segment (it is
+        replaced by padding, so the loss is still normalized by the number of real target tokens)
+
+        Arguments:
+            batch: the batch
+            trg: target sequences [batch_size, trg_seq_len] (including <s>)
+
+        Returns:
+            A Tensor of shape [batch_size, trg_seq_len - 1]
+        """
+        targets = trg[:, 1:]
+        if isinstance(batch, PackedBatch):
+            targets = targets.masked_fill(
+                batch.segment_starts[:, 1:].to(targets.device), self.params.pad_token)
+        return targets
+
+    def train_epoch(self, data_iter: DataIterator, update_freq: int = None) -> Tuple[float, list]:
         """
         Train Encoder-Decoder model for one single epoch
 
+        The gradients of `update_freq` consecutive batches are accumulated before the parameters are
+        updated, so the effective batch is `update_freq` times bigger. The update uses the gradients of
+        the summed loss of all these batches (as with a single batch before accumulation was added), so
+        they are the same as the gradients of one batch holding the same examples, whatever `update_freq`
+        is, and the learning rate carries over. `self.iterations` (the learning rate schedule and the
+        TensorBoard counters) counts parameter updates
+
         Arguments:
             - data_iter: The Data Iterator
+            - update_freq: number of batches per parameter update (defaults to `update_freq` in the params)
 
         Returns:
             - loss per word
             - hard training examples according to perplexity (only used in Boosting)
         """
         self.model.train()
-        total_loss = 0
+
+        # the statistics are kept in tensors, so they don't force a synchronization at every batch
+        total_loss = 0.0
         n_word_total = 0
         hard_examples: list = []
         example_to_perplexity: defaultdict = defaultdict(float)
-
-        with tqdm() as t:
-            for idx, batch in enumerate(data_iter):
+        update_freq = update_freq or self.update_freq
+        if self.world_size > 1:
+            data_iter = ShardedIterator(data_iter, self.rank, self.world_size)
+        if self.pack_len:
+            data_iter = PackingIterator(
+                data_iter, self.params.pad_token, self.pack_len)
+
+        # loss, number of target tokens and number of the batches accumulated since the last update
+        update_loss, update_words, update_batches = 0.0, 0, 0
+
+        with tqdm(disable=self.rank != 0) as t:
+            for idx, batch in enumerate(self.batches(data_iter)):
                 src, src_lengths = batch.src
                 trg, trg_lengths = batch.trg
 
@@ -76,73 +152,162 @@ class Trainer(object):
                     src_trg_examples = list(zip(*[self.batch_reverse_tokenization(
                         data) for data in [src, trg]]))
 
-                # [batch_size, 1, src_seq_len]
-                src_mask = (src != self.params.pad_token).unsqueeze(-2)
+                # [batch_size, 1, src_seq_len], [batch_size, trg_seq_len, trg_seq_len]
+                src_mask, trg_mask = batch_masks(batch, self.params.pad_token)
 
-                # [batch_size, trg_seq_len, trg_seq_len]
-                trg_mask = make_tgt_mask(trg, self.params.pad_token)
+                # masks and positions of the segments of a packed batch
+                packed_inputs = batch.model_inputs() if isinstance(batch, PackedBatch) else {}
 
                 if self.params.cuda:
                     src, trg = src.cuda(), trg.cuda()
 
                 # run the data through the model
-                self.optimizer.zero_grad()
-
-                output = self.model(src, trg, src_mask,
-                                    trg_mask, src_lengths, trg_lengths)
-
-                trg_batch_size = trg.size(0)
-                trg_seq_len = trg.size(-1)
+                if update_batches == 0:
+                    self.optimizer.zero_grad()
+
+                if self.loss_chunk_size and not self.params.boost:
+                    # compute the generator and the loss chunk by chunk
+                    with mixed_precision(self.bf16):
+                        hidden = self.model(src, trg, src_mask, trg_mask, src_lengths, trg_lengths,
+                                            return_hidden=True, **packed_inputs)
+                    trg = self.loss_targets(batch, trg)
+                    batch_loss = self.chunked_loss(hidden, trg, backward=True)
+                    trg = trg.contiguous().view(-1)
+                else:
+                    # the log probabilities are in float32 even under mixed precision
+                    with mixed_precision(self.bf16):
+                        output = self.model(src, trg, src_mask,
+                                            trg_mask, src_lengths, trg_lengths, **packed_inputs)
 
-                output = output[:, :-1, :].contiguous().view(-1,
-                                                             self.params.tgt_vocab_size)
-                trg = trg[:, 1:].contiguous().view(-1)
+                    trg_batch_size = trg.size(0)
+                    trg_seq_len = trg.size(-1)
 
-                assert output.size(0) == trg.size(0)
+                    output = output[:, :-1, :].contiguous().view(-1,
+                                                                 self.params.tgt_vocab_size)
+                    trg = self.loss_targets(batch, trg).contiguous().view(-1)
 
-                # Compute perplexity per example, update example_to_perplexity for corresponding
-                # (src,trg) pairs (if boost==True)
-                if self.params.boost:
-                    perplexity_per_example = self.compute_perplexity_on_batch(
-                        output, trg, trg_batch_size, trg_seq_len - 1)
-                    for i in range(trg_batch_size):
-                        example_to_perplexity[src_trg_examples[i]
-                                              ] = perplexity_per_example[i]
+                    assert output.size(0) == trg.size(0)
 
-                loss = self.criterion(output, trg)
-                loss.backward()
+                    # Compute perplexity per example, update example_to_perplexity for corresponding
+                    # (src,trg) pairs (if boost==True)
+                    if self.params.boost:
+                        perplexity_per_example = self.compute_perplexity_on_batch(
+                            output, trg, trg_batch_size, trg_seq_len - 1)
+                        for i in range(trg_batch_size):
+                            example_to_perplexity[src_trg_examples[i]
+                                                  ] = perplexity_per_example[i]
 
-                # update the parameters
-                if isinstance(self.optimizer, ScheduledOptimizer):
-                    self.optimizer.step_and_update_lr()
-                    self.summary_writer.add_scalar(
-                        "train/lr", self.optimizer._get_lr_scale(), self.iterations)
-                else:
-                    self.optimizer.step()
+                    loss = self.criterion(output, trg)
+                    loss.backward()
+                    batch_loss = loss.detach()
 
                 # update the average loss
-                batch_loss = loss.item()
-                total_loss += batch_loss
+                total_loss = total_loss + batch_loss
                 non_pad_mask = trg.ne(self.params.pad_token)
-                n_word = non_pad_mask.sum().item()
-                n_word_total += n_word
+                n_word = non_pad_mask.sum()
+                n_word_total = n_word_total + n_word
 
-                t.set_postfix(loss='{:05.3f}'.format(batch_loss/n_word))
+                update_loss = update_loss + batch_loss
+                update_words = update_words + n_word
+                update_batches += 1
                 t.update()
-                self.iterations += 1
-                self.summary_writer.add_scalar(
-                    'train/loss_per_iteration', batch_loss/n_word, self.iterations)
-                self.summary_writer.add_scalar(
-                    'train/perplexity_per_iteration', math.exp(batch_loss/n_word), self.iterations)
-                torch.cuda.empty_cache()
+
+                # update the parameters every `update_freq` batches
+                if update_batches == update_freq:
+                    self.update_parameters(update_loss, update_words)
+                    update_loss, update_words, update_batches = 0.0, 0, 0
+
+            # the last batches of the epoch still make an update
+            if update_batches > 0:
+                self.update_parameters(update_loss, update_words)
+            self.metrics.flush(self.iterations)
+
+        if self.pack_len:
+            # compared with train/padding_ratio, the padding of the batches without packing
+            _, packed_padding_ratio = data_iter.padding_ratios()
+            self.summary_writer.add_scalar(
+                "train/packed_padding_ratio", packed_padding_ratio, self.epoch)
 
         # Obtain the hardest examples in the batch according to its perplexity
         if self.params.boost:
             hard_examples = self.get_hardest_examples(
                 example_to_perplexity, self.params.boost_percent)
-        loss_per_word = total_loss/n_word_total
+        if self.world_size > 1:
+            total_loss, n_word_total = all_reduce_sum(
+                [total_loss, n_word_total])
+        loss_per_word = float(total_loss)/float(n_word_total)
         return loss_per_word, hard_examples
 
+    def update_parameters(self, update_loss: torch.Tensor, update_words: torch.Tensor):
+        """
+        Update the parameters with the accumulated gradients (of the summed loss)
+
+        Arguments:
+            update_loss: (summed) loss of the batches accumulated since the last update
+            update_words: number of (non pad) target tokens of these batches
+        """
+        if self.world_size > 1:
+            # sum the gradients of all the processes, so that the update uses the gradients
+            # of the summed loss of all their batches (and sum their loss/tokens for the metrics)
+            all_reduce_gradients(self.model)
+            update_loss, update_words = all_reduce_sum(
+                [update_loss, update_words])
+
+        lr = None
+        if isinstance(self.optimizer, ScheduledOptimizer):
+            self.optimizer.step_and_update_lr()
+            lr = self.optimizer._get_lr_scale()
+        else:
+            self.optimizer.step()
+
+        self.iterations += 1
+        self.metrics.step(self.iterations, update_loss, update_words, lr)
+
+    def chunked_loss(self, hidden: torch.Tensor, targets: torch.Tensor, backward: bool = False) -> torch.Tensor:
+        """
+        Compute the loss of a batch `loss_chunk_size` target tokens at a time, so that the
+        [batch_size * seq_len, tgt_vocab_size] log probabilities (and their gradient) never exist
+        for the whole batch at once
+
+        The outputs of the Decoder are detached: every chunk goes through the generator, log softmax
+        and the criterion and is backpropagated down to the detached outputs (accumulating their gradient),
+        then the accumulated gradient is backpropagated through the rest of the model in one pass
+
+        Arguments:
+            hidden: outputs of the Decoder [batch_size, trg_seq_len, hidden_size]
+            targets: target tokens predicted by the outputs [batch_size, trg_seq_len - 1] (see `loss_targets`)
+            backward: whether to backpropagate the loss
+
+        Returns:
+            The (summed) loss of the batch
+        """
+        # predict the target tokens after <s>, padding tokens don't contribute to the loss
+        hidden = hidden[:, :-1, :].contiguous().view(-1, hidden.size(-1))
+        trg = targets.contiguous().view(-1)
+        non_pad = trg.ne(self.params.pad_token).nonzero().view(-1)
+        hidden, trg = hidden.index_select(0, non_pad), trg.index_select(0, non_pad)
+
+        chunks = hidden.detach()
+        if backward:
+            chunks.requires_grad_()
+
+        total_loss = hidden.new_zeros((), dtype=torch.float)
+        for start in range(0, trg.size(0), self.loss_chunk_size):
+            chunk = chunks[start:start + self.loss_chunk_size]
+            with mixed_precision(self.bf16):
+                logits = self.model.generator(chunk)
+            output = F.log_softmax(logits.float(), dim=-1)
+            loss = self.criterion(
+                output, trg[start:start + self.loss_chunk_size])
+            if backward:
+                loss.backward()
+            total_loss = total_loss + loss.detach()
+
+        # a batch without (non pad) targets has no chunk, so nothing to backpropagate
+        if backward and chunks.grad is not None:
+            hidden.backward(chunks.grad)
+        return total_loss
+
     def get_hardest_examples(self, example_to_perplexity: dict, boost_percent: float) -> list:
         """
         Get the hardest examples in the batch according to perplexity
@@ -198,30 +363,39 @@ class Trainer(object):
         n_word_total = 0
         with tqdm() as t:
             with torch.no_grad():
-                for idx, batch in enumerate(self.dev_iter):
+                for idx, batch in enumerate(self.batches(self.dev_iter)):
                     src, src_lengths = batch.src
                     trg, trg_lengths = batch.trg
-                    src_mask = (src != self.params.pad_token).unsqueeze(-2)
-                    # [batch_size, trg_seq_len, trg_seq_len]
-                    trg_mask = make_tgt_mask(trg, self.params.pad_token)
+                    # [batch_size, 1, src_seq_len], [batch_size, trg_seq_len, trg_seq_len]
+                    src_mask, trg_mask = batch_masks(
+                        batch, self.params.pad_token)
 
                     if self.params.cuda:
                         src, trg = src.cuda(), trg.cuda()
 
                     # run the data through the model
-                    output = self.model(src, trg, src_mask,
-                                        trg_mask, src_lengths, trg_lengths)
-
-                    output = output[:, :-1, :].contiguous().view(-1,
-                                                                 self.params.tgt_vocab_size)
-                    trg = trg[:, 1:].contiguous().view(-1)
+                    if self.loss_chunk_size:
+                        with mixed_precision(self.bf16):
+                            hidden = self.model(src, trg, src_mask, trg_mask, src_lengths, trg_lengths,
+                                                return_hidden=True)
+                        batch_loss = self.chunked_loss(
+                            hidden, trg[:, 1:]).item()
+                        trg = trg[:, 1:].contiguous().view(-1)
+                    else:
+                        with mixed_precision(self.bf16):
+                            output = self.model(src, trg, src_mask,
+                                                trg_mask, src_lengths, trg_lengths)
+
+                        output = output[:, :-1, :].contiguous().view(-1,
+                                                                     self.params.tgt_vocab_size)
+                        trg = trg[:, 1:].contiguous().view(-1)
+
+                        assert output.size(0) == trg.size(0)
+
+                        # compute the loss
+                        loss = self.criterion(output, trg)
+                        batch_loss = loss.item()
 
-                    assert output.size(0) == trg.size(0)
-
-                    # compute the loss
-                    loss = self.criterion(output, trg)
-
-                    batch_loss = loss.item()
                     total_loss += batch_loss
                     non_pad_mask = trg.ne(self.params.pad_token)
                     n_word = non_pad_mask.sum().item()
@@ -293,7 +467,7 @@ class Trainer(object):
 
         data_iterator = DataIterator(dataset, batch_size=self.params.train_batch_size, device=self.params.device,
                                      repeat=False, sort_key=lambda x: (len(x.src), len(x.trg)),
-                                     batch_size_fn=batch_size_fn, train=True, sort_within_batch=True, shuffle=True)
+                                     train=True, sort_within_batch=True, shuffle=True)
         return data_iterator
 
     def train(self):
@@ -335,6 +509,12 @@ class Trainer(object):
             train_loss_avg, hard_training_instances = self.train_epoch(
                 data_iterator)
 
+            # fraction of padding in the batches planned for the epoch
+            plan = getattr(data_iterator, "plan", None)
+            if plan is not None:
+                self.summary_writer.add_scalar(
+                    "train/padding_ratio", plan.padding_ratio, self.epoch)
+
             # write epoch statistics to Tensorboard
             self.summary_writer.add_scalar(
                 "train/avg_loss_per_epoch", train_loss_avg, self.epoch)
@@ -347,9 +527,11 @@ class Trainer(object):
             print(
                 f'Epoch: {epoch+1:02} | Avg Train Loss: {train_loss_avg} | Perpelxity: {math.exp(train_loss_avg)} | Time: {epoch_mins}m {epoch_secs}s')
 
-            # validate the model on the dev set
+            # validate the model on the dev set (on rank 0, which shares the loss with the other ranks)
             val_start_time = time.time()
-            val_loss_avg = self.validate()
+            val_loss_avg = self.validate() if self.rank == 0 else 0.0
+            if self.world_size > 1:
+                val_loss_avg = broadcast_value(val_loss_avg)
             val_end_time = time.time()
             val_mins, val_secs = self.epoch_time(val_start_time, val_end_time)
 
@@ -362,7 +544,7 @@ class Trainer(object):
             # TODO: write translations to Tensorboard
             # every `decode_every_num_epochs` epochs, write out translations using Greedy Decoding
             # to Tensorboard
-            if (self.epoch + 1) % self.decode_every_num_epochs == 0:
+            if (self.epoch + 1) % self.decode_every_num_epochs == 0 and self.rank == 0:
                 print("Performing Greedy Decoding...")
                 num_translations = 5
                 dev_iter = copy.copy(self.dev_iter)
@@ -389,17 +571,21 @@ class Trainer(object):
                 self.optimizer, ScheduledOptimizer) else self.optimizer.state_dict()
 
             # save checkpoint
-            self.save_checkpoint({
-                "epoch": epoch+1,
-                "state_dict": self.model.state_dict(),
-                "optim_dict": optim_dict},
-                is_best=is_best,
-                checkpoint=self.params.model_dir+"/checkpoints/")
+            if self.rank == 0:
+                self.save_checkpoint({
+                    "epoch": epoch+1,
+                    "state_dict": self.model.state_dict(),
+                    "optim_dict": optim_dict},
+                    is_best=is_best,
+                    checkpoint=self.params.model_dir+"/checkpoints/")
 
             if is_best:
                 print("- Found new lowest loss!")
                 self.best_val_loss = val_loss_avg
 
+        # write the last training statistics
+        self.metrics.close(self.iterations)
+
     def epoch_time(self, start_time: float, end_time: float) -> Tuple[float, float]:
         """
         Calculate the time to train a `model` on a single epoch
@@ -0,0 +1,123 @@
+""" A translation memory that caches the translations of exact repeated src sentences """
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+def model_fingerprint(model):
+    """
+    Compute a fingerprint of the weights of a model, so that the cached translations
+    of a model are never returned for another model (or another checkpoint of the same model)
+
+    Arguments:
+        model: the pytorch model
+
+    Returns:
+        A hex digest of the parameters/buffers of the model
+    """
+    digest = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode("utf-8"))
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class TranslationCache(object):
+    """
+    LRU cache of translations, keyed by the (numericalized) src sentence, the fingerprint of the
+    model weights and the decoding settings. The most recently used `capacity` translations are kept
+    in memory, and all of them are also written to a sqlite database if a `path` is given, so the
+    cache survives restarts (translations evicted from memory are read back from the database)
+
+    Arguments:
+        capacity: maximum number of translations kept in memory
+        path: path of the sqlite database (no persistence if None)
+    """
+
+    def __init__(self, capacity=100000, path=None):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # the cache is shared by the threads of the server
+        self.lock = threading.Lock()
+
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, translation TEXT)")
+            self.db.commit()
+
+    @staticmethod
+    def make_key(src_ids, fingerprint, settings):
+        """
+        Build the key of a src sentence
+
+        Arguments:
+            src_ids: word ids of the src sentence (without padding)
+            fingerprint: fingerprint of the model weights (see `model_fingerprint`)
+            settings: tuple with the decoding settings (eg. beam size, alpha, max length)
+
+        Returns:
+            The key as a string
+        """
+        return "{}|{}|{}".format(fingerprint, ",".join(str(s) for s in settings),
+                                 " ".join(str(i) for i in src_ids))
+
+    def get(self, key):
+        """
+        Look up the translation of a key
+
+        Returns:
+            The cached translation (a list of word ids) or None
+        """
+        with self.lock:
+            translation = self.entries.get(key)
+            if translation is not None:
+                self.entries.move_to_end(key)
+            elif self.db is not None:
+                row = self.db.execute(
+                    "SELECT translation FROM translations WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    translation = json.loads(row[0])
+                    self.insert(key, translation)
+
+            if translation is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return translation
+
+    def put(self, key, translation):
+        """
+        Cache the translation of a key
+
+        Arguments:
+            key: key of the src sentence (see `make_key`)
+            translation: list of word ids
+        """
+        with self.lock:
+            self.insert(key, translation)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO translations VALUES (?, ?)",
+                                (key, json.dumps(translation)))
+                self.db.commit()
+
+    def insert(self, key, translation):
+        """ Insert a translation in memory and evict the least recently used one if the cache is full """
+        self.entries[key] = translation
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        """ Get the hit/miss counters of the cache """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "size": len(self.entries)}
@@ -1,11 +1,14 @@
 import torch
 from torch.autograd import Variable
 import torch.nn.functional as F
-from utils.beam_search import beam_search_single, translate_batch
+from utils.beam_search import translate_batch
 from tqdm import tqdm
 import logging
 import numpy as np
-from utils.utils import make_tgt_mask
+from utils.utils import make_tgt_mask, mixed_precision
+from utils.data_loader import InferenceIterator
+from utils.translation_cache import TranslationCache, model_fingerprint
+from collections import OrderedDict
 import os
 
 
@@ -18,154 +21,432 @@ class Translator(object):
         dev_iter: Iterator for the Dev data 
         params: params related to the `model`
         device: CPU/GPU device number
+        max_tokens: if given, the sentences of the Dev data are decoded in length-sorted batches of
+                    at most `max_tokens` source tokens (see `InferenceIterator`) instead of the
+                    batches of `dev_iter`. The translations are still returned in the original order
+        cache: TranslationCache used to look up the translations of src sequences that were already
+               translated with the same model weights and decoding settings (None disables the cache)
     """
 
-    def __init__(self, model, dev_iter, params, device):
+    def __init__(self, model, dev_iter, params, device, max_tokens=None, cache=None):
         self.model = model
         self.dev_iter = dev_iter
         self.params = params
         self.device = device
+        self.max_tokens = max_tokens
+        self.cache = cache
+        self.fingerprint = None
 
-    def greedy_decode(self, max_len):
+    def inference_batches(self, beam_width=1):
+        """
+        Get the batches of the Dev data to decode
+
+        Arguments:
+            beam_width: size of the beam used to decode the batches (1 for greedy decoding)
+
+        Returns:
+            An iterator over the batches to decode
+        """
+        if self.max_tokens is None:
+            return self.dev_iter
+        return InferenceIterator(self.dev_iter.dataset, self.max_tokens, beam_width, self.device)
+
+    def restore_order(self, decoded_sentences, indices):
+        """
+        Put the decoded sentences back in the order of the Dev data
+
+        Arguments:
+            decoded_sentences: list of decoded sentences
+            indices: the index (in the Dev data) of each decoded sentence (empty if the sentences were decoded in order)
+
+        Returns:
+            The list of decoded sentences in the original order
+        """
+        if len(indices) != len(decoded_sentences):
+            return decoded_sentences
+        ordered_sentences = [None] * len(decoded_sentences)
+        for index, sentence in zip(indices, decoded_sentences):
+            ordered_sentences[index] = sentence
+        return ordered_sentences
+
+    def greedy_decode(self, max_len, max_len_a=0.0, max_len_b=None):
         """ 
         Perform greedy decoding to obtain translations of the src sequences 
 
         Arguments:
             max_len: maximum length of target sequence
+            max_len_a, max_len_b: limit the length of each translation to `max_len_a * src_len + max_len_b` words
+                                  (if max_len_b is not given, the translations are only limited by `max_len`)
 
         Returns:
             This method returns a list of all decoded translations in the dev set using
             greedy decoding
         """
-        decoded_sentences = []
+        decoded_sentences, indices = [], []
         self.model.eval()
-        with tqdm(total=len(self.dev_iter)) as t:
+        data_iter = self.inference_batches()
+        with tqdm(total=len(data_iter)) as t:
             with torch.no_grad():
-                for idx, batch in enumerate(self.dev_iter):
+                for idx, batch in enumerate(data_iter):
                     src, src_lengths = batch.src
-                    src_mask = (src != self.params.pad_token).unsqueeze(-2)
-
-                    if self.params.cuda:
-                        src = src.cuda()
-
-                    # run the src language through the Encoder
-                    encoder_output, encoder_final = self.model.encode(
-                        src, src_mask, src_lengths)
-
-                    # TODO: Greedy Decoding for GRU and Transformers are different
-                    # the GRU greedy decoding just takes in the previous token
-                    # whereas the Transformer model takes in the whole sequence
-                    # that has been decoded sofar
-
-                    # Encoder Final is the final hidden state of the Encoder Model
-                    # You will only have the Encoder Final if you are using a
-                    # GRUEncoder and if you are using a Transformer then
-                    # the encoder_final will be None
-                    # [num_layers, batch_size, hidden_size]
-                    encoder_final = encoder_final[:self.model.decoder.num_layers] if self.params.model_type == "GRU" else None
-
-                    decoded_batch = torch.ones(1, 1).fill_(
-                        self.params.sos_index).type_as(src)
-
-                    hidden = None
-                    for _ in range(max_len-1):
-                        # either use the decoded batch to decode the next word
-                        # or use the last word decoded to decode the next work
-                        trg = decoded_batch[:, -1].unsqueeze(
-                            1) if self.params.model_type == "GRU" else decoded_batch
-
-                        # create trgt_mask for transformer [batch_size, seq_len, seq_len]
-                        trg_mask = make_tgt_mask(
-                            trg, tgt_pad=self.params.pad_token)
-
-                        # output: [batch_size, seq_len, hidden_size], hidden: [num_layers, batch_size, hidden_size]
-                        output, hidden = self.model.decode(
-                            trg, encoder_output, src_mask, trg_mask, encoder_final, hidden)
-
-                        # pass the output through the generator to get prediction
-                        # take the last output and pass it through the
-                        # linear softmax layer to get preidctions
-
-                        # output[:, -1] => [batch_size, hidden_size]
-                        # linear [hidden_size, tgt_vocab_size]
-                        # prob: [batch_size, tgt_vocab_size]
-                        prob = self.model.generator(output[:, -1])
-                        prob = F.log_softmax(prob, dim=-1)
-
-                        # [batch_size, 1]
-                        next_word = torch.argmax(prob, dim=-1).item()
-
-                        decoded_batch = torch.cat([decoded_batch,
-                                                   torch.ones(1, 1).type_as(src.data).fill_(next_word)], dim=1)
-
-                    # the decoded batch should not include the <s> token
-                    decoded_batch = decoded_batch[:, 1:]
+                    decoded_batch = self.cached_greedy_decode_batch(
+                        src, src_lengths, max_len, max_len_a, max_len_b)
                     tokens = self.batch_reverse_tokenization(decoded_batch)
                     decoded_sentences.extend(tokens)
+                    indices.extend(getattr(batch, "indices", []))
                     t.update()
-        return decoded_sentences
+        return self.restore_order(decoded_sentences, indices)
+
+    def greedy_decode_batch(self, src, src_lengths, max_len, max_len_a=0.0, max_len_b=None):
+        """
+        Greedily decode a whole batch of src sequences at once.
+        Decoding stops as soon as every sequence in the batch has produced </s>
+        (or has reached its maximum length)
+
+        Arguments:
+            src: Source sequence tensor [batch_size, seq_len]
+            src_lengths: length of each example in the batch
+            max_len: maximum length of target sequence
+            max_len_a, max_len_b: limit the length of each translation to `max_len_a * src_len + max_len_b` words
+
+        Returns:
+            A Tensor of shape [batch_size, decoded_len] with the decoded word ids (without the <s> token),
+            in the same order as `src`
+        """
+        # the GRUEncoder packs the src sequences, which requires the batch to be sorted by length
+        src, src_lengths, restore_index = self.sort_batch(src, src_lengths)
+        src_mask = (src != self.params.pad_token).unsqueeze(-2)
+
+        if self.params.cuda:
+            src = src.cuda()
+
+        # run the src language through the Encoder
+        encoder_output, encoder_final = self.model.encode(
+            src, src_mask, src_lengths)
+
+        # Encoder Final is the final hidden state of the Encoder Model
+        # You will only have the Encoder Final if you are using a
+        # GRUEncoder and if you are using a Transformer then
+        # the encoder_final will be None
+        # [num_layers, batch_size, hidden_size]
+        encoder_final = encoder_final[:self.model.decoder.num_layers] if self.params.model_type == "GRU" else None
+
+        batch_size = src.size(0)
+        decoded_batch = torch.ones(batch_size, 1).fill_(
+            self.params.sos_index).type_as(src)
+
+        # maximum number of words to decode for each sequence [batch_size]
+        max_lengths = self.max_decode_lengths(
+            src_lengths, max_len, max_len_a, max_len_b).to(src.device)
+
+        # sequences that have produced </s> (or reached their maximum length)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=src.device)
+
+        # the GRU carries its hidden state from one step to the next, whereas
+        # the Transformer caches the keys/values of the tokens decoded so far
+        # (and of the encoder outputs) in a DecoderState, so both only need the last decoded word
+        hidden = self.model.decoder.init_state(encoder_output, encoder_final)
+        for step in range(int(max_lengths.max())):
+            # use the last word decoded to decode the next word
+            trg = decoded_batch[:, -1].unsqueeze(1)
+
+            # create trgt_mask for transformer [batch_size, 1, 1]
+            trg_mask = make_tgt_mask(
+                trg, tgt_pad=self.params.pad_token)
+
+            # output: [batch_size, seq_len, hidden_size], hidden: [num_layers, batch_size, hidden_size]
+            output, hidden = self.model.decode(
+                trg, encoder_output, src_mask, trg_mask, encoder_final, hidden)
+
+            # pass the output through the generator to get prediction
+            # take the last output and pass it through the
+            # linear layer to get predictions (the argmax of the logits is
+            # the same as the argmax of the log softmax)
+
+            # output[:, -1] => [batch_size, hidden_size]
+            # linear [hidden_size, tgt_vocab_size]
+            # prob: [batch_size, tgt_vocab_size]
+            prob = self.model.generator(output[:, -1])
+
+            # [batch_size]
+            next_word = torch.argmax(prob, dim=-1)
+
+            # finished sequences keep on producing </s>
+            next_word = next_word.masked_fill(
+                finished, self.params.eos_index)
+
+            decoded_batch = torch.cat(
+                [decoded_batch, next_word.unsqueeze(1)], dim=1)
+
+            finished = finished | next_word.eq(
+                self.params.eos_index) | max_lengths.le(step + 1)
+            if finished.all():
+                break
+
+        # the decoded batch should not include the <s> token
+        decoded_batch = decoded_batch[:, 1:]
+        if restore_index is not None:
+            decoded_batch = decoded_batch.index_select(0, restore_index)
+        return decoded_batch
+
+    def sort_batch(self, src, src_lengths):
+        """
+        Sort a batch of src sequences by decreasing length (only needed by the GRUEncoder)
+
+        Arguments:
+            src: Source sequence tensor [batch_size, seq_len]
+            src_lengths: length of each example in the batch
 
-    def beam_decode(self, beam_width, max_seq_len=100):
+        Returns:
+            The sorted `src` and `src_lengths` and the index that restores the original order
+            of the batch (None if the batch wasn't sorted)
+        """
+        if self.params.model_type != "GRU":
+            return src, src_lengths, None
+        src_lengths, sort_index = src_lengths.sort(0, descending=True)
+        src = src.index_select(0, sort_index.to(src.device))
+        _, restore_index = sort_index.sort(0)
+        return src, src_lengths, restore_index.to(src.device)
+
+    def max_decode_lengths(self, src_lengths, max_len, max_len_a=0.0, max_len_b=None):
+        """
+        Compute the maximum number of words to decode for each src sequence
+
+        Arguments:
+            src_lengths: length of each example in the batch (including <s> and </s>)
+            max_len: maximum length of target sequence (including <s>)
+            max_len_a, max_len_b: limit the length of each translation to `max_len_a * src_len + max_len_b` words
+
+        Returns:
+            A LongTensor of shape [batch_size]
+        """
+        max_lengths = torch.full_like(src_lengths, max_len - 1)
+        if max_len_b is not None:
+            # src_len is the number of words of the src sequence, without <s> and </s>
+            src_words = (src_lengths - 2).clamp(min=0).float()
+            max_lengths = (max_len_a * src_words +
+                           max_len_b).long().clamp(1, max_len - 1)
+        return max_lengths
+
+    def beam_decode(self, beam_width, max_seq_len=100, max_len_a=0.0, max_len_b=None):
         """ 
         Perform Beam Search as a decoding procedure to get translations
 
         Arguments:
             beam_width: size of the beam
             max_seq_len: The maximum sequence length of the translations
+            max_len_a, max_len_b: limit the length of each translation to `max_len_a * src_len + max_len_b` words
+                                  (if max_len_b is not given, the translations are only limited by `max_seq_len`)
 
         Returns: 
             This method returns a list of all decoded translations in the dev set
             using Beam Search
         """
-        decoded_sentences = []
+        decoded_sentences, indices = [], []
         self.model.eval()
-        with tqdm(total=len(self.dev_iter)) as t:
+        data_iter = self.inference_batches(beam_width)
+        with tqdm(total=len(data_iter)) as t:
             with torch.no_grad():
-                for index, batch in enumerate(self.dev_iter):
+                for index, batch in enumerate(data_iter):
                     src, src_lengths = batch.src
-                    src_mask = (src != self.params.pad_token).unsqueeze(-2)
-
-                    if self.params.cuda:
-                        src = src.cuda()
-
-                    # run the src langauge through the Encoder
-                    # output => [batch_size, seq_len, hidden_size],
-                    # hidden => [num_layers, batch_size, hidden_size]
-                    encoder_output, encoder_final = self.model.encode(
-                        src, src_mask, src_lengths)
-
-                    # transform the `encoder_final` if using GRU, otherwise `encoder_final` is None is using Transformer model
-                    encoder_final = encoder_final[:self.model.decoder.num_layers] if self.params.model_type == "GRU" else None
-
-                    if self.params.model_type == "GRU":
-                        trg_mask = None
-                        translation = beam_search_single(model=self.model, encoder_final=encoder_final, encoder_outputs=encoder_output,
-                                                         src_mask=src_mask, beam_size=beam_width,
-                                                         alpha=1.0, params=self.params, max_seq_len=max_seq_len)
-                    else:
-                        translation, _ = translate_batch(model=self.model, src_enc=encoder_output, src_mask=src_mask,
-                                                         beam_size=beam_width, alpha=0.0, params=self.params, max_seq_len=max_seq_len)
-
-                    # convert tensor of word indices to words
-                    tokens = self.batch_reverse_tokenization(
-                        translation.view(1, -1))
+                    translations = self.cached_beam_decode_batch(
+                        src, src_lengths, beam_width, max_seq_len, max_len_a, max_len_b)
+
+                    # convert the best translation of each src sequence to words
+                    tokens = self.batch_reverse_tokenization(translations)
                     decoded_sentences.extend(tokens)
+                    indices.extend(getattr(batch, "indices", []))
                     t.update()
-        return decoded_sentences
+        return self.restore_order(decoded_sentences, indices)
+
+    def beam_decode_batch(self, src, src_lengths, beam_width, max_seq_len=100, n_best=1, max_len_a=0.0, max_len_b=None):
+        """
+        Decode a whole batch of src sequences using Beam Search
+
+        Arguments:
+            src: Source sequence tensor [batch_size, seq_len]
+            src_lengths: length of each example in the batch
+            beam_width: size of the beam
+            max_seq_len: The maximum sequence length of the translations
+            n_best: number of translations to return for each src sequence
+            max_len_a, max_len_b: limit the length of each translation to `max_len_a * src_len + max_len_b` words
+
+        Returns:
+            A tuple (translations, scores) where translations[i] holds the `n_best` translations
+            of the i-th src sequence (lists of word ids) and scores[i] their scores
+        """
+        src, src_lengths, restore_index = self.sort_batch(src, src_lengths)
+        src_mask = (src != self.params.pad_token).unsqueeze(-2)
+
+        if self.params.cuda:
+            src = src.cuda()
+
+        # run the src langauge through the Encoder
+        # output => [batch_size, seq_len, hidden_size],
+        # hidden => [num_layers, batch_size, hidden_size]
+        encoder_output, encoder_final = self.model.encode(
+            src, src_mask, src_lengths)
+
+        # transform the `encoder_final` if using GRU, otherwise `encoder_final` is None is using Transformer model
+        encoder_final = encoder_final[:self.model.decoder.num_layers] if self.params.model_type == "GRU" else None
+
+        # the beams decode up to `max_seq_len` words (the `max_len` of `max_decode_lengths` includes <s>)
+        max_lengths = None
+        if max_len_b is not None:
+            max_lengths = self.max_decode_lengths(
+                src_lengths, max_seq_len + 1, max_len_a, max_len_b).tolist()
+
+        translations, scores = translate_batch(model=self.model, src_enc=encoder_output, src_mask=src_mask,
+                                               beam_size=beam_width, alpha=0.0, params=self.params,
+                                               max_seq_len=max_seq_len, n_best=n_best, max_lengths=max_lengths,
+                                               encoder_final=encoder_final)
+
+        if restore_index is not None:
+            restore_index = restore_index.tolist()
+            translations = [translations[i] for i in restore_index]
+            scores = [scores[i] for i in restore_index]
+        return translations, scores
+
+    def translate_sentences(self, sentences, beam_width=None, max_len=100):
+        """
+        Translate a list of (BPE'd) src sentences
+
+        Arguments:
+            sentences: list of src sentences, where each sentence is a list of tokens
+            beam_width: size of the beam (greedy decoding is used if not given)
+            max_len: maximum length of the translations
+
+        Returns:
+            The translations of the src sentences (lists of tokens) in the same order as `sentences`
+        """
+        self.model.eval()
+        with torch.no_grad():
+            # add <s>, </s>, pad and numericalize the src sentences
+            src, src_lengths = self.params.SRC.process(
+                sentences, device=self.device)
+            if beam_width:
+                translations = self.cached_beam_decode_batch(
+                    src, src_lengths, beam_width, max_len)
+            else:
+                translations = self.cached_greedy_decode_batch(
+                    src, src_lengths, max_len)
+        return self.batch_reverse_tokenization(translations)
+
+    def cached_greedy_decode_batch(self, src, src_lengths, max_len, max_len_a=0.0, max_len_b=None):
+        """
+        Greedily decode a batch of src sequences (see `greedy_decode_batch`), translating
+        every distinct src sequence only once and reusing the cached translations
+
+        Returns:
+            The translations of the src sequences (lists of word ids without </s>) in the same order as `src`
+        """
+        def decode_batch(src, src_lengths):
+            return self.greedy_decode_batch(src, src_lengths, max_len, max_len_a, max_len_b).tolist()
+        return self.decode_unique(src, src_lengths, ("greedy", max_len, max_len_a, max_len_b), decode_batch)
+
+    def cached_beam_decode_batch(self, src, src_lengths, beam_width, max_seq_len=100, max_len_a=0.0, max_len_b=None):
+        """
+        Decode a batch of src sequences using Beam Search (see `beam_decode_batch`), translating
+        every distinct src sequence only once and reusing the cached translations
+
+        Returns:
+            The best translation of each src sequence (lists of word ids) in the same order as `src`
+        """
+        def decode_batch(src, src_lengths):
+            translations, _ = self.beam_decode_batch(
+                src, src_lengths, beam_width, max_seq_len, max_len_a=max_len_a, max_len_b=max_len_b)
+            return [n_best[0] for n_best in translations]
+        return self.decode_unique(src, src_lengths, ("beam", beam_width, 0.0, max_seq_len, max_len_a, max_len_b),
+                                  decode_batch)
+
+    def decode_unique(self, src, src_lengths, settings, decode_batch):
+        """
+        Decode the distinct src sequences of a batch that are not in the cache.
+        Repeated src sequences (in the batch or in the cache) are only decoded once
+
+        Arguments:
+            src: Source sequence tensor [batch_size, seq_len]
+            src_lengths: length of each example in the batch
+            settings: tuple with the decoding settings (part of the cache key)
+            decode_batch: function that decodes (src, src_lengths) into a list of translations (lists of word ids)
+
+        Returns:
+            The translations of the src sequences (lists of word ids without </s>) in the same order as `src`
+        """
+        # positions of every distinct src sequence in the batch
+        positions = OrderedDict()
+        for position, row in enumerate(src.tolist()):
+            row = tuple(word for word in row if word != self.params.pad_token)
+            positions.setdefault(row, []).append(position)
+
+        if self.cache is not None and self.fingerprint is None:
+            self.fingerprint = model_fingerprint(self.model)
+
+        # translations decoded in bfloat16 may differ from the float32 ones
+        bf16 = getattr(self.params, "bf16", False)
+        if bf16:
+            settings = settings + ("bf16",)
+
+        translations = [None] * src.size(0)
+
+        # (cache key, positions) of the distinct src sequences that are not in the cache
+        missing = []
+        for row, row_positions in positions.items():
+            key, cached = None, None
+            if self.cache is not None:
+                key = TranslationCache.make_key(
+                    row, self.fingerprint, settings)
+                cached = self.cache.get(key)
+            if cached is not None:
+                for position in row_positions:
+                    translations[position] = cached
+            else:
+                missing.append((key, row_positions))
+
+        if not missing:
+            return translations
+
+        if len(missing) < src.size(0):
+            index = [row_positions[0] for _, row_positions in missing]
+            src_lengths = src_lengths.index_select(
+                0, torch.tensor(index, dtype=torch.long, device=src_lengths.device))
+            src = src.index_select(0, torch.tensor(index, dtype=torch.long, device=src.device))[
+                :, :int(src_lengths.max())]
+
+        # decode in bfloat16 if mixed precision is enabled
+        with mixed_precision(bf16):
+            decoded = decode_batch(src, src_lengths)
+
+        for (key, row_positions), translation in zip(missing, decoded):
+            translation = self.strip_eos(translation)
+            for position in row_positions:
+                translations[position] = translation
+            if self.cache is not None:
+                self.cache.put(key, translation)
+        return translations
+
+    def strip_eos(self, translation):
+        """ Cut a translation (list of word ids) at its first </s> token """
+        translation = [int(word) for word in translation]
+        if self.params.eos_index in translation:
+            translation = translation[:translation.index(self.params.eos_index)]
+        return translation
 
     def batch_reverse_tokenization(self, batch):
         """
         Convert a batch of sequences of word IDs to words in a batch
 
         Arguments:
-            batch: a Tensor containg the decoded examples (with word ids representing the sequence)
+            batch: a Tensor (or a list of lists) containg the decoded examples (with word ids representing the sequence)
 
         Returns:
             The `word` translations for each src sequence in the batch as a list, where each translation
             is represented as a list of tokens
         """
+        if torch.is_tensor(batch):
+            batch = batch.tolist()
         sentences = []
-        for example in batch.tolist():
+        for example in batch:
             sentence = []
             for token_id in example:
                 token_id = int(token_id)
@@ -6,6 +6,7 @@ import shutil
 import logging
 from torch import nn
 import copy
+import contextlib
 import numpy as np
 from torch.autograd import Variable
 
@@ -24,6 +25,22 @@ def get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
 
 
+def use_checkpoint(module, layer_index, x):
+    """
+    Whether to checkpoint (recompute during the backward pass) a layer of a Transformer Encoder/Decoder
+
+    Arguments:
+        module: the TransformerEncoder/TransformerDecoder
+        layer_index: index of the layer in the stack
+        x: input of the layer
+
+    Returns:
+        True if the activations of the layer should be recomputed instead of being kept in memory
+    """
+    return (module.training and module.checkpoint_every > 0 and layer_index % module.checkpoint_every == 0
+            and torch.is_grad_enabled() and x.requires_grad)
+
+
 def mask_invalid_positions(max_seq_len):
     """ 
     Mask out invalid positions for Masked Multi-head Attention 
@@ -55,6 +72,24 @@ def make_tgt_mask(tgt, tgt_pad):
     return tgt_mask
 
 
+def mixed_precision(enabled):
+    """
+    Context manager that runs the ops of the model in bfloat16 on the CPU (autocast)
+
+    Arguments:
+        enabled: whether to use bfloat16 (if False, the ops run in the dtype of the model)
+
+    Returns:
+        An autocast context manager (or a context manager that does nothing)
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    if not hasattr(torch, "cpu") or not hasattr(torch.cpu, "amp"):
+        raise RuntimeError(
+            "bfloat16 autocast requires torch>=1.10 (torch.cpu.amp), see requirements.txt")
+    return torch.cpu.amp.autocast(dtype=torch.bfloat16)
+
+
 def set_logger(log_path):
     """
     Set logger to log info in the terminal and file `log path`